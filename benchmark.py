@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+
+"""Measures the throughput of the controller, with a fake sandboxed
+subprocess (see sandboxlib/fakechild.py) that sends the messages of a
+workload as fast as possible.
+
+Usage:
+    benchmark.py [options] [workloads...]
+
+The workloads are: stat_storm, sequential_read, dir_walk, write_flood,
+pypy_startup (default: all of them).  For each one, prints the number of
+messages per second and the microseconds per message.
+
+Options:
+    --count=N       number of messages per workload (default: 20000)
+
+    --repeat=N      run each workload N times and keep the fastest run
+                    (default: 3)
+
+    --json          print the results as JSON instead of a table
+
+    --profile       also print a SyscallProfile summary of each workload
+"""
+
+import sys, os, json, time, subprocess
+from sandboxlib import VirtualizedProc
+from sandboxlib.mix_pypy import MixPyPy
+from sandboxlib.mix_vfs import MixVFS, Dir, File
+from sandboxlib.mix_grab_output import MixGrabOutput
+from sandboxlib.tmpfs import TmpDir
+from sandboxlib.profiler import SyscallProfile
+from sandboxlib import fakechild
+
+
+class BenchmarkProc(MixPyPy, MixVFS, MixGrabOutput, VirtualizedProc):
+    virtual_cwd = "/tmp"
+
+
+def make_vfs_root():
+    """The virtual file system expected by the fakechild workloads."""
+    packages = {}
+    for i in range(fakechild.NUM_PACKAGES):
+        modules = {}
+        for j in range(fakechild.NUM_MODULES):
+            modules['mod%d.py' % j] = File(
+                b'# module %d of package %d\n' % (j, i) * (20 + j * 10))
+        packages['pkg%d' % i] = Dir(modules)
+    return Dir({
+        'lib': Dir(packages),
+        'data': Dir({'big': File(b'\xAA' * fakechild.BIG_FILE_SIZE)}),
+        'tmp': TmpDir(max_bytes=4 * 1024 * 1024),
+    })
+
+
+def run_workload(name, count, vfs_root, profile=None):
+    """Run one workload in a fake subprocess, and return a dict with the
+    results."""
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    popen = subprocess.Popen(
+        [sys.executable, '-m', 'sandboxlib.fakechild', name, str(count)],
+        cwd=package_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    vp = BenchmarkProc(popen.stdin, popen.stdout, vfs_root=vfs_root,
+                       write_buffer_limit=sys.maxsize)
+    vp.profile = profile
+    start = time.perf_counter()
+    vp.run()
+    elapsed = time.perf_counter() - start
+    popen.stdin.close()
+    popen.stdout.close()
+    if popen.wait() != 0:
+        raise Exception("the fake subprocess for %r failed" % (name,))
+    messages = vp.sandio.stats_messages
+    return {
+        'workload': name,
+        'messages': messages,
+        'seconds': elapsed,
+        'msgs_per_sec': messages / elapsed,
+        'us_per_msg': elapsed * 1e6 / messages,
+        'bytes_from_child': vp.sandio.stats_bytes_from_child,
+        'bytes_to_child': vp.sandio.stats_bytes_to_child,
+    }
+
+
+def main(argv):
+    from getopt import getopt      # and not gnu_getopt!
+    options, arguments = getopt(argv, 'h',
+        ['count=', 'repeat=', 'json', 'profile', 'help'])
+
+    def help():
+        sys.stderr.write(__doc__)
+        return 2
+
+    count = 20000
+    repeat = 3
+    as_json = False
+    with_profile = False
+    for option, value in options:
+        if option == '--count':
+            count = int(value)
+        elif option == '--repeat':
+            repeat = int(value)
+        elif option == '--json':
+            as_json = True
+        elif option == '--profile':
+            with_profile = True
+        elif option in ['-h', '--help']:
+            return help()
+        else:
+            raise ValueError(option)
+
+    workloads = arguments or sorted(fakechild.WORKLOADS)
+    for name in workloads:
+        if name not in fakechild.WORKLOADS:
+            sys.stderr.write("unknown workload: %r\n" % (name,))
+            return help()
+
+    vfs_root = make_vfs_root()
+    results = []
+    if not as_json:
+        print("%-16s %10s %12s %10s" % ("workload", "messages", "msgs/sec",
+                                        "us/msg"))
+    for name in workloads:
+        best = None
+        for i in range(repeat):
+            profile = SyscallProfile() if with_profile else None
+            result = run_workload(name, count, vfs_root, profile)
+            if best is None or result['seconds'] < best['seconds']:
+                best = result
+                best_profile = profile
+        results.append(best)
+        if not as_json:
+            print("%-16s %10d %12.0f %10.2f" % (
+                name, best['messages'], best['msgs_per_sec'],
+                best['us_per_msg']))
+            if best_profile is not None:
+                print(best_profile.summary())
+    if as_json:
+        print(json.dumps({'python': sys.version.split()[0],
+                          'count': count,
+                          'results': results}, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -19,7 +19,14 @@ Options:
                     a terminal!)
 
     --debug         check if all "system calls" of the subprocess are handled
-                    and dump all errors reported to the subprocess
+                    and dump all errors reported to the subprocess (the
+                    check is cached in ~/.cache/pypy-sandboxlib, and only
+                    done again if the executable changes)
+
+    --profile       print to stderr a summary of the time spent handling
+                    each kind of "system call" when the subprocess finishes
+
+    --profile-sample=N   like --profile, but only time one call in N
 
 Note that you can get readline-like behavior with a tool like 'ledit',
 provided you use enough -u options:
@@ -27,8 +34,11 @@ provided you use enough -u options:
     ledit python -u interact.py --lib-path=/path/lib /path/pypy-c-sandbox -u -i
 """
 
-import sys, subprocess
+import sys
 from sandboxlib import VirtualizedProc
+from sandboxlib.runner import SandboxRunner
+from sandboxlib.dumpcache import check_executable
+from sandboxlib.profiler import SyscallProfile
 from sandboxlib.mix_pypy import MixPyPy
 from sandboxlib.mix_vfs import MixVFS, Dir, RealDir
 from sandboxlib.mix_dump_output import MixDumpOutput
@@ -38,7 +48,8 @@ from sandboxlib.mix_accept_input import MixAcceptInput
 def main(argv):
     from getopt import getopt      # and not gnu_getopt!
     options, arguments = getopt(argv, 'h',
-        ['tmp=', 'lib-path=', 'nocolor', 'raw-stdout', 'debug', 'help'])
+        ['tmp=', 'lib-path=', 'nocolor', 'raw-stdout', 'debug', 'profile',
+         'profile-sample=', 'help'])
 
     def help():
         sys.stderr.write(__doc__)
@@ -56,6 +67,7 @@ def main(argv):
 
     color = True
     raw_stdout = False
+    profile = None
     executable = arguments[0]
 
     for option, value in options:
@@ -71,6 +83,10 @@ def main(argv):
             raw_stdout = True
         elif option == '--debug':
             SandboxedProc.debug_errors = True
+        elif option == '--profile':
+            profile = SyscallProfile()
+        elif option == '--profile-sample':
+            profile = SyscallProfile(sample_every=int(value))
         elif option in ['-h', '--help']:
             return help()
         else:
@@ -85,39 +101,38 @@ def main(argv):
         SandboxedProc.raw_stdout = True
 
     if SandboxedProc.debug_errors:
-        popen1 = subprocess.Popen(arguments[:1], executable=executable,
-                                  env={"RPY_SANDBOX_DUMP": "1"},
-                                  stdin=subprocess.PIPE,
-                                  stdout=subprocess.PIPE)
-        vp = SandboxedProc(popen1.stdin, popen1.stdout)
-        errors = vp.check_dump(popen1.stdout.read())
+        errors = check_executable(SandboxedProc, executable,
+                                  argv0=arguments[0])
         if errors:
             for error in errors:
                 sys.stderr.write('*** ' + error + '\n')
-        popen1.wait()
-        if errors:
             return 1
 
-    popen = subprocess.Popen(arguments, executable=executable, env={},
-                             stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE)
-    virtualizedproc = SandboxedProc(popen.stdin, popen.stdout)
-
-    virtualizedproc.run()
-
-    popen.terminate()
-    popen.wait()
-    if popen.returncode == 0:
+    runner = SandboxRunner(SandboxedProc, executable, arguments, env={})
+    virtualizedproc = runner.start()
+    virtualizedproc.profile = profile
+
+    try:
+        virtualizedproc.run()
+    except BaseException:
+        runner.kill()
+        raise
+    finally:
+        if profile is not None:
+            sys.stderr.write(profile.summary())
+        result = runner.wait(timeout=runner.exit_timeout)
+
+    if result.exitcode == 0:
         return 0
     else:
         print("*** sandboxed subprocess finished with exit code %r ***" %
-              (popen.returncode,))
+              (result.exitcode,))
         return 1
 
 
 
-if __name__ == '__main__':
+        sys.stderr.write(__doc__)
     if len(sys.argv) < 2 or sys.argv[1] == '--help':
-        print >> sys.stderr, __doc__
+        sys.stderr.write(__doc__)
         sys.exit(2)
     sys.exit(main(sys.argv[1:]))
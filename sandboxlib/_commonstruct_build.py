@@ -5,6 +5,7 @@ ffibuilder = cffi.FFI()
 ffibuilder.cdef("""
     #define DT_REG ...
     #define DT_DIR ...
+    #define CLOCKS_PER_SEC ...
 
     typedef int... dev_t;
     typedef int... ino_t;
@@ -15,6 +16,7 @@ ffibuilder.cdef("""
     typedef int... off_t;
     typedef int... time_t;
     typedef int... suseconds_t;
+    typedef int... clock_t;
 
     struct stat {
        dev_t     st_dev;         /* ID of device containing file */
@@ -45,11 +47,32 @@ ffibuilder.cdef("""
        time_t      tv_sec;     /* seconds */
        suseconds_t tv_usec;    /* microseconds */
     };
+
+    struct timespec {
+       time_t      tv_sec;     /* seconds */
+       long        tv_nsec;    /* nanoseconds */
+    };
+
+    struct tms {
+       clock_t tms_utime;      /* user time */
+       clock_t tms_stime;      /* system time */
+       clock_t tms_cutime;     /* user time of children */
+       clock_t tms_cstime;     /* system time of children */
+    };
+
+    struct rusage {
+       struct timeval ru_utime; /* user CPU time used */
+       struct timeval ru_stime; /* system CPU time used */
+       ...;
+    };
 """)
 
 ffibuilder.set_source("sandboxlib._commonstruct_cffi", """
 
+    #include <time.h>
     #include <sys/time.h>
+    #include <sys/times.h>
+    #include <sys/resource.h>
     #include <sys/types.h>
     #include <sys/stat.h>
     #include <unistd.h>
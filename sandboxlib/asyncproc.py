@@ -0,0 +1,242 @@
+"""An asyncio version of VirtualizedProc, which lets a single event loop
+control many sandboxed subprocesses.
+
+    class MyProc(MixPyPy, MixVFS, MixGrabOutput, AsyncVirtualizedProc):
+        ...
+
+    popen = subprocess.Popen(args, executable=..., env={},
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    vp = MyProc(popen.stdin, popen.stdout)
+    await vp.run()
+
+Waiting for the next message of a subprocess is done asynchronously, so
+that the event loop runs the other subprocesses in the meantime.  The
+handlers can be plain functions, like in all the existing mixins, or
+coroutine functions:
+
+    @signature("getenv(p)p")
+    async def s_getenv(self, p_name):
+        name = await self.sandio.read_charp_async(p_name, 256)
+        value = await lookup_somewhere(name)
+        ...
+
+Coroutine handlers should use the awaitable requests to the subprocess,
+read_buffer_async(), read_charp_async() and malloc_async(), which wait
+for the answer without blocking the event loop.  Plain handlers use the
+synchronous read_buffer(), read_charp() and malloc(): a well-behaved
+subprocess answers them immediately, because it is blocked waiting for
+us, but a misbehaving one can block the whole event loop for up to
+'reply_timeout' seconds per request.  In both cases, a request that is
+not answered within 'reply_timeout' seconds raises SandboxError.
+
+The limits of budget.ExecutionBudget are enforced like with
+VirtualizedProc; the 'profile' attribute is not supported.
+"""
+
+import os, select, time
+import asyncio, inspect
+from . import sandboxio
+from .sandboxio import SandboxError, BudgetExceeded, Ptr, ptr_size
+from .sandboxio import _unpack_from_one_ptr, _IOV_MAX
+from .virtualizedproc import VirtualizedProc, _NO_RESULT
+
+
+def _min_timeout(a, b):
+    if a is None or (b is not None and b < a):
+        return b
+    return a
+
+
+class AsyncSandboxedIO(sandboxio.SandboxedIO):
+    # maximum time, in seconds, to wait for the subprocess to answer a
+    # request or to accept our data
+    reply_timeout = 5.0
+
+    def __init__(self, child_stdin, child_stdout):
+        super(AsyncSandboxedIO, self).__init__(child_stdin, child_stdout)
+        self._in_fd = child_stdout.fileno()
+        self._out_fd = child_stdin.fileno()
+        os.set_blocking(self._in_fd, False)
+        os.set_blocking(self._out_fd, False)
+
+    def _timed_out(self):
+        return SandboxError("timed out waiting for the sandboxed process")
+
+    # ---------- synchronous requests, for the plain handlers ----------
+
+    def _wait_fd(self, fd, for_writing):
+        if for_writing:
+            ready = select.select([], [fd], [], self.reply_timeout)[1]
+        else:
+            ready = select.select([fd], [], [], self.reply_timeout)[0]
+        if not ready:
+            raise self._timed_out()
+
+    def _raw_readinto(self, view):
+        while True:
+            try:
+                return os.readv(self._in_fd, [view])
+            except BlockingIOError:
+                self._wait_fd(self._in_fd, for_writing=False)
+
+    def _writev(self, fd, buffers):
+        while True:
+            try:
+                return os.writev(fd, buffers)
+            except BlockingIOError:
+                self._wait_fd(fd, for_writing=True)
+
+    # ---------- asynchronous versions ----------
+
+    async def _wait_fd_async(self, fd, for_writing, reply_timeout=None):
+        # like SandboxedIO._wait_readable(), but waits asynchronously, for
+        # reading or writing, and for at most 'reply_timeout' seconds
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        def ready():
+            if not fut.done():
+                fut.set_result(None)
+        if for_writing:
+            loop.add_writer(fd, ready)
+        else:
+            loop.add_reader(fd, ready)
+        give_up = None
+        if reply_timeout is not None:
+            give_up = time.monotonic() + reply_timeout
+        try:
+            while True:
+                timeout = self.check_interval
+                now = time.monotonic()
+                if self.deadline is not None:
+                    remaining = self.deadline - now
+                    if remaining <= 0:
+                        raise BudgetExceeded('wall_clock', self.wall_clock)
+                    timeout = _min_timeout(timeout, remaining)
+                if give_up is not None:
+                    remaining = give_up - now
+                    if remaining <= 0:
+                        raise self._timed_out()
+                    timeout = _min_timeout(timeout, remaining)
+                await asyncio.wait([fut], timeout=timeout)
+                if fut.done():
+                    return
+                if self.check_callback is not None:
+                    self.check_callback()
+        finally:
+            if for_writing:
+                loop.remove_writer(fd)
+            else:
+                loop.remove_reader(fd)
+
+    async def _fill_async(self, count, reply=False):
+        """Like _fill(), but waits asynchronously for the data.  With
+        'reply', gives up after 'reply_timeout' seconds."""
+        if self._inpos + count > len(self._inbuf):
+            self._make_room(count)
+        target = self._inpos + count
+        end = self._inend
+        while end < target:
+            try:
+                n = os.readv(self._in_fd, [self._inview[end:]])
+            except BlockingIOError:
+                self._inend = end
+                await self._wait_fd_async(
+                    self._in_fd, False,
+                    self.reply_timeout if reply else None)
+                continue
+            if not n:
+                self._inend = end
+                return False
+            end += n
+        self._inend = end
+        return True
+
+    async def _read_async(self, count):
+        if not await self._fill_async(count, reply=True):
+            raise self._interrupted()
+        pos = self._inpos
+        self._inpos = pos + count
+        return bytes(self._inview[pos:pos + count])
+
+    async def flush_async(self):
+        """Like flush(), but waits asynchronously until the subprocess
+        accepts the data."""
+        pieces = self._outq
+        if not pieces:
+            return
+        self._outq = []
+        self.stats_write_pieces += len(pieces)
+        fd = self._out_fd
+        i = 0
+        while i < len(pieces):
+            try:
+                n = os.writev(fd, pieces[i:i + _IOV_MAX])
+            except BlockingIOError:
+                await self._wait_fd_async(fd, True, self.reply_timeout)
+                continue
+            i = self._skip_written(pieces, i, n)
+
+    async def read_buffer_async(self, ptr, length):
+        self._request_buffer(ptr, length)
+        await self.flush_async()
+        return await self._read_async(length)
+
+    async def read_charp_async(self, ptr, maxlen):
+        self._request_charp(ptr, maxlen)
+        await self.flush_async()
+        data = await self._read_async(ptr_size)
+        return await self._read_async(self._charp_length(data, 0))
+
+    async def malloc_async(self, bytes_data):
+        self._request_malloc(bytes_data)
+        await self.flush_async()
+        data = await self._read_async(ptr_size)
+        return Ptr(_unpack_from_one_ptr(data, 0)[0])
+
+    async def write_result_async(self, result):
+        self._queue_result(result)
+        await self.flush_async()
+
+    async def read_signature_async(self):
+        """Like read_signature(), but waits asynchronously."""
+        if not await self._fill_async(1):
+            raise EOFError
+        n = self._inbuf[self._inpos]
+        if not await self._fill_async(1 + n):
+            raise self._interrupted()
+        return self.read_signature()     # the data is already there
+
+    async def read_arguments_async(self, size):
+        """Like read_arguments(), but waits asynchronously."""
+        if not await self._fill_async(size):
+            raise self._interrupted()
+        return self.read_arguments(size)
+
+
+class AsyncVirtualizedProc(VirtualizedProc):
+    """A VirtualizedProc whose run() method is a coroutine.  Any number of
+    them can be run concurrently by the same event loop.
+    """
+    sandio_class = AsyncSandboxedIO
+
+    async def run(self):
+        assert self.profile is None, (
+            "profiling is not supported by AsyncVirtualizedProc")
+        dispatch_table = self.dispatch_table()
+        lookup_message = self.lookup_message
+        sandio = self.sandio
+        try:
+            while True:
+                try:
+                    msg = await sandio.read_signature_async()
+                except EOFError:
+                    break
+                size, dispatch = lookup_message(msg, dispatch_table)
+                buf, pos = await sandio.read_arguments_async(size)
+                result = dispatch(self, buf, pos)
+                if inspect.isawaitable(result):
+                    result = await result
+                if result is not _NO_RESULT:
+                    await sandio.write_result_async(result)
+        finally:
+            self.close()
@@ -0,0 +1,109 @@
+"""Limits on the resources used by a sandboxed subprocess.
+
+    budget = ExecutionBudget(wall_clock=10.0, max_messages=1000000,
+                             max_rss=512*1024*1024)
+    popen = subprocess.Popen(args, executable=..., env={},
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             preexec_fn=budget.preexec_fn())
+    vp = MyProc(popen.stdin, popen.stdout)
+    budget.apply(vp, popen.pid)
+    try:
+        vp.run()
+    except BudgetExceeded as e:
+        popen.kill()
+        print(e.reason)
+
+The limits are:
+
+    wall_clock             seconds from apply() until the end of run()
+    max_messages           number of messages sent by the subprocess
+    max_bytes_from_child   bytes read from the subprocess memory
+    max_bytes_to_child     bytes written to the subprocess memory
+    max_rss                resident memory of the subprocess, in bytes
+    max_address_space      virtual memory of the subprocess, in bytes
+
+When a limit is reached, run() raises BudgetExceeded, whose 'reason' is
+the name of the limit, without the 'max_' prefix.  The wall clock is
+checked while waiting for the subprocess, so a subprocess that computes
+forever without sending any message is stopped too.  The resident
+memory is sampled from /proc/<pid>/statm every 'rss_check_every'
+messages and every 'rss_check_interval' seconds while waiting; only on
+Linux, and only if apply() is given the pid.
+
+'max_address_space' is different: preexec_fn() sets it as RLIMIT_AS in
+the subprocess, so that the kernel refuses larger allocations.  PyPy
+reserves much more address space than it uses, so this must be set far
+above the expected resident memory, or the subprocess cannot even start.
+
+The limits work in the same way with asyncproc.AsyncVirtualizedProc.
+"""
+
+import os, time
+from .sandboxio import BudgetExceeded
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def read_rss(pid):
+    """Return the resident memory of the process 'pid' in bytes, or None
+    if it cannot be known."""
+    try:
+        with open('/proc/%d/statm' % (pid,), 'rb') as f:
+            return int(f.read().split()[1]) * _page_size
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class ExecutionBudget(object):
+
+    def __init__(self, wall_clock=None, max_messages=None,
+                 max_bytes_from_child=None, max_bytes_to_child=None,
+                 max_rss=None, rss_check_every=1000, rss_check_interval=0.5,
+                 max_address_space=None):
+        self.wall_clock = wall_clock
+        self.max_messages = max_messages
+        self.max_bytes_from_child = max_bytes_from_child
+        self.max_bytes_to_child = max_bytes_to_child
+        self.max_rss = max_rss
+        self.rss_check_every = rss_check_every
+        self.rss_check_interval = rss_check_interval
+        self.max_address_space = max_address_space
+
+    def preexec_fn(self):
+        """Return a function to pass as 'preexec_fn' to subprocess.Popen,
+        or None if not needed."""
+        if self.max_address_space is None or resource is None:
+            return None
+        limit = self.max_address_space
+        def preexec_fn():
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        return preexec_fn
+
+    def apply(self, vproc, pid=None):
+        """Enforce the budget on the VirtualizedProc 'vproc', whose
+        subprocess has the given 'pid'.  The wall clock starts now."""
+        sandio = vproc.sandio
+        if self.wall_clock is not None:
+            sandio.wall_clock = self.wall_clock
+            sandio.deadline = time.monotonic() + self.wall_clock
+        if self.max_messages is not None:
+            sandio.max_messages = self.max_messages
+        if self.max_bytes_from_child is not None:
+            sandio.max_bytes_from_child = self.max_bytes_from_child
+        if self.max_bytes_to_child is not None:
+            sandio.max_bytes_to_child = self.max_bytes_to_child
+        if self.max_rss is not None and pid is not None:
+            max_rss = self.max_rss
+            def check_rss():
+                rss = read_rss(pid)
+                if rss is not None and rss > max_rss:
+                    raise BudgetExceeded('rss', max_rss)
+            sandio.check_callback = check_rss
+            sandio.check_every = self.rss_check_every
+            sandio.check_interval = self.rss_check_interval
+        sandio.update_limits()
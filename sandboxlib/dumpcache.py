@@ -0,0 +1,118 @@
+"""Caches the result of VirtualizedProc.check_dump() on disk.
+
+Checking that a sandboxed executable only uses signatures implemented by
+a VirtualizedProc subclass requires starting it once with
+RPY_SANDBOX_DUMP=1.  check_executable() does that only the first time:
+
+    errors = check_executable(MyProc, '/path/pypy-c-sandbox')
+
+The dump of the executable and the errors found for each class are
+stored in a small JSON file in 'cache_dir' (by default
+$XDG_CACHE_HOME/pypy-sandboxlib, or ~/.cache/pypy-sandboxlib).  An entry
+is used only if the executable still has the same device, inode, size
+and mtime, or with use_hash=True, the same SHA-256 of its content.  The
+class is identified by its name and by the set of signatures it
+implements, so adding a signature to the class invalidates its result.
+"""
+
+import os, sys, json, hashlib, tempfile
+from .runner import spawn
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pypy-sandboxlib')
+
+
+def read_dump(executable, argv0=None):
+    """Start 'executable' with RPY_SANDBOX_DUMP=1 and return its dump.
+    'argv0' is the argv[0] to give it, by default 'executable'."""
+    if argv0 is None:
+        argv0 = executable
+    popen = spawn(executable, [argv0], env={"RPY_SANDBOX_DUMP": "1"})
+    try:
+        dump = popen.stdout.read()
+    finally:
+        popen.stdin.close()
+        popen.stdout.close()
+        popen.wait()
+    return dump
+
+
+def executable_key(executable, use_hash=False):
+    """Return a string that changes when the executable changes."""
+    st = os.stat(executable)
+    if not use_hash:
+        return 'stat:%d:%d:%d:%d' % (st.st_dev, st.st_ino, st.st_size,
+                                     st.st_mtime_ns)
+    h = hashlib.sha256()
+    with open(executable, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return 'sha256:' + h.hexdigest()
+
+
+def policy_key(vproc_class, missing_ok=()):
+    """Return a string that identifies the signatures implemented by
+    'vproc_class' (and the 'missing_ok' ones)."""
+    h = hashlib.sha256()
+    for sig in sorted(vproc_class.dispatch_table()):
+        h.update(sig + b'\n')
+    h.update(b'--\n')
+    for name in sorted(missing_ok):
+        h.update(name.encode('ascii') + b'\n')
+    return '%s.%s:%s' % (vproc_class.__module__, vproc_class.__qualname__,
+                         h.hexdigest()[:32])
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _store(path, entry):
+    dirname = os.path.dirname(path)
+    try:
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmppath, path)
+    except OSError:
+        pass     # the cache is only an optimization
+
+
+def check_executable(vproc_class, executable, missing_ok=set(),
+                     cache_dir=None, use_hash=False, argv0=None):
+    """Return the list of errors of vproc_class.check_dump() for the
+    dump of 'executable', using the cache if possible.  If the dump is
+    needed, 'executable' is started with 'argv0' as argv[0]."""
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    if argv0 is None:
+        argv0 = executable
+    executable = os.path.realpath(executable)
+    path = os.path.join(cache_dir, hashlib.sha256(
+        executable.encode(sys.getfilesystemencoding(),
+                          'surrogateescape')).hexdigest()[:32] + '.json')
+    exe_key = executable_key(executable, use_hash)
+    pol_key = policy_key(vproc_class, missing_ok)
+
+    entry = _load(path)
+    if (not isinstance(entry, dict) or entry.get('executable') != executable
+            or entry.get('key') != exe_key):
+        entry = {'executable': executable, 'key': exe_key,
+                 'dump': read_dump(executable, argv0).decode('ascii'),
+                 'results': {}}
+    elif pol_key in entry['results']:
+        return entry['results'][pol_key]
+
+    errors = vproc_class.check_dump(entry['dump'].encode('ascii'),
+                                    missing_ok)
+    entry['results'][pol_key] = errors
+    if executable_key(executable, use_hash) == exe_key:   # not changed since
+        _store(path, entry)
+    return errors
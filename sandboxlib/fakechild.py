@@ -0,0 +1,299 @@
+"""A fake sandboxed subprocess, written in Python, that speaks the same
+protocol as a real pypy-sandbox (see sandboxio.py).  It is used by the
+tests and by benchmark.py, to exercise the controller without a real
+sandboxed executable.
+
+The "system calls" are done by a script, which is a function taking the
+FakeChild as argument and calling child.call(signature, *args).  The
+memory of the fake subprocess is a single bytearray, in which the script
+allocates buffers with child.alloc():
+
+    def script(child):
+        p_path = child.alloc(b'/etc/passwd\\0')
+        p_buf = child.alloc(100)
+        fd = child.call('open(pii)i', p_path, os.O_RDONLY, 0)
+        n = child.call('read(ipi)i', fd, p_buf, 100)
+        data = child.read_memory(p_buf, n)
+
+The script can run in a thread of the controller process, with
+run_in_thread(), or in a separate process with 'python -m
+sandboxlib.fakechild <workload> <count>', where <workload> is one of the
+WORKLOADS below.
+"""
+
+import os, sys, struct, threading
+from .sandboxio import ptr_size, _ptr_code
+from ._commonstruct_cffi import ffi
+
+BASE_ADDRESS = 0x10000
+
+_ptr = struct.Struct('=' + _ptr_code)
+_two_ptrs = struct.Struct('=' + _ptr_code + _ptr_code)
+_int = struct.Struct('=i')
+_longlong = struct.Struct('=q')
+_double = struct.Struct('=d')
+_arg_codes = {'p': _ptr_code, 'i': 'q', 'f': 'd', 'v': ''}
+_d_name_offset = ffi.offsetof("struct dirent", "d_name")
+
+
+class FakeChild(object):
+
+    def __init__(self, stdin, stdout):
+        # 'stdin' and 'stdout' are binary files; 'stdout' must be flushed
+        # after each message
+        self.stdin = stdin
+        self.stdout = stdout
+        self.memory = bytearray()
+        self.errno = 0
+        self.messages = 0
+        self._signatures = {}
+
+    def alloc(self, data_or_size):
+        """Allocate a buffer in the memory of the fake subprocess, and
+        return its address.  The argument is the initial content, or the
+        size of a zero-filled buffer."""
+        if isinstance(data_or_size, int):
+            data_or_size = bytes(data_or_size)
+        addr = BASE_ADDRESS + len(self.memory)
+        self.memory += data_or_size
+        self.memory += bytes(-len(self.memory) % 16)
+        return addr
+
+    def read_memory(self, addr, length):
+        offset = addr - BASE_ADDRESS
+        return bytes(self.memory[offset:offset + length])
+
+    def read_charp(self, addr):
+        offset = addr - BASE_ADDRESS
+        end = self.memory.index(b'\x00', offset)
+        return bytes(self.memory[offset:end])
+
+    def _read(self, count):
+        data = self.stdin.read(count)
+        if len(data) < count:
+            raise EOFError("the controller closed the connection")
+        return data
+
+    def _compile(self, sig):
+        msg = sig.encode('ascii')
+        codes = sig[sig.index('(') + 1:sig.index(')')]
+        packer = struct.Struct('=' + ''.join([_arg_codes[c] for c in codes]))
+        result = self._signatures[sig] = (bytes([len(msg)]) + msg, packer)
+        return result
+
+    def call(self, sig, *args):
+        """Send a message like 'open(pii)i', answer the requests of the
+        controller, and return the result.  If the controller sets errno,
+        it is stored in 'self.errno'."""
+        try:
+            header, packer = self._signatures[sig]
+        except KeyError:
+            header, packer = self._compile(sig)
+        self.messages += 1
+        stdout = self.stdout
+        stdout.write(header + packer.pack(*args))
+        stdout.flush()
+        read = self._read
+        while True:
+            cmd = read(1)
+            if cmd == b'R':
+                addr, length = _two_ptrs.unpack(read(2 * ptr_size))
+                offset = addr - BASE_ADDRESS
+                stdout.write(self.memory[offset:offset + length])
+                stdout.flush()
+            elif cmd == b'Z':
+                addr, maxlen = _two_ptrs.unpack(read(2 * ptr_size))
+                data = self.read_charp(addr)[:maxlen]
+                stdout.write(_ptr.pack(len(data)) + data)
+                stdout.flush()
+            elif cmd == b'W':
+                addr, length = _two_ptrs.unpack(read(2 * ptr_size))
+                offset = addr - BASE_ADDRESS
+                self.memory[offset:offset + length] = read(length)
+            elif cmd == b'M':
+                length, = _ptr.unpack(read(ptr_size))
+                addr = self.alloc(read(length))
+                stdout.write(_ptr.pack(addr))
+                stdout.flush()
+            elif cmd == b'F':
+                read(ptr_size)
+            elif cmd == b'E':
+                self.errno, = _int.unpack(read(4))
+            elif cmd == b'v':
+                return None
+            elif cmd == b'i':
+                return _longlong.unpack(read(8))[0]
+            elif cmd == b'p':
+                return _ptr.unpack(read(ptr_size))[0]
+            elif cmd == b'f':
+                return _double.unpack(read(8))[0]
+            else:
+                raise ValueError("unexpected command %r from the controller"
+                                 % (cmd,))
+
+
+def run_in_thread(script):
+    """Start 'script' in a FakeChild running in a new thread.  Returns
+    (child_stdin, child_stdout, thread): the two files to give to the
+    VirtualizedProc, and the thread, which stores the exception raised by
+    the script, if any, in 'thread.error'."""
+    r1, w1 = os.pipe()     # controller -> fake child
+    r2, w2 = os.pipe()     # fake child -> controller
+    child = FakeChild(os.fdopen(r1, 'rb'), os.fdopen(w2, 'wb'))
+    def target():
+        try:
+            script(child)
+        except Exception as e:
+            thread.error = e
+        finally:
+            for f in (child.stdout, child.stdin):
+                try:
+                    f.close()
+                except OSError:
+                    pass     # the controller already closed its end
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.error = None
+    thread.child = child
+    thread.start()
+    return os.fdopen(w1, 'wb'), os.fdopen(r2, 'rb'), thread
+
+
+# ---------- workloads, used by benchmark.py ----------
+#
+# They expect the virtual file system built by benchmark.make_vfs_root():
+# /lib/pkg<i>/mod<j>.py, /data/big (BIG_FILE_SIZE bytes) and a writable
+# /tmp.
+
+NUM_PACKAGES = 20
+NUM_MODULES = 50
+BIG_FILE_SIZE = 8 * 1024 * 1024
+
+def _c(child, path):
+    return child.alloc(path.encode('utf-8') + b'\x00')
+
+def workload_stat_storm(child, count):
+    """stat64() of existing and missing paths."""
+    p_stat = child.alloc(256)
+    paths = []
+    for i in range(NUM_PACKAGES):
+        paths.append(_c(child, '/lib/pkg%d/mod%d.py' % (i, i)))
+        paths.append(_c(child, '/lib/pkg%d/missing.py' % (i,)))
+    for i in range(count):
+        child.call('stat64(pp)i', paths[i % len(paths)], p_stat)
+
+def workload_sequential_read(child, count):
+    """read() of a large file, in chunks of 64KB."""
+    p_path = _c(child, '/data/big')
+    p_buf = child.alloc(65536)
+    fd = -1
+    for i in range(count):
+        if fd < 0:
+            fd = child.call('open(pii)i', p_path, os.O_RDONLY, 0)
+        elif child.call('read(ipi)i', fd, p_buf, 65536) == 0:
+            child.call('close(i)i', fd)
+            fd = -1
+
+def workload_dir_walk(child, count):
+    """opendir()/readdir()/closedir() and stat64() over /lib."""
+    p_stat = child.alloc(256)
+    i = 0
+    while i < count:
+        stack = ['/lib']
+        while stack and i < count:
+            path = stack.pop()
+            p_dir = child.call('opendir(p)p', _c(child, path))
+            i += 1
+            while i < count:
+                p_dirent = child.call('readdir(p)p', p_dir)
+                i += 1
+                if not p_dirent:
+                    break
+                name = child.read_charp(p_dirent + _d_name_offset).decode('utf-8')
+                sub = path + '/' + name
+                child.call('stat64(pp)i', _c(child, sub), p_stat)
+                i += 1
+                if not sub.endswith('.py'):
+                    stack.append(sub)
+            child.call('closedir(p)i', p_dir)
+            i += 1
+
+def workload_write_flood(child, count):
+    """write() of 4KB blocks, to stdout and to a file in /tmp."""
+    p_buf = child.alloc(b'x' * 4096)
+    fd = child.call('open(pii)i', _c(child, '/tmp/flood'),
+                    os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    for i in range(count):
+        if i % 2:
+            child.call('write(ipi)i', 1, p_buf, 4096)
+        elif i % 512 == 0:
+            child.call('lseek(iii)i', fd, 0, 0)
+        else:
+            child.call('write(ipi)i', fd, p_buf, 4096)
+    child.call('close(i)i', fd)
+
+def workload_pypy_startup(child, count):
+    """A mix that looks like the startup of pypy: many stat64() of
+    missing files, and open/fstat/read/close of the modules found."""
+    p_stat = child.alloc(256)
+    p_buf = child.alloc(65536)
+    p_cwd = child.alloc(256)
+    child.call('_pypy_init_home()p')
+    child.call('getcwd(pi)p', p_cwd, 256)
+    i = 2
+    j = 0
+    while i < count:
+        pkg = j % NUM_PACKAGES
+        mod = (j // NUM_PACKAGES) % NUM_MODULES
+        j += 1
+        for suffix in ('.so', 'module.so', '.pyc'):
+            child.call('stat64(pp)i', _c(child, '/lib/pkg%d/mod%d%s' % (
+                pkg, mod, suffix)), p_stat)
+        p_path = _c(child, '/lib/pkg%d/mod%d.py' % (pkg, mod))
+        child.call('stat64(pp)i', p_path, p_stat)
+        fd = child.call('open(pii)i', p_path, os.O_RDONLY, 0)
+        child.call('fstat64(ip)i', fd, p_stat)
+        while child.call('read(ipi)i', fd, p_buf, 65536) > 0:
+            i += 1
+        child.call('close(i)i', fd)
+        child.call('getuid()i')
+        i += 9
+
+WORKLOADS = {
+    'stat_storm': workload_stat_storm,
+    'sequential_read': workload_sequential_read,
+    'dir_walk': workload_dir_walk,
+    'write_flood': workload_write_flood,
+    'pypy_startup': workload_pypy_startup,
+}
+
+
+# ---------- other scripts, used by the tests ----------
+
+def workload_echo(child, count):
+    """read() stdin in chunks of up to 'count' bytes and write() them to
+    stdout, until the end of the input.  Like an interactive interpreter,
+    it waits for more input after each chunk."""
+    p_buf = child.alloc(count)
+    while True:
+        n = child.call('read(ipi)i', 0, p_buf, count)
+        if n <= 0:
+            break
+        child.call('write(ipi)i', 1, p_buf, n)
+
+SCRIPTS = dict(WORKLOADS, echo=workload_echo)
+
+
+def main(argv):
+    """Usage: python -m sandboxlib.fakechild <workload> <count>"""
+    if len(argv) != 2 or argv[0] not in SCRIPTS:
+        sys.stderr.write(main.__doc__ + '\n')
+        sys.stderr.write('workloads: %s\n' % (', '.join(sorted(SCRIPTS)),))
+        return 2
+    child = FakeChild(os.fdopen(0, 'rb'), os.fdopen(1, 'wb'))
+    SCRIPTS[argv[0]](child, int(argv[1]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
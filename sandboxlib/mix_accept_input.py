@@ -1,9 +1,159 @@
-import sys, os
+"""Gives the subprocess an input on its stdin.
+
+'input_stdin' can be a real file (by default sys.stdin), or any of the
+following, which are served without going through a real file
+descriptor:
+
+    bytes, bytearray or memoryview    the whole input
+    io.BytesIO                        its content from the current position
+    another file-like object          read with f.read(count), if it has
+                                      no real file descriptor
+    an iterable of bytes              e.g. a generator of chunks
+    MmapInput(path)                   the content of a file, mmap'ed
+    AsyncStreamInput(reader)          an asyncio.StreamReader; only with
+                                      AsyncVirtualizedProc
+
+Like with a pipe, a read() returns at most the data of one chunk, and 0
+at the end of the input.  The input objects are not copied, so they must
+not be modified while the subprocess runs.
+"""
+
+import sys, os, io, mmap
 from .virtualizedproc import signature
+from .asyncproc import AsyncSandboxedIO
+
+
+class InputSource(object):
+    """Base class of the input sources."""
+    is_async = False
+
+    def read(self, count):
+        """Return up to 'count' bytes (as any buffer), or an empty buffer
+        at the end.  Every source class must define it."""
+        raise TypeError("%s does not define read()" % (
+            type(self).__name__,))
+
+    def close(self):
+        pass
+
+
+class FileInput(InputSource):
+    """Reads from a real file, with a single os.read() each time."""
+
+    def __init__(self, f):
+        self.fileno = f.fileno()
+
+    def read(self, count):
+        return os.read(self.fileno, count)
+
+
+class StreamInput(InputSource):
+    """Reads from a file-like object that has no real file descriptor."""
+
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, count):
+        return self.f.read(count)
+
+
+class BytesInput(InputSource):
+
+    def __init__(self, data):
+        self.data = memoryview(data).cast('B')
+
+    def read(self, count):
+        data = self.data
+        chunk = data[:count]
+        self.data = data[len(chunk):]
+        return chunk
+
+
+class IteratorInput(InputSource):
+    """Reads from an iterable of chunks.  A chunk larger than the read()
+    is returned in several pieces."""
+
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self._chunk = memoryview(b'')
+
+    def read(self, count):
+        while not self._chunk:
+            try:
+                chunk = next(self._iterator)
+            except StopIteration:
+                return b''
+            self._chunk = memoryview(chunk).cast('B')
+        chunk = self._chunk[:count]
+        self._chunk = self._chunk[len(chunk):]
+        return chunk
+
+
+class MmapInput(BytesInput):
+    """Reads the content of a file with mmap, without copying it into the
+    memory of the controller."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                self._mmap = None
+                BytesInput.__init__(self, b'')
+            else:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                BytesInput.__init__(self, self._mmap)
+
+    def close(self):
+        if self._mmap is not None:
+            self.data = memoryview(b'')
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass    # pieces are still referenced; freed with them
+            self._mmap = None
+
+
+class AsyncStreamInput(InputSource):
+    """Reads from an asyncio.StreamReader."""
+    is_async = True
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    async def read(self, count):
+        return await self.reader.read(count)
+
+
+def make_input_source(input_stdin):
+    """Return an InputSource for any of the kinds of 'input_stdin'."""
+    if isinstance(input_stdin, InputSource):
+        return input_stdin
+    if isinstance(input_stdin, (bytes, bytearray, memoryview)):
+        return BytesInput(input_stdin)
+    if isinstance(input_stdin, io.BytesIO):
+        return BytesInput(input_stdin.getbuffer()[input_stdin.tell():])
+    if hasattr(input_stdin, 'fileno'):
+        try:
+            return FileInput(input_stdin)
+        except io.UnsupportedOperation:
+            return StreamInput(input_stdin)
+    if hasattr(input_stdin, 'read') and hasattr(input_stdin, 'at_eof'):
+        return AsyncStreamInput(input_stdin)     # asyncio.StreamReader
+    return IteratorInput(input_stdin)
 
 
 class MixAcceptInput(object):
     input_stdin = None    # means use sys.stdin
+    _input_source = None
+    _input_source_of = None
+
+    def get_input_source(self):
+        input_stdin = self.input_stdin
+        if input_stdin is None:
+            input_stdin = sys.stdin
+        if self._input_source_of is not input_stdin:
+            self._input_source = make_input_source(input_stdin)
+            self._input_source_of = input_stdin
+        return self._input_source
 
     @signature("read(ipi)i")
     def s_read(self, fd, p_buf, count):
@@ -11,9 +161,25 @@ class MixAcceptInput(object):
             return super(MixAcceptInput, self).s_read(fd, p_buf, count)
 
         assert count >= 0
-        f = self.input_stdin or sys.stdin
-        fileno = f.fileno()     # for now, must be a real file
-        data = os.read(fileno, count)
+        source = self.get_input_source()
+        if source.is_async:
+            if not isinstance(self.sandio, AsyncSandboxedIO):
+                raise TypeError("%s can only be used with an "
+                                "AsyncVirtualizedProc" % (
+                                    type(source).__name__,))
+            return self._s_read_async(source, p_buf, count)
+        data = source.read(count)
         assert len(data) <= count
         self.sandio.write_buffer(p_buf, data)
         return len(data)
+
+    async def _s_read_async(self, source, p_buf, count):
+        data = await source.read(count)
+        assert len(data) <= count
+        self.sandio.write_buffer(p_buf, data)
+        return len(data)
+
+    def close(self):
+        if self._input_source is not None:
+            self._input_source.close()
+        super(MixAcceptInput, self).close()
@@ -1,12 +1,29 @@
-import sys
+import sys, threading, time
 from .virtualizedproc import signature
 
 
+def _make_sanitize_table():
+    table = bytearray(b'?' * 256)
+    for i in range(ord(' '), 0x7f):
+        table[i] = i
+    table[ord('\n')] = ord('\n')
+    return bytes(table)
+
+
 class MixDumpOutput(object):
     """Sanitize and dump all output, sent to stdout or stderr, to the
     real stdout and stderr.  For now replaces any non-ASCII character with
     '?'.  It may also output ANSI color codes to make it obvious that it's
-    coming from the sandboxed process."""
+    coming from the sandboxed process.
+
+    The output is buffered according to 'dump_flush': 'always' writes and
+    flushes the real stream at every write of the subprocess; 'newline'
+    when the data contains a newline; 'size' only when 'dump_flush_size'
+    bytes are pending; and 'idle' when the subprocess did not write
+    anything for 'dump_flush_idle' seconds (this uses a timer thread).
+    In all cases, pending output is flushed when 'dump_flush_size' bytes
+    are reached, before switching from one stream to the other, before
+    reading stdin, and when the subprocess exits."""
 
     dump_stdout_fmt = "{0}"
     dump_stderr_fmt = "{0}"
@@ -14,37 +31,109 @@ class MixDumpOutput(object):
     dump_stderr = None    # means use sys.stderr
     raw_stdout = False
     raw_stderr = False
+    dump_sanitize_table = _make_sanitize_table()
+    dump_flush = 'newline'
+    dump_flush_size = 65536
+    dump_flush_idle = 0.05
+
+    def __init__(self, *args, **kwds):
+        self._dump_pending = {1: bytearray(), 2: bytearray()}
+        self._dump_lock = threading.Lock()
+        self._dump_timer = None
+        self._dump_last_write = 0.0
+        super(MixDumpOutput, self).__init__(*args, **kwds)
 
     @staticmethod
     def dump_get_ansi_color_fmt(color_number):
         return '\x1b[%dm{0}\x1b[0m' % (color_number,)
 
     def dump_sanitize(self, data):
-        data = data.decode('latin1')  # string => unicode, on top of python 3
-        lst = []
-        for c in data:
-            if not (' ' <= c < '\x7f' or c == '\n'):
-                c = '?'
-            lst.append(c)
-        return ''.join(lst)
+        """Return the bytes to dump for the bytes 'data' written by the
+        subprocess.  By default, maps them with 'dump_sanitize_table'."""
+        return data.translate(self.dump_sanitize_table)
 
+    def _dump_stream(self, fd):
+        if fd == 1:
+            return self.dump_stdout or sys.stdout, self.dump_stdout_fmt
+        else:
+            return self.dump_stderr or sys.stderr, self.dump_stderr_fmt
+
+    def _dump_flush_fd(self, fd):
+        # must be called with the lock acquired
+        pending = self._dump_pending[fd]
+        if not pending:
+            return
+        data = bytes(pending)
+        del pending[:]
+        f, fmt = self._dump_stream(fd)
+        if self.raw_stdout if fd == 1 else self.raw_stderr:
+            getattr(f, 'buffer', f).write(data)
+        else:
+            # the color codes are added around the whole chunk
+            f.write(fmt.format(data.decode('latin1')))
+        f.flush()
+
+    def dump_flush_all(self):
+        """Write out all the pending output."""
+        with self._dump_lock:
+            self._dump_flush_fd(1)
+            self._dump_flush_fd(2)
+
+    def _dump_idle_check(self):
+        with self._dump_lock:
+            delay = (self._dump_last_write + self.dump_flush_idle -
+                     time.monotonic())
+            if delay > 0:
+                self._dump_start_timer(delay)
+                return
+            self._dump_timer = None
+            self._dump_flush_fd(1)
+            self._dump_flush_fd(2)
+
+    def _dump_start_timer(self, delay):
+        timer = threading.Timer(delay, self._dump_idle_check)
+        timer.daemon = True
+        self._dump_timer = timer
+        timer.start()
 
     @signature("write(ipi)i")
     def s_write(self, fd, p_buf, count):
         if fd == 1:
-            f = self.dump_stdout or sys.stdout
-            fmt = self.dump_stdout_fmt
             raw = self.raw_stdout
         elif fd == 2:
-            f = self.dump_stderr or sys.stderr
-            fmt = self.dump_stderr_fmt
             raw = self.raw_stderr
         else:
-            return super(MixGrabOutput, self).s_write(fd, p_buf, count)
+            return super(MixDumpOutput, self).s_write(fd, p_buf, count)
 
         data = self.sandio.read_buffer(p_buf, count)
         if not raw:
-            data = fmt.format(self.dump_sanitize(data))
-        f.write(data)
-        f.flush()
+            data = self.dump_sanitize(data)
+        policy = self.dump_flush
+        with self._dump_lock:
+            self._dump_flush_fd(3 - fd)     # keep the order of stdout/stderr
+            pending = self._dump_pending[fd]
+            pending += data
+            if (policy == 'always' or
+                    len(pending) >= self.dump_flush_size or
+                    (policy == 'newline' and b'\n' in data)):
+                self._dump_flush_fd(fd)
+            elif policy == 'idle':
+                self._dump_last_write = time.monotonic()
+                if self._dump_timer is None:
+                    self._dump_start_timer(self.dump_flush_idle)
         return count
+
+    @signature("read(ipi)i")
+    def s_read(self, fd, p_buf, count):
+        # flush before the subprocess waits for input, e.g. after a prompt
+        if fd == 0:
+            self.dump_flush_all()
+        return super(MixDumpOutput, self).s_read(fd, p_buf, count)
+
+    def close(self):
+        timer = self._dump_timer
+        if timer is not None:
+            timer.cancel()
+            self._dump_timer = None
+        self.dump_flush_all()
+        super(MixDumpOutput, self).close()
@@ -1,27 +1,285 @@
+"""Collects the output written by the subprocess to stdout and stderr.
+
+By default, everything written to stdout and stderr is kept in memory,
+in the order it was written, and returned by get_all_output().  This is
+limited to 'write_buffer_limit' bytes (1MB by default, a keyword argument
+of the constructor).  The output can instead be sent to "sinks", given as
+the keyword arguments 'stdout_sink' and 'stderr_sink':
+
+    MemorySink(limit)          keeps everything in memory (the default)
+    RingBufferSink(max_bytes)  keeps only the last 'max_bytes' bytes
+    SpoolSink(max_memory)      keeps the output in memory until it is
+                               larger than 'max_memory', then in a
+                               temporary file
+    CallbackSink(callback)     calls callback(data) for every chunk
+    QueueSink()                can be iterated over, typically from another
+                               thread, to get the chunks as they come
+
+The same sink can be given for both streams; with separate_output=True,
+stdout and stderr each get their own MemorySink.  This is not the
+default, so that get_all_output() keeps returning stdout and stderr
+interleaved in the order they were written; use get_stdout() and
+get_stderr() with separate_output=True to get them apart.  Writes are read from
+the subprocess in chunks of 'output_chunk_size' bytes, so that huge
+writes never need to be in memory at once.
+"""
+
+import queue, shutil, tempfile
 from io import BytesIO
+from .sandboxio import SandboxError, Ptr
 from .virtualizedproc import signature
 
 
+class OutputLimitExceeded(SandboxError):
+    """The subprocess wrote more output than allowed."""
+
+
+class OutputSink(object):
+    """Base class of the sinks.  'size' is the total number of bytes
+    written so far."""
+    size = 0
+
+    def check_room(self, count):
+        """Called before 'count' bytes are written.  Raises
+        OutputLimitExceeded if they must not be."""
+
+    def write(self, data):
+        """Called with each chunk of output, as bytes, and must add its
+        length to 'size'.  Every sink class must define it."""
+        raise TypeError("%s does not define write()" % (
+            type(self).__name__,))
+
+    def getvalue(self):
+        """Return the output kept by the sink, as bytes."""
+        return b''
+
+    def copy_to(self, f):
+        """Write the output kept by the sink to the file 'f'."""
+        f.write(self.getvalue())
+
+    def reset(self):
+        """Discard the output collected so far."""
+        self.size = 0
+
+    def finish(self):
+        """Called when the subprocess has exited."""
+
+
+class MemorySink(OutputSink):
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self._buffer = BytesIO()
+
+    def check_room(self, count):
+        if self.limit is not None and self.size + count > self.limit:
+            raise OutputLimitExceeded("subprocess is writing too much data "
+                                      "on stdout/stderr")
+
+    def write(self, data):
+        self._buffer.write(data)
+        self.size += len(data)
+
+    def getvalue(self):
+        return self._buffer.getvalue()
+
+    def reset(self):
+        self._buffer = BytesIO()
+        self.size = 0
+
+
+class RingBufferSink(OutputSink):
+    """Keeps the last 'max_bytes' bytes of output.  'dropped' is the
+    number of bytes that were discarded before them."""
+
+    def __init__(self, max_bytes):
+        assert max_bytes > 0
+        self.max_bytes = max_bytes
+        self.reset()
+
+    def write(self, data):
+        data = memoryview(data)
+        n = len(data)
+        self.size += n
+        max_bytes = self.max_bytes
+        if n >= max_bytes:
+            self._ring[:] = data[n - max_bytes:]
+            self._pos = 0
+            self._filled = max_bytes
+            return
+        pos = self._pos
+        first = min(n, max_bytes - pos)
+        self._ring[pos:pos + first] = data[:first]
+        if first < n:
+            self._ring[:n - first] = data[first:]
+        self._pos = (pos + n) % max_bytes
+        self._filled = min(self._filled + n, max_bytes)
+
+    def getvalue(self):
+        if self._filled < self.max_bytes:
+            return bytes(self._ring[:self._filled])
+        return bytes(self._ring[self._pos:] + self._ring[:self._pos])
+
+    @property
+    def dropped(self):
+        return self.size - self._filled
+
+    def reset(self):
+        self._ring = bytearray(self.max_bytes)
+        self._pos = 0
+        self._filled = 0
+        self.size = 0
+
+
+class SpoolSink(OutputSink):
+    """Keeps the output in memory up to 'max_memory' bytes, and in an
+    anonymous temporary file after that.  An optional 'limit' can still be
+    given.  Use copy_to() rather than getvalue() for large outputs."""
+
+    def __init__(self, max_memory=1024*1024, limit=None, dir=None):
+        self.max_memory = max_memory
+        self.limit = limit
+        self.dir = dir
+        self._file = None
+        self.reset()
+
+    def check_room(self, count):
+        if self.limit is not None and self.size + count > self.limit:
+            raise OutputLimitExceeded("subprocess is writing too much data "
+                                      "on stdout/stderr")
+
+    def write(self, data):
+        self._file.write(data)
+        self.size += len(data)
+
+    def spilled(self):
+        """Return True if the output was moved to a temporary file."""
+        return bool(self._file._rolled)
+
+    def getvalue(self):
+        self._file.seek(0)
+        try:
+            return self._file.read()
+        finally:
+            self._file.seek(0, 2)
+
+    def copy_to(self, f):
+        self._file.seek(0)
+        try:
+            shutil.copyfileobj(self._file, f)
+        finally:
+            self._file.seek(0, 2)
+
+    def reset(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = tempfile.SpooledTemporaryFile(max_size=self.max_memory,
+                                                   dir=self.dir)
+        self.size = 0
+
+    def close(self):
+        """Delete the temporary file."""
+        self._file.close()
+
+
+class CallbackSink(OutputSink):
+    """Calls 'callback(data)' for every chunk of output.  Nothing is
+    kept."""
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def write(self, data):
+        self.size += len(data)
+        self.callback(data)
+
+
+class QueueSink(OutputSink):
+    """Iterating over a QueueSink yields the chunks of output as they are
+    written, until the subprocess exits.  With 'maxsize', the controller
+    blocks when that many chunks are waiting to be consumed."""
+
+    def __init__(self, maxsize=0):
+        self._queue = queue.Queue(maxsize)
+
+    def write(self, data):
+        self.size += len(data)
+        self._queue.put(data)
+
+    def finish(self):
+        self._queue.put(None)
+
+    def __iter__(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            yield data
+
+
 class MixGrabOutput(object):
+    output_chunk_size = 256 * 1024
 
     def __init__(self, *args, **kwds):
-        self._write_buffer = BytesIO()
-        self._write_buffer_limit = kwds.pop('write_buffer_limit', 1000000)
+        limit = kwds.pop('write_buffer_limit', 1000000)
+        stdout_sink = kwds.pop('stdout_sink', None)
+        stderr_sink = kwds.pop('stderr_sink', None)
+        if kwds.pop('separate_output', False):
+            stdout_sink = stdout_sink or MemorySink(limit)
+            stderr_sink = stderr_sink or MemorySink(limit)
+        elif stdout_sink is None or stderr_sink is None:
+            default_sink = stdout_sink or stderr_sink or MemorySink(limit)
+            stdout_sink = stdout_sink or default_sink
+            stderr_sink = stderr_sink or default_sink
+        self.stdout_sink = stdout_sink
+        self.stderr_sink = stderr_sink
         super(MixGrabOutput, self).__init__(*args, **kwds)
 
     @signature("write(ipi)i")
     def s_write(self, fd, p_buf, count):
-        """Writes to stdout or stderr are copied to an internal buffer."""
+        """Writes to stdout or stderr are sent to the sinks."""
 
-        if fd != 1 and fd != 2:
+        if fd == 1:
+            sink = self.stdout_sink
+        elif fd == 2:
+            sink = self.stderr_sink
+        else:
             return super(MixGrabOutput, self).s_write(fd, p_buf, count)
 
-        data = self.sandio.read_buffer(p_buf, count)
-        if self._write_buffer.tell() + len(data) > self._write_buffer_limit:
-            raise Exception("subprocess is writing too much data on "
-                            "stdout/stderr")
-        self._write_buffer.write(data)
+        sink.check_room(count)
+        chunk_size = self.output_chunk_size
+        if count <= chunk_size:
+            sink.write(self.sandio.read_buffer(p_buf, count))
+            return count
+        addr = p_buf.addr
+        for offset in range(0, count, chunk_size):
+            n = min(chunk_size, count - offset)
+            sink.write(self.sandio.read_buffer(Ptr(addr + offset), n))
         return count
 
+    def _output_sinks(self):
+        if self.stdout_sink is self.stderr_sink:
+            return [self.stdout_sink]
+        return [self.stdout_sink, self.stderr_sink]
+
     def get_all_output(self):
-        return self._write_buffer.getvalue()
+        """Return the output kept by the sinks: stdout and stderr
+        interleaved if they go to the same sink, or else the output on
+        stdout followed by the output on stderr."""
+        return b''.join([sink.getvalue() for sink in self._output_sinks()])
+
+    def get_stdout(self):
+        return self.stdout_sink.getvalue()
+
+    def get_stderr(self):
+        return self.stderr_sink.getvalue()
+
+    def reset_output(self):
+        """Discard all the output collected so far."""
+        for sink in self._output_sinks():
+            sink.reset()
+
+    def close(self):
+        for sink in self._output_sinks():
+            sink.finish()
+        super(MixGrabOutput, self).close()
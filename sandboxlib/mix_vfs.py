@@ -1,26 +1,47 @@
 import sys
-import os, errno, stat
-from io import BytesIO
-from .virtualizedproc import signature, sigerror
+import os, errno, stat, struct, time, threading, zlib, zipfile
+import mmap, heapq, fcntl
+from collections import OrderedDict
+from .virtualizedproc import signature
 from .sandboxio import NULL
 from ._commonstruct_cffi import ffi, lib
 
 MAX_PATH = 256
 UID = 1000
 GID = 1000
-INO_COUNTER = 0
+ROOT_INO = 2
+
+
+def host_ino(st_dev, st_ino):
+    """The virtual inode number of a real file: stable for as long as the
+    controller runs, whatever the number of lookups of the file."""
+    return (hash((st_dev, st_ino)) & 0x7fffffffffffffff) or 1
+
+def child_ino(parent_ino, name):
+    """The virtual inode number of the virtual node 'name' in the directory
+    whose inode number is 'parent_ino'."""
+    name_hash = zlib.crc32(name.encode('utf-8'))
+    return (hash((parent_ino, name_hash)) & 0x7fffffffffffffff) or 1
 
 
 class FSObject(object):
     read_only = True
+    # False for nodes that can change, whose lookup must not be cached
+    cacheable = True
+    # the inode number is set when the node is first found by looking up
+    # its name in a Dir, or stays ROOT_INO for the root
+    _st_ino = None
+    _stat_bytes = None
 
-    def stat(self):
-        try:
-            st_ino = self._st_ino
-        except AttributeError:
-            global INO_COUNTER
-            INO_COUNTER += 1
-            st_ino = self._st_ino = INO_COUNTER
+    def getino(self):
+        if self._st_ino is None:
+            self._st_ino = ROOT_INO
+        return self._st_ino
+
+    def getmtime(self):
+        return 0
+
+    def _stat_fields(self):
         st_mode = self.kind
         st_mode |= stat.S_IWUSR | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
         if self.is_dir():
@@ -31,22 +52,38 @@ class FSObject(object):
         else:
             st_uid = UID     # read-write files are owned by this virtual user
             st_gid = GID
-        return ffi.new("struct stat *", dict(
-            st_ino = st_ino,
+        mtime = self.getmtime()
+        return dict(
+            st_ino = self.getino(),
             st_dev = 1,
             st_nlink = 1,
             st_size = self.getsize(),
             st_mode = st_mode,
             st_uid = st_uid,
-            st_gid = st_gid))
+            st_gid = st_gid,
+            st_atime = mtime,
+            st_mtime = mtime,
+            st_ctime = mtime)
+
+    def stat(self):
+        return ffi.new("struct stat *", self._stat_fields())
+
+    def stat_bytes(self):
+        """Return the 'struct stat' of this node, packed as bytes.  This is
+        computed only once per node."""
+        bytes_data = self._stat_bytes
+        if bytes_data is None:
+            bytes_data = self._stat_bytes = ffi.buffer(self.stat())[:]
+        return bytes_data
 
     def access(self, mode):
-        s = self.stat()
-        e_mode = s.st_mode & stat.S_IRWXO
-        if UID == s.st_uid:
-            e_mode |= (s.st_mode & stat.S_IRWXU) >> 6
-        if GID == s.st_gid:
-            e_mode |= (s.st_mode & stat.S_IRWXG) >> 3
+        s = self._stat_fields()
+        st_mode = s['st_mode']
+        e_mode = st_mode & stat.S_IRWXO
+        if UID == s['st_uid']:
+            e_mode |= (st_mode & stat.S_IRWXU) >> 6
+        if GID == s['st_gid']:
+            e_mode |= (st_mode & stat.S_IRWXG) >> 3
         return (e_mode & mode) == mode
 
     def keys(self):
@@ -55,9 +92,27 @@ class FSObject(object):
     def join(self, name):
         raise OSError(errno.ENOTDIR, self)
 
+    def scandir(self):
+        """Return a sorted list [(name, d_type, inode number)] of the
+        entries of this directory."""
+        raise OSError(errno.ENOTDIR, self)
+
     def open(self):
         raise OSError(errno.EACCES, self)
 
+    # the operations that change a directory; only some directories are
+    # writable (see tmpfs.TmpDir)
+    def create(self, name, mode):
+        raise OSError(errno.ENOTDIR, self)
+    mkdir = create
+
+    def unlink(self, name):
+        raise OSError(errno.ENOTDIR, self)
+    rmdir = unlink
+
+    def rename(self, name, new_dir, new_name):
+        raise OSError(errno.ENOTDIR, self)
+
     def getsize(self):
         return 0
 
@@ -73,11 +128,56 @@ class Dir(FSObject):
         return sorted(self.entries.keys())
     def join(self, name):
         try:
-            return self.entries[name]
+            node = self.entries[name]
         except KeyError:
             raise OSError(errno.ENOENT, name)
+        if node._st_ino is None:
+            node._st_ino = child_ino(self.getino(), name)
+        return node
+    def scandir(self):
+        result = []
+        for name in self.keys():
+            try:
+                node = self.join(name)
+                st_ino = node.getino()
+            except OSError:
+                continue
+            d_type = lib.DT_DIR if node.is_dir() else lib.DT_REG
+            result.append((name, d_type, st_ino))
+        return result
+    def create(self, name, mode):
+        raise OSError(errno.EPERM, name)
+    mkdir = create
+    def unlink(self, name):
+        raise OSError(errno.EPERM, name)
+    rmdir = unlink
+    def rename(self, name, new_dir, new_name):
+        raise OSError(errno.EPERM, name)
 
-class RealDir(Dir):
+
+class RealNode(object):
+    # Mixin for the nodes that correspond to a real file or directory.
+    # The result of os.stat() is taken when the node is created, and is
+    # used for the inode number, the size and the mtime; a later change
+    # of the real file is seen by making a new node.
+    _host_st = None
+
+    def host_stat(self):
+        if self._host_st is None:
+            self._host_st = os.stat(self.path)
+        return self._host_st
+
+    def getino(self):
+        if self._st_ino is None:
+            st = self.host_stat()
+            self._st_ino = host_ino(st.st_dev, st.st_ino)
+        return self._st_ino
+
+    def getmtime(self):
+        return int(self.host_stat().st_mtime)
+
+
+class RealDir(RealNode, Dir):
     # If show_dotfiles=False, we pretend that all files whose name starts
     # with '.' simply don't exist.  If follow_links=True, then symlinks are
     # transparently followed (they look like a regular file or directory to
@@ -86,26 +186,62 @@ class RealDir(Dir):
     # file endings that we filter out (note that we also filter out files
     # with the same ending but a different case, to be safe).
     def __init__(self, path, show_dotfiles=False, follow_links=False,
-                 exclude=[]):
+                 exclude=[], host_st=None):
         self.path = path
         self.show_dotfiles = show_dotfiles
         self.follow_links  = follow_links
         self.exclude       = [excl.lower() for excl in exclude]
+        self._host_st = host_st
+        self._exclude_tuple = tuple(self.exclude)
     def __repr__(self):
         return '<RealDir %s>' % (self.path,)
+    def _is_hidden(self, name):
+        return ((name.startswith('.') and not self.show_dotfiles) or
+                (self._exclude_tuple and
+                 name.lower().endswith(self._exclude_tuple)))
     def keys(self):
-        names = os.listdir(self.path)
-        if not self.show_dotfiles:
-            names = [name for name in names if not name.startswith('.')]
-        for excl in self.exclude:
-            names = [name for name in names if not name.lower().endswith(excl)]
-        return sorted(names)
+        is_hidden = self._is_hidden
+        return sorted([name for name in os.listdir(self.path)
+                       if not is_hidden(name)])
+    def scandir(self):
+        # the type of each entry comes from os.scandir(), without a stat()
+        # of the entry, except for symlinks if follow_links is True
+        is_hidden = self._is_hidden
+        follow_links = self.follow_links
+        st_dev = self.host_stat().st_dev
+        result = []
+        for entry in os.scandir(self.path):
+            name = entry.name
+            if is_hidden(name):
+                continue
+            try:
+                if entry.is_symlink():
+                    if not follow_links:
+                        continue
+                    st = entry.stat()
+                    if stat.S_ISDIR(st.st_mode):
+                        d_type = lib.DT_DIR
+                    elif stat.S_ISREG(st.st_mode):
+                        d_type = lib.DT_REG
+                    else:
+                        continue
+                    st_ino = host_ino(st.st_dev, st.st_ino)
+                else:
+                    if entry.is_dir():
+                        d_type = lib.DT_DIR
+                    elif entry.is_file():
+                        d_type = lib.DT_REG
+                    else:
+                        continue
+                    st_ino = host_ino(st_dev, entry.inode())
+            except OSError:
+                continue
+            result.append((name, d_type, st_ino))
+        result.sort()
+        return result
     def join(self, name):
-        if name.startswith('.') and not self.show_dotfiles:
+        if self._is_hidden(name):
             raise OSError(errno.ENOENT, name)
-        for excl in self.exclude:
-            if name.lower().endswith(excl):
-                raise OSError(errno.ENOENT, name)
         path = os.path.join(self.path, name)
         if self.follow_links:
             st = os.stat(path)
@@ -114,9 +250,10 @@ class RealDir(Dir):
         if stat.S_ISDIR(st.st_mode):
             return RealDir(path, show_dotfiles = self.show_dotfiles,
                                  follow_links  = self.follow_links,
-                                 exclude       = self.exclude)
+                                 exclude       = self.exclude,
+                                 host_st       = st)
         elif stat.S_ISREG(st.st_mode):
-            return RealFile(path)
+            return RealFile(path, host_st=st)
         else:
             # don't allow access to symlinks and other special files
             raise OSError(errno.EACCES, path)
@@ -129,29 +266,561 @@ class File(FSObject):
     def getsize(self):
         return len(self.data)
     def open(self):
-        return BytesIO(self.data)
+        return MemoryFile(self.data)
 
-class RealFile(File):
-    def __init__(self, path, mode=0):
+class FileContentCache(object):
+    """A cache of the content of real files, shared by all the sandboxed
+    processes of the controller.  The entries are keyed by (path,
+    st_mtime_ns, st_size), so that checking if an entry is still valid
+    only costs an os.stat().  At most 'max_bytes' are kept, evicting the
+    least recently used files; files larger than 'max_file_size' are not
+    cached.
+    """
+
+    def __init__(self, max_bytes=64*1024*1024, max_file_size=None):
+        if max_file_size is None:
+            max_file_size = max_bytes // 16
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()    # {key: bytes}
+        self._keys = {}                  # {path: current key}
+        self._lock = threading.Lock()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'entries': len(self._entries),
+                'resident_bytes': self.resident_bytes,
+                'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': float(self.hits) / total if total else 0.0}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+            self.resident_bytes = 0
+
+    def _remove(self, key):
+        data = self._entries.pop(key)
+        self.resident_bytes -= len(data)
+        if self._keys.get(key[0]) == key:
+            del self._keys[key[0]]
+
+    def get(self, path):
+        """Return the content of the real file 'path' as a read-only bytes,
+        or None if it is too large to be cached."""
+        st = os.stat(path)
+        if st.st_size > self.max_file_size:
+            return None
+        key = (path, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) != st.st_size:
+            return data     # changed while we read it, don't cache
+        with self._lock:
+            old_key = self._keys.get(path)
+            if old_key is not None and old_key in self._entries:
+                self._remove(old_key)
+            if key not in self._entries:
+                while (self._entries and
+                       self.resident_bytes + len(data) > self.max_bytes):
+                    self._remove(next(iter(self._entries)))
+                self._entries[key] = data
+                self._keys[path] = key
+                self.resident_bytes += len(data)
+        return data
+
+file_content_cache = FileContentCache()
+
+
+class RealFile(RealNode, File):
+    # Small real files are served from 'content_cache', shared by all the
+    # subprocesses; set it to None to disable it.  Other files are read
+    # normally.  With 'use_mmap', they are mmap()ed instead, which avoids
+    # any copy; only use it for files that are never modified, because if
+    # a file is truncated while the subprocess has it open, accessing the
+    # missing pages kills the controller with SIGBUS.
+    content_cache = file_content_cache
+    use_mmap = False
+
+    def __init__(self, path, mode=0, host_st=None):
         self.path = path
         self.kind |= mode
+        self._host_st = host_st
     def __repr__(self):
         return '<RealFile %s>' % (self.path,)
     def getsize(self):
-        return os.stat(self.path).st_size
+        return self.host_stat().st_size
     def open(self):
         try:
-            return open(self.path, "rb")
-        except IOError as e:
+            if self.content_cache is not None:
+                data = self.content_cache.get(self.path)
+                if data is not None:
+                    return MemoryFile(data)
+            if not self.use_mmap:
+                return open(self.path, "rb")
+            fd = os.open(self.path, os.O_RDONLY)
+        except (IOError, OSError) as e:
             raise OSError(e.errno, "open failed")
+        try:
+            if os.fstat(fd).st_size == 0:
+                return MemoryFile(b'')    # can't mmap() an empty file
+            mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # not a mmap()able file after all
+            return os.fdopen(os.dup(fd), "rb")
+        finally:
+            os.close(fd)
+        return MemoryFile(mm, owner=mm)
+
+
+class MemoryFile(object):
+    """A read-only, seekable file whose content is the given buffer (bytes,
+    mmap, memoryview...).  read() returns memoryview slices of the buffer,
+    without copying.  If 'owner' is given, its close() method is called
+    when the file is closed."""
+    def __init__(self, buffer, owner=None):
+        self.view = memoryview(buffer)
+        self.owner = owner
+        self.pos = 0
+    def read(self, count=-1):
+        pos = self.pos
+        if count < 0:
+            end = len(self.view)
+        else:
+            end = min(pos + count, len(self.view))
+        if pos >= end:
+            return b''
+        self.pos = end
+        return self.view[pos:end]
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self.view)
+        if offset < 0:
+            raise OSError(errno.EINVAL, "negative seek position")
+        self.pos = offset
+        return offset
+    def tell(self):
+        return self.pos
+    def close(self):
+        self.view.release()
+        if self.owner is not None:
+            try:
+                self.owner.close()
+            except BufferError:
+                pass    # slices are still alive; it will be freed by the GC
+
+
+class ZipArchive(object):
+    # The central directory of a zip file, read once and shared by all the
+    # ZipDir and ZipMember nodes that come from it.
+    _local_header = struct.Struct('<4s5H3L2H')
+
+    def __init__(self, path):
+        self.path = path
+        self.zipfile = zipfile.ZipFile(path)
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.dirs = {'': {}}     # {dir path: {name: ZipInfo or None}}
+        self.nodes = {}          # {member path: node}
+        for info in self.zipfile.infolist():
+            parts = info.filename.rstrip('/').split('/')
+            for i in range(len(parts)):
+                dirpath = '/'.join(parts[:i])
+                if dirpath not in self.dirs:
+                    self.dirs[dirpath] = {}
+                    self.dirs['/'.join(parts[:i-1])][parts[i-1]] = None
+            if info.filename.endswith('/'):
+                self.dirs.setdefault('/'.join(parts), {})
+                self.dirs['/'.join(parts[:-1])][parts[-1]] = None
+            else:
+                self.dirs['/'.join(parts[:-1])][parts[-1]] = info
+
+    def node(self, member_path):
+        try:
+            return self.nodes[member_path]
+        except KeyError:
+            pass
+        if member_path in self.dirs:
+            node = ZipDir(self, member_path)
+        else:
+            dirpath, _, name = member_path.rpartition('/')
+            node = ZipMember(self, self.dirs[dirpath][name])
+        self.nodes[member_path] = node
+        return node
+
+    def data_offset(self, info):
+        # the offset of the data of a member is after its local header
+        fields = self._local_header.unpack_from(self.mm, info.header_offset)
+        if fields[0] != b'PK\x03\x04':
+            raise OSError(errno.EIO, "bad zip file: %r" % (self.path,))
+        return (info.header_offset + self._local_header.size +
+                fields[-2] + fields[-1])
+
+
+class ZipDir(Dir):
+    """A read-only directory serving the content of a zip archive, e.g. a
+    wheel, without extracting it.  The listing comes from the central
+    directory of the archive, read once; the members are opened lazily.
+    Members that are stored uncompressed are served directly from the
+    mmap()ed archive.  Use ZipDir(path) for the root of the archive.
+    """
+    def __init__(self, archive, member_path=''):
+        if not isinstance(archive, ZipArchive):
+            archive = ZipArchive(archive)
+        self.archive = archive
+        self.member_path = member_path
+        self.entries = archive.dirs[member_path]
+    def __repr__(self):
+        return '<ZipDir %s:%s>' % (self.archive.path, self.member_path)
+    def join(self, name):
+        if name not in self.entries:
+            raise OSError(errno.ENOENT, name)
+        if self.member_path:
+            node = self.archive.node(self.member_path + '/' + name)
+        else:
+            node = self.archive.node(name)
+        if node._st_ino is None:
+            node._st_ino = child_ino(self.getino(), name)
+        return node
+
+class ZipMember(File):
+    def __init__(self, archive, info):
+        self.archive = archive
+        self.info = info
+        self._data_offset = None
+        if info.external_attr >> 16:
+            self.kind |= (info.external_attr >> 16) & 0o111
+    def __repr__(self):
+        return '<ZipMember %s:%s>' % (self.archive.path, self.info.filename)
+    def getsize(self):
+        return self.info.file_size
+    def getmtime(self):
+        return int(time.mktime(self.info.date_time + (0, 0, -1)))
+    def open(self):
+        info = self.info
+        if info.compress_type == zipfile.ZIP_STORED:
+            if self._data_offset is None:
+                self._data_offset = self.archive.data_offset(info)
+            start = self._data_offset
+            return MemoryFile(memoryview(self.archive.mm)[
+                start:start + info.file_size])
+        return self.archive.zipfile.open(info)
+
+
+def _make_dirent_packer():
+    # a struct.Struct for the part of 'struct dirent' before 'd_name'
+    codes = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+    fields = sorted([(field.offset, name, ffi.sizeof(field.type))
+                     for name, field in ffi.typeof("struct dirent").fields])
+    fmt = '='
+    names = []
+    pos = 0
+    for offset, name, size in fields:
+        fmt += 'x' * (offset - pos)
+        if name == 'd_name':
+            break
+        fmt += codes[size]
+        names.append(name)
+        pos = offset + size
+    header = struct.Struct(fmt)
+    d_reclen = ffi.sizeof("struct dirent")
+    max_name = ffi.sizeof(ffi.typeof("struct dirent").fields[-1][1].type)
+    def pack_dirent(name, d_type, st_ino):
+        values = dict(d_ino=st_ino, d_off=0, d_reclen=d_reclen,
+                      d_type=d_type)
+        return header.pack(*[values[n] for n in names]) + name + b'\x00'
+    return pack_dirent, max_name
+
+_pack_dirent, _dirent_max_name = _make_dirent_packer()
 
 
 class OpenDir(object):
+    """A snapshot of the entries of a directory, taken by opendir().  The
+    'struct dirent' of each entry is packed in advance, up to the end of
+    'd_name'."""
     def __init__(self, node):
         self.node = node
-        self.iter_names = iter(node.keys())
+        records = []
+        for name, d_type, st_ino in node.scandir():
+            name = name.encode('utf-8')
+            if len(name) >= _dirent_max_name:
+                continue      # can't be represented in a 'struct dirent'
+            records.append(_pack_dirent(name, d_type, st_ino))
+        self.records = records
+        self.index = 0
     def readdir(self):
-        return next(self.iter_names)
+        """Return the next packed 'struct dirent', or None at the end."""
+        index = self.index
+        if index >= len(self.records):
+            return None
+        self.index = index + 1
+        return self.records[index]
+
+
+def vfs_walk(components, path):
+    """Resolve 'path', starting from the node 'components[0]'.  The nodes
+    along the way are appended to the list 'components'; the last one is
+    the result.  In case of OSError, the last one is the directory in which
+    the lookup failed."""
+    for name in path.split('/'):
+        if name == '..':
+            if len(components) > 1:
+                del components[-1]
+        elif name and name != '.':
+            components.append(components[-1].join(name))
+
+
+class PathCache(object):
+    """A cache for the lookups done by MixVFS.vfs_getnode(), shared by all
+    the MixVFS instances with the same vfs_root.  It maps paths to the
+    resulting nodes, and also remembers the lookups that failed with one of
+    NEGATIVE_ERRNOS.  At most 'maxsize' paths are kept, evicting the least
+    recently used ones.
+
+    If the result depends on a real directory or file, it is revalidated
+    by comparing its mtime with the one it had when the entry was created;
+    this is done at most once every 'revalidate' seconds for each entry,
+    or never if 'revalidate' is None.  Lookups that go through a node
+    which is not 'cacheable' (like a tmpfs.TmpDir) are never cached.
+    """
+    NEGATIVE_ERRNOS = (errno.ENOENT, errno.EACCES, errno.ENOTDIR)
+
+    def __init__(self, root, maxsize=4096, revalidate=1.0):
+        self.root = root
+        self.maxsize = maxsize
+        self.revalidate = revalidate
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits,
+                'negative_hits': self.negative_hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @staticmethod
+    def _host_mtime(host_path):
+        if host_path is None:
+            return None
+        try:
+            return os.stat(host_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _lookup(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                return None
+            self._entries.move_to_end(path)
+        # entry = [node or errno, host path or None, mtime, last check]
+        if entry[1] is not None and self.revalidate is not None:
+            now = time.time()
+            if now - entry[3] >= self.revalidate:
+                if self._host_mtime(entry[1]) != entry[2]:
+                    return None
+                entry[3] = now
+        return entry
+
+    def _store(self, path, result, host_path):
+        entry = [result, host_path, self._host_mtime(host_path), time.time()]
+        with self._lock:
+            self._entries[path] = entry
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def getnode(self, path):
+        entry = self._lookup(path)
+        if entry is not None:
+            result = entry[0]
+            if isinstance(result, int):
+                self.negative_hits += 1
+                raise OSError(result, path)
+            self.hits += 1
+            return result
+        self.misses += 1
+        components = [self.root]
+        cacheable = True
+        try:
+            for name in path.split('/'):
+                if name == '..':
+                    if len(components) > 1:
+                        del components[-1]
+                elif name and name != '.':
+                    if not components[-1].cacheable:
+                        cacheable = False
+                    components.append(components[-1].join(name))
+        except OSError as e:
+            if cacheable and e.errno in self.NEGATIVE_ERRNOS:
+                self._store(path, e.errno, getattr(components[-1], 'path',
+                                                   None))
+            raise
+        node = components[-1]
+        if cacheable and node.cacheable:
+            self._store(path, node, getattr(node, 'path', None))
+        return node
+
+
+_path_caches_lock = threading.Lock()
+
+def get_path_cache(root, maxsize=4096, revalidate=1.0):
+    """Return the PathCache for the tree 'root', creating it if needed.
+    It is stored on the root itself, so that it goes away with it."""
+    with _path_caches_lock:
+        cache = root.__dict__.get('_path_cache')
+        if cache is None:
+            cache = root._path_cache = PathCache(root, maxsize, revalidate)
+        return cache
+
+
+class OpenFileDescription(object):
+    """An open file, shared by all the file descriptors that are dup()s of
+    each other.  'flags' are the flags given to open(), of which O_APPEND
+    and O_NONBLOCK can be changed later."""
+    SETTABLE_FLAGS = os.O_APPEND | os.O_NONBLOCK
+
+    def __init__(self, f, node, flags=os.O_RDONLY):
+        self.f = f
+        self.node = node
+        self.flags = flags & ~(os.O_CREAT | os.O_EXCL | os.O_TRUNC |
+                               os.O_CLOEXEC)
+        self.refcount = 0
+
+    def get_status_flags(self):
+        return self.flags
+
+    def set_status_flags(self, flags):
+        self.flags = ((self.flags & ~self.SETTABLE_FLAGS) |
+                      (flags & self.SETTABLE_FLAGS))
+        if hasattr(self.f, 'append'):
+            self.f.append = bool(self.flags & os.O_APPEND)
+
+
+class FDTable(object):
+    """The virtual file descriptors of one subprocess, in 'fd_range'.  Like
+    a real kernel, new file descriptors are always the lowest free ones.
+    Freed descriptors go into a heap, and all the descriptors from
+    'self._next' upwards are free except the ones explicitly taken by
+    dup2(), so that allocating is O(1) amortized (O(log n) if there are
+    freed descriptors).
+    """
+
+    def __init__(self, fd_range):
+        self.start = fd_range[0]
+        self.stop = fd_range[-1] + 1
+        self._fds = {}        # {fd: [OpenFileDescription, cloexec]}
+        self._freed = []      # heap of freed fds below self._next
+        self._next = self.start
+
+    def __contains__(self, fd):
+        return fd in self._fds
+
+    def __len__(self):
+        return len(self._fds)
+
+    def __getitem__(self, fd):
+        """Return the OpenFileDescription, or raise KeyError."""
+        return self._fds[fd][0]
+
+    def get(self, fd):
+        try:
+            return self._fds[fd][0]
+        except KeyError:
+            raise OSError(errno.EBADF, "bad file descriptor")
+
+    def _take(self, fd, description, cloexec):
+        description.refcount += 1
+        self._fds[fd] = [description, cloexec]
+        return fd
+
+    def _lowest_free(self):
+        freed = self._freed
+        while freed:
+            fd = heapq.heappop(freed)
+            if fd not in self._fds:      # else, taken again by dup2()
+                return fd
+        fd = self._next
+        while fd in self._fds:
+            fd += 1
+        if fd >= self.stop:
+            raise OSError(errno.EMFILE, "trying to open too many files")
+        self._next = fd + 1
+        return fd
+
+    def allocate(self, description, cloexec=False, minfd=0):
+        if minfd <= self.start:
+            fd = self._lowest_free()
+        else:
+            fd = minfd
+            while fd in self._fds:
+                fd += 1
+            if fd >= self.stop:
+                raise OSError(errno.EMFILE, "trying to open too many files")
+        return self._take(fd, description, cloexec)
+
+    def dup(self, fd, cloexec=False, minfd=0):
+        return self.allocate(self.get(fd), cloexec, minfd)
+
+    def dup2(self, fd, fd2, cloexec=False):
+        description = self.get(fd)
+        if not (self.start <= fd2 < self.stop):
+            raise OSError(errno.EBADF, "bad file descriptor")
+        if fd2 == fd:
+            return fd2
+        if fd2 in self._fds:
+            self.close(fd2)
+        return self._take(fd2, description, cloexec)
+
+    def get_cloexec(self, fd):
+        self.get(fd)
+        return self._fds[fd][1]
+
+    def set_cloexec(self, fd, cloexec):
+        self.get(fd)
+        self._fds[fd][1] = cloexec
+
+    def close(self, fd):
+        description = self.get(fd)
+        del self._fds[fd]
+        if fd < self._next:
+            heapq.heappush(self._freed, fd)
+        description.refcount -= 1
+        if description.refcount == 0:
+            description.f.close()
+
+    def close_all(self):
+        """Close all the file descriptors at once."""
+        descriptions = set([entry[0] for entry in self._fds.values()])
+        self._fds.clear()
+        del self._freed[:]
+        self._next = self.start
+        for description in descriptions:
+            description.refcount = 0
+            description.f.close()
+
+
+_pipe_stat_bytes = None
 
 
 def vfs_signature(sig, filearg=None):
@@ -183,7 +852,8 @@ def vfs_signature(sig, filearg=None):
 
 
 class MixVFS(object):
-    """A virtual, read-only file system.
+    """A virtual file system, read-only except in the writable directories
+    like tmpfs.TmpDir.
 
     Call with 'vfs_root = root directory' in the constructor or by
     adding an attribute 'vfs_root' on the subclass directory.
@@ -192,13 +862,19 @@ class MixVFS(object):
 
     # The allowed 'fd' to return.  You might increase the range if your
     # subprocess needs more fd's.
-    virtual_fd_range = range(3, 50)
+    virtual_fd_range = range(3, 4096)
 
     # This is the number of simultaneous open directories.  The value of 0
     # prevnts opendir() from working at all, which is fine in some situations
     # (notably with pypy2-sandbox, but not with pypy3-sandbox).
     virtual_fd_directories = 20
 
+    # Path lookups are cached per vfs_root, see PathCache.  Set
+    # 'vfs_cache_size' to 0 to disable the cache.  Note that the cache
+    # assumes that the Dir() instances of the tree are not modified.
+    vfs_cache_size = 4096
+    vfs_cache_revalidate = 1.0
+
 
     def __init__(self, *args, **kwds):
         try:
@@ -207,14 +883,16 @@ class MixVFS(object):
             assert hasattr(self, 'vfs_root'), (
                 "must pass a vfs_root argument to the constructor, or assign "
                 "a vfs_root class attribute directory in the subclass")
-        self.vfs_open_fds = {}
+        if self.vfs_cache_size > 0:
+            self.vfs_path_cache = get_path_cache(self.vfs_root,
+                                                 self.vfs_cache_size,
+                                                 self.vfs_cache_revalidate)
+        else:
+            self.vfs_path_cache = None
+        self.vfs_open_fds = FDTable(self.virtual_fd_range)
         self.vfs_open_dirs = {}
         super(MixVFS, self).__init__(*args, **kwds)
 
-    s_mkdir          = sigerror("mkdir(pi)i", errno.EPERM, -1)
-    s_fcntl          = sigerror("fcntl(iii)i", errno.ENOSYS, -1)
-    s_unlink         = sigerror("unlink(p)i", errno.EPERM, -1)
-
     @staticmethod
     def vfs_pypy_lib_directory(library_path, exclude=["*.pyc", "*.pyo"]):
         """Returns a Dir() instance that emulates the settings of a binary
@@ -235,7 +913,7 @@ class MixVFS(object):
         if not os.path.isdir(lib_pypy):
             raise IOError("directory not found: %r" % (lib_pypy,))
         return Dir({
-                 'pypy': File('', mode=0o111),
+                 'pypy': File(b'', mode=0o111),
                  'lib-python': RealDir(lib_python, exclude=exclude),
                  'lib_pypy': RealDir(lib_pypy, exclude=exclude),
                  })
@@ -247,46 +925,50 @@ class MixVFS(object):
 
     def vfs_getnode(self, p_pathname):
         path = self.vfs_fetch_path(p_pathname)
+        if self.vfs_path_cache is not None:
+            return self.vfs_path_cache.getnode(path)
         all_components = [self.vfs_root]
-        for name in path.split('/'):
-            if name == '..':
-                if len(all_components) > 1:
-                    del all_components[-1]
-            elif name and name != '.':
-                all_components.append(all_components[-1].join(name))
+        vfs_walk(all_components, path)
         return all_components[-1]
 
+    def vfs_getparent(self, p_pathname):
+        """Return (directory node, last component) for a path which is
+        going to be created, removed or renamed."""
+        path = self.vfs_fetch_path(p_pathname)
+        head, _, name = path.rstrip('/').rpartition('/')
+        if name in ('', '.', '..'):
+            raise OSError(errno.EINVAL, path)
+        return self.vfs_getnode(head), name
+
     def vfs_write_stat(self, p_statbuf, node):
-        ffi_stat = node.stat()
-        bytes_data = ffi.buffer(ffi_stat)[:]
-        self.sandio.write_buffer(p_statbuf, bytes_data)
+        self.sandio.write_buffer(p_statbuf, node.stat_bytes())
 
-    def vfs_allocate_fd(self, f, node):
+    def vfs_allocate_fd(self, f, node, flags=os.O_RDONLY):
         assert not node.is_dir()
-        for fd in self.virtual_fd_range:
-            if fd not in self.vfs_open_fds:
-                self.vfs_open_fds[fd] = (f, node)
-                return fd
-        else:
-            raise OSError(errno.EMFILE, "trying to open too many files")
+        description = OpenFileDescription(f, node, flags)
+        try:
+            return self.vfs_open_fds.allocate(description,
+                                              bool(flags & os.O_CLOEXEC))
+        except OSError:
+            f.close()
+            raise
 
     def vfs_get_file(self, fd):
         """Return the open file for file descriptor `fd`."""
-        try:
-            return self.vfs_open_fds[fd][0]
-        except KeyError:
-            raise OSError(errno.EBADF, "bad file descriptor")
+        return self.vfs_open_fds.get(fd).f
 
     def vfs_stat_for_pipe(self, p_statbuf):
-        ffi_stat = ffi.new("struct stat *", dict(
-            st_ino = 120,
-            st_dev = 12,
-            st_nlink = 1,
-            st_mode = stat.S_IFIFO | stat.S_IRUSR | stat.S_IWUSR,
-            st_uid = UID,
-            st_gid = GID))
-        bytes_data = ffi.buffer(ffi_stat)[:]
-        self.sandio.write_buffer(p_statbuf, bytes_data)
+        global _pipe_stat_bytes
+        if _pipe_stat_bytes is None:
+            ffi_stat = ffi.new("struct stat *", dict(
+                st_ino = 120,
+                st_dev = 12,
+                st_nlink = 1,
+                st_mode = stat.S_IFIFO | stat.S_IRUSR | stat.S_IWUSR,
+                st_uid = UID,
+                st_gid = GID))
+            _pipe_stat_bytes = ffi.buffer(ffi_stat)[:]
+        self.sandio.write_buffer(p_statbuf, _pipe_stat_bytes)
 
     @vfs_signature("stat64(pp)i", filearg=0)
     def s_stat64(self, p_pathname, p_statbuf):
@@ -301,7 +983,7 @@ class MixVFS(object):
     @vfs_signature("fstat64(ip)i")
     def s_fstat64(self, fd, p_statbuf):
         try:
-            f, node = self.vfs_open_fds[fd]
+            node = self.vfs_open_fds[fd].node
         except KeyError:
             if fd in (0, 1, 2):
                 self.vfs_stat_for_pipe(p_statbuf)
@@ -317,20 +999,99 @@ class MixVFS(object):
 
     @vfs_signature("open(pii)i", filearg=0)
     def s_open(self, p_pathname, flags, mode):
-        node = self.vfs_getnode(p_pathname)
+        path = self.vfs_fetch_path(p_pathname)
         write_mode = flags & (os.O_RDONLY|os.O_WRONLY|os.O_RDWR) != os.O_RDONLY
-        if not node.access(os.W_OK if write_mode else os.R_OK):
-            raise OSError(errno.EACCES, node)
-        assert not write_mode, "open: write mode not implemented"
-        # all other flags are ignored
-        f = node.open()
-        return self.vfs_allocate_fd(f, node)
+        try:
+            node = self.vfs_getnode(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT or not (flags & os.O_CREAT):
+                raise
+            parent, name = self.vfs_getparent(path)
+            node = parent.create(name, mode)
+        else:
+            if (flags & os.O_CREAT) and (flags & os.O_EXCL):
+                raise OSError(errno.EEXIST, path)
+            # file descriptors of directories are not supported, even in
+            # read-only mode: use opendir()
+            if node.is_dir():
+                raise OSError(errno.EISDIR, path)
+            if not node.access(os.W_OK if write_mode else os.R_OK):
+                raise OSError(errno.EACCES, node)
+            if write_mode and (flags & os.O_TRUNC):
+                node.truncate(0)
+        # O_WRONLY, O_RDWR and O_APPEND are only possible on writable
+        # nodes; all other flags are ignored
+        if node.read_only:
+            f = node.open()
+        else:
+            f = node.open(flags)
+        return self.vfs_allocate_fd(f, node, flags)
 
     @vfs_signature("close(i)i")
     def s_close(self, fd):
-        f = self.vfs_get_file(fd)
-        del self.vfs_open_fds[fd]
-        f.close()
+        self.vfs_open_fds.close(fd)
+
+    @vfs_signature("dup(i)i")
+    def s_dup(self, fd):
+        if fd not in self.vfs_open_fds and fd in (0, 1, 2):
+            return super(MixVFS, self).s_dup(fd)
+        return self.vfs_open_fds.dup(fd)
+
+    @vfs_signature("dup2(ii)i")
+    def s_dup2(self, fd, fd2):
+        if fd not in self.vfs_open_fds and fd in (0, 1, 2):
+            return super(MixVFS, self).s_dup2(fd, fd2)
+        return self.vfs_open_fds.dup2(fd, fd2)
+
+    @vfs_signature("rpy_dup_noninheritable(i)i")
+    def s_rpy_dup_noninheritable(self, fd):
+        if fd not in self.vfs_open_fds and fd in (0, 1, 2):
+            return super(MixVFS, self).s_rpy_dup_noninheritable(fd)
+        return self.vfs_open_fds.dup(fd, cloexec=True)
+
+    @vfs_signature("rpy_dup2_noninheritable(ii)i")
+    def s_rpy_dup2_noninheritable(self, fd, fd2):
+        if fd not in self.vfs_open_fds and fd in (0, 1, 2):
+            return super(MixVFS, self).s_rpy_dup2_noninheritable(fd, fd2)
+        self.vfs_open_fds.dup2(fd, fd2, cloexec=True)
+        return 0
+
+    @vfs_signature("fcntl(iii)i")
+    def s_fcntl(self, fd, cmd, arg):
+        fds = self.vfs_open_fds
+        if fd not in fds and fd in (0, 1, 2):
+            return super(MixVFS, self).s_fcntl(fd, cmd, arg)
+        if cmd == fcntl.F_DUPFD:
+            return fds.dup(fd, minfd=arg)
+        elif cmd == fcntl.F_DUPFD_CLOEXEC:
+            return fds.dup(fd, cloexec=True, minfd=arg)
+        elif cmd == fcntl.F_GETFD:
+            return fcntl.FD_CLOEXEC if fds.get_cloexec(fd) else 0
+        elif cmd == fcntl.F_SETFD:
+            fds.set_cloexec(fd, bool(arg & fcntl.FD_CLOEXEC))
+        elif cmd == fcntl.F_GETFL:
+            return fds.get(fd).get_status_flags()
+        elif cmd == fcntl.F_SETFL:
+            fds.get(fd).set_status_flags(arg)
+        else:
+            raise OSError(errno.EINVAL, "fcntl: unsupported command")
+
+    @vfs_signature("rpy_get_status_flags(i)i")
+    def s_rpy_get_status_flags(self, fd):
+        if fd not in self.vfs_open_fds and fd in (0, 1, 2):
+            return super(MixVFS, self).s_rpy_get_status_flags(fd)
+        return self.vfs_open_fds.get(fd).get_status_flags()
+
+    @vfs_signature("rpy_set_status_flags(ii)i")
+    def s_rpy_set_status_flags(self, fd, flags):
+        if fd not in self.vfs_open_fds and fd in (0, 1, 2):
+            return super(MixVFS, self).s_rpy_set_status_flags(fd, flags)
+        self.vfs_open_fds.get(fd).set_status_flags(flags)
+
+    def close(self):
+        self.vfs_open_fds.close_all()
+        self.vfs_open_dirs.clear()
+        super(MixVFS, self).close()
 
     @vfs_signature("read(ipi)i")
     def s_read(self, fd, p_buf, count):
@@ -345,6 +1106,48 @@ class MixVFS(object):
         self.sandio.write_buffer(p_buf, data)
         return len(data)
 
+    def vfs_get_writable_file(self, fd):
+        f = self.vfs_get_file(fd)
+        if not getattr(f, 'vfs_writable', False):
+            raise OSError(errno.EBADF, "file not open for writing")
+        return f
+
+    @vfs_signature("write(ipi)i")
+    def s_write(self, fd, p_buf, count):
+        if fd not in self.vfs_open_fds:
+            return super(MixVFS, self).s_write(fd, p_buf, count)
+        f = self.vfs_get_writable_file(fd)
+        if count < 0:
+            raise OSError(errno.EINVAL, "negative count")
+        # like in s_read(), don't copy more than 256KB at once: it is a
+        # short write if 'count' is larger
+        return f.write(self.sandio.read_buffer(p_buf, min(count, 256*1024)))
+
+    @vfs_signature("ftruncate(ii)i")
+    def s_ftruncate(self, fd, length):
+        self.vfs_get_writable_file(fd).truncate(length)
+
+    @vfs_signature("unlink(p)i", filearg=0)
+    def s_unlink(self, p_pathname):
+        parent, name = self.vfs_getparent(p_pathname)
+        parent.unlink(name)
+
+    @vfs_signature("mkdir(pi)i", filearg=0)
+    def s_mkdir(self, p_pathname, mode):
+        parent, name = self.vfs_getparent(p_pathname)
+        parent.mkdir(name, mode)
+
+    @vfs_signature("rmdir(p)i", filearg=0)
+    def s_rmdir(self, p_pathname):
+        parent, name = self.vfs_getparent(p_pathname)
+        parent.rmdir(name)
+
+    @vfs_signature("rename(pp)i", filearg=0)
+    def s_rename(self, p_old, p_new):
+        old_parent, old_name = self.vfs_getparent(p_old)
+        new_parent, new_name = self.vfs_getparent(p_new)
+        old_parent.rename(old_name, new_parent, new_name)
+
     @vfs_signature("lseek(iii)i")
     def s_lseek(self, fd, offset, whence):
         if whence not in (0, 1, 2):
@@ -371,32 +1174,10 @@ class MixVFS(object):
 
     @vfs_signature("readdir(p)p")
     def s_readdir(self, p_dir):
-        fdir = self.vfs_open_dirs[p_dir.addr]
-        while True:
-            try:
-                name = fdir.readdir()
-            except StopIteration:
-                return NULL
-            try:
-                subnode = fdir.node.join(name)
-                st = subnode.stat()
-            except OSError:
-                continue
-            break
-        dirent = ffi.new("struct dirent *")
-        dirent.d_ino = st.st_ino
-        dirent.d_reclen = ffi.sizeof("struct dirent")
-        if subnode.is_dir():
-            dirent.d_type = lib.DT_DIR
-        else:
-            dirent.d_type = lib.DT_REG
-        name = name.encode('utf-8') + b'\x00'
-        n = len(name)
-        if n > ffi.sizeof(dirent.d_name):
-            raise OSError(errno.EOVERFLOW, subnode)
-        ffi.memmove(dirent.d_name, name, n)
-        bytes_data = ffi.buffer(dirent)[:]
-        self.sandio.write_buffer(p_dir, bytes_data)
+        record = self.vfs_open_dirs[p_dir.addr].readdir()
+        if record is None:
+            return NULL
+        self.sandio.write_buffer(p_dir, record)
         return p_dir
 
     @vfs_signature("closedir(p)i")
@@ -0,0 +1,268 @@
+"""A pool of pre-started sandboxed subprocesses.
+
+Starting pypy-sandbox costs a lot of messages: all the stat64/open/read
+of the standard library, the encodings imports, and so on.  For short
+jobs, that dominates.  A SandboxPool starts the subprocesses in advance
+and runs them until they are "parked", i.e. until they try to read from
+their stdin for the first time.  This is typically done with pypy-sandbox
+in interactive mode ('-i'), which waits for input after initialization.
+
+A job is then some input bytes given to a warm subprocess.  The job is
+finished when the subprocess tries to read its stdin again after having
+consumed all the input (in '-i' mode, that's when it shows the next
+prompt), or when the subprocess exits.  The same subprocess can be used
+for up to 'max_reuse' jobs; note that reusing it means that the jobs
+share the same interpreter state.
+
+    pool = SandboxPool(MyProc, ['/bin/pypy', '-S', '-i'], executable,
+                       size=4, max_reuse=1)
+    pool.start()
+    result = pool.run_job(b"print(6*7)\\n")
+    print(result.output)
+    pool.close()
+"""
+
+import subprocess, threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue     # Python 2
+from .sandboxio import SandboxError
+from .virtualizedproc import signature
+
+
+class PoolTimeout(Exception):
+    """No warm subprocess became available in time."""
+
+
+class _Parked(Exception):
+    """Raised out of run() when the subprocess waits for more input."""
+
+
+class MixWarmPool(object):
+    """Serves the stdin of the subprocess from the input of the current
+    job, and parks the subprocess whenever that input is exhausted.
+    Added automatically by SandboxPool if the class doesn't have it.
+    """
+
+    def __init__(self, *args, **kwds):
+        self._pool_input = None
+        self._pool_eof = False
+        self._pool_pending = None
+        self._pool_parking = False
+        super(MixWarmPool, self).__init__(*args, **kwds)
+
+    @signature("read(ipi)i")
+    def s_read(self, fd, p_buf, count):
+        if fd != 0:
+            return super(MixWarmPool, self).s_read(fd, p_buf, count)
+        if self._pool_eof:
+            return 0
+        data = self._pool_input
+        if not data:
+            self._pool_parking = True
+            raise _Parked(p_buf, count)
+        assert count >= 0
+        chunk = data[:count]
+        self._pool_input = data[len(chunk):]
+        self.sandio.write_buffer(p_buf, chunk.tobytes())
+        return len(chunk)
+
+    def pool_run(self):
+        """Run the subprocess until it is parked (returns True) or until
+        it finishes (returns False)."""
+        try:
+            self.run()
+        except _Parked as e:
+            self._pool_pending = e.args
+            return True
+        finally:
+            self._pool_parking = False
+        return False
+
+    def close(self):
+        # run() calls close() when _Parked is raised, but the subprocess
+        # is only suspended
+        if not self._pool_parking:
+            super(MixWarmPool, self).close()
+
+    def pool_resume(self, input_data, eof=False):
+        """Answer the pending read() of a parked subprocess with the given
+        input, or with an end-of-file, and run it until it is parked again
+        or finishes."""
+        p_buf, count = self._pool_pending
+        self._pool_pending = None
+        self._pool_input = memoryview(input_data)
+        self._pool_eof = eof
+        try:
+            result = self.s_read(0, p_buf, count)
+        except _Parked:
+            self._pool_parking = False
+            self._pool_pending = p_buf, count
+            return True
+        self.sandio.write_result(result)
+        return self.pool_run()
+
+
+class WarmSandbox(object):
+    """A started subprocess with its controller."""
+
+    def __init__(self, popen, vproc):
+        self.popen = popen
+        self.vproc = vproc
+        self.uses = 0
+        self.holds_slot = True     # counted in SandboxPool._free_slots
+
+    def kill(self):
+        popen = self.popen
+        if popen.poll() is None:
+            popen.kill()
+        for f in (popen.stdin, popen.stdout):
+            try:
+                f.close()
+            except (OSError, ValueError):
+                pass     # e.g. broken pipe when flushing
+        popen.wait()
+
+
+class JobResult(object):
+    def __init__(self, output, exitcode):
+        self.output = output        # None if the class doesn't grab output
+        self.exitcode = exitcode    # None if the subprocess is still alive
+
+    def __repr__(self):
+        return '<JobResult exitcode=%r>' % (self.exitcode,)
+
+
+class SandboxPool(object):
+    """Keeps 'size' subprocesses started and parked, refilled in the
+    background by a thread.  'vproc_class' is the VirtualizedProc subclass
+    to use, normally with MixGrabOutput to collect the output of the jobs.
+    """
+
+    def __init__(self, vproc_class, args, executable, env={}, size=4,
+                 max_reuse=1, vproc_kwds={}):
+        if not issubclass(vproc_class, MixWarmPool):
+            vproc_class = type('Warm' + vproc_class.__name__,
+                               (MixWarmPool, vproc_class), {})
+        self.vproc_class = vproc_class
+        self.args = args
+        self.executable = executable
+        self.env = env
+        self.size = size
+        self.max_reuse = max_reuse
+        self.vproc_kwds = vproc_kwds
+        self._idle = queue.Queue()
+        # one slot per subprocess, idle or running a job, that may still
+        # be used for a job
+        self._free_slots = threading.Semaphore(size)
+        self._closed = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._refill_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _start_one(self):
+        popen = subprocess.Popen(self.args, executable=self.executable,
+                                 env=self.env,
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE)
+        sandbox = WarmSandbox(popen,
+            self.vproc_class(popen.stdin, popen.stdout, **self.vproc_kwds))
+        parked = False
+        try:
+            parked = sandbox.vproc.pool_run()
+        finally:
+            if not parked:
+                sandbox.kill()
+        if not parked:
+            raise SandboxError("the subprocess finished with exit code %r "
+                            "instead of waiting for input" %
+                            (popen.returncode,))
+        return sandbox
+
+    def _refill_loop(self):
+        while True:
+            self._free_slots.acquire()
+            if self._closed:
+                break
+            try:
+                sandbox = self._start_one()
+            except Exception as e:
+                self._idle.put(e)      # reported by the next acquire()
+            else:
+                self._idle.put(sandbox)
+
+    def acquire(self, timeout=None):
+        """Take a warm subprocess out of the pool, for one job.  A
+        replacement is started in the background as soon as it is known
+        that this subprocess will not be reused.  Raises PoolTimeout if
+        none is available after 'timeout' seconds."""
+        if self._closed:
+            raise ValueError("the pool is closed")
+        try:
+            sandbox = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise PoolTimeout("timed out waiting for a warm subprocess")
+        if isinstance(sandbox, Exception):
+            self._free_slots.release()
+            raise sandbox
+        sandbox.uses += 1
+        if sandbox.uses >= self.max_reuse:
+            # it will not come back: start the replacement now
+            sandbox.holds_slot = False
+            self._free_slots.release()
+        return sandbox
+
+    def release(self, sandbox):
+        """Give back a subprocess after a job.  It is put back in the pool
+        if it is still parked and can be reused, and killed otherwise."""
+        if (not self._closed and sandbox.vproc._pool_pending is not None
+                and sandbox.uses < self.max_reuse):
+            self._idle.put(sandbox)
+        else:
+            self._retire(sandbox)
+
+    def _retire(self, sandbox):
+        sandbox.kill()
+        if sandbox.holds_slot:
+            sandbox.holds_slot = False
+            self._free_slots.release()
+
+    def run_job(self, input_data, timeout=None):
+        """Run a job on a warm subprocess and return a JobResult."""
+        sandbox = self.acquire(timeout)
+        vproc = sandbox.vproc
+        if hasattr(vproc, 'reset_output'):
+            vproc.reset_output()       # drop the output of the startup
+        done = False
+        try:
+            parked = vproc.pool_resume(input_data)
+            done = True
+        finally:
+            if not done:
+                self._retire(sandbox)
+        output = None
+        if hasattr(vproc, 'get_all_output'):
+            output = vproc.get_all_output()
+        exitcode = None
+        if not parked:
+            exitcode = sandbox.popen.wait()
+        self.release(sandbox)
+        return JobResult(output, exitcode)
+
+    def close(self):
+        """Kill all the idle subprocesses and stop refilling."""
+        self._closed = True
+        self._free_slots.release()     # wake up the refill thread
+        if self._thread is not None:
+            self._thread.join()
+        while True:
+            try:
+                sandbox = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(sandbox, WarmSandbox):
+                sandbox.kill()
@@ -0,0 +1,224 @@
+"""Profiling of the messages exchanged with a sandboxed subprocess.
+
+    vp = MyProc(popen.stdin, popen.stdout)
+    vp.profile = SyscallProfile()
+    vp.run()
+    print(vp.profile.summary())
+
+For every signature, the profile records the number of calls, the time
+spent in the controller handling them ("handler time"), and the time
+spent waiting for the subprocess to send them ("wait time", which is
+mostly the time the subprocess runs between two messages).  It also
+records the bytes of the subprocess memory read by read_buffer() and
+read_charp() and written by write_buffer() and malloc().  Times are
+also collected in histograms with power-of-two buckets.
+
+With SyscallProfile(sample_every=N), only one message in N on average
+is timed, at random intervals so that periodic patterns in the messages
+don't bias the result.  Every message is still counted, and the times
+reported for each signature are extrapolated from the timed ones.  For
+the other messages the cost is one dict lookup and two additions, so a
+profile with e.g. sample_every=100 can be left on in production.
+"""
+
+import time, random
+
+
+class Histogram(object):
+    """Counts durations in buckets of powers of two microseconds: bucket
+    'i' counts the durations 'd' such that 2**(i-1) <= d < 2**i
+    microseconds, and bucket 0 the ones below 1 microsecond."""
+    NUM_BUCKETS = 40
+
+    def __init__(self):
+        self.buckets = [0] * self.NUM_BUCKETS
+        self.count = 0
+
+    def add(self, seconds):
+        i = int(seconds * 1e6).bit_length()
+        if i >= self.NUM_BUCKETS:
+            i = self.NUM_BUCKETS - 1
+        self.buckets[i] += 1
+        self.count += 1
+
+    def percentile(self, p):
+        """Return an upper bound, in seconds, of the p-th percentile, or
+        None if the histogram is empty."""
+        if not self.count:
+            return None
+        target = self.count * p / 100.0
+        total = 0
+        for i, n in enumerate(self.buckets):
+            total += n
+            if n and total >= target:
+                return (1 << i) / 1e6
+        return None
+
+    def as_dict(self):
+        """Return {upper bound in microseconds: count} for the non-empty
+        buckets."""
+        return dict([(1 << i, n) for i, n in enumerate(self.buckets) if n])
+
+
+class SignatureStats(object):
+    """The statistics for one signature.  'handler_time', 'wait_time' and
+    the bytes are sums over the 'sampled' messages only; the estimate_*()
+    methods extrapolate them to all the 'count' messages."""
+
+    def __init__(self, signature):
+        self.signature = signature
+        self.count = 0
+        self.sampled = 0
+        self.handler_time = 0.0
+        self.wait_time = 0.0
+        self.bytes_from_child = 0
+        self.bytes_to_child = 0
+        self.handler_hist = Histogram()
+        self.wait_hist = Histogram()
+
+    def _scale(self, value):
+        if not self.sampled:
+            return 0.0
+        return value * self.count / float(self.sampled)
+
+    def estimate_handler_time(self):
+        return self._scale(self.handler_time)
+
+    def estimate_wait_time(self):
+        return self._scale(self.wait_time)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sampled': self.sampled,
+            'handler_time': self.estimate_handler_time(),
+            'wait_time': self.estimate_wait_time(),
+            'bytes_from_child': self._scale(self.bytes_from_child),
+            'bytes_to_child': self._scale(self.bytes_to_child),
+            'handler_hist': self.handler_hist.as_dict(),
+            'wait_hist': self.wait_hist.as_dict(),
+        }
+
+
+class SyscallProfile(object):
+    """Collects the statistics of VirtualizedProc.run(), if assigned to the
+    'profile' attribute of the VirtualizedProc.  The same profile can be
+    used for several runs, which are then added together."""
+
+    def __init__(self, sample_every=1, clock=time.perf_counter):
+        assert sample_every >= 1
+        self.sample_every = sample_every
+        self.clock = clock
+        self._random = random.Random()
+        self.reset()
+
+    def reset(self):
+        self.signatures = {}      # {signature: SignatureStats}
+        self.messages = 0
+        self.run_time = 0.0
+        self.bytes_from_child = 0
+        self.bytes_to_child = 0
+
+    def run(self, vproc):
+        """The main loop of VirtualizedProc.run(), with profiling."""
+        dispatch_table = vproc.dispatch_table()
+        lookup_message = vproc.lookup_message
+        sandio = vproc.sandio
+        clock = self.clock
+        signatures = self.signatures
+        sample_every = self.sample_every
+        randrange = self._random.randrange
+        countdown = 1
+        bytes_from_child = sandio.stats_bytes_from_child
+        bytes_to_child = sandio.stats_bytes_to_child
+        start = t_end = clock()
+        try:
+            while True:
+                try:
+                    msg = sandio.read_signature()
+                except EOFError:
+                    break
+                self.messages += 1
+                size, dispatch = lookup_message(msg, dispatch_table)
+                try:
+                    st = signatures[msg]
+                except KeyError:
+                    if msg not in dispatch_table:
+                        # unknown signature: not recorded
+                        buf, pos = sandio.read_arguments(size)
+                        dispatch(vproc, buf, pos)
+                        continue
+                    st = signatures[msg] = SignatureStats(msg)
+                st.count += 1
+                countdown -= 1
+                if countdown > 0:
+                    buf, pos = sandio.read_arguments(size)
+                    sandio.write_result(dispatch(vproc, buf, pos))
+                    if countdown == 1:
+                        t_end = clock()    # the next message is timed
+                    continue
+                if sample_every > 1:
+                    countdown = randrange(1, 2 * sample_every)
+                else:
+                    countdown = 1
+                t_msg = clock()
+                from_child = sandio.stats_bytes_from_child
+                to_child = sandio.stats_bytes_to_child
+                buf, pos = sandio.read_arguments(size)
+                sandio.write_result(dispatch(vproc, buf, pos))
+                t_done = clock()
+                st.sampled += 1
+                st.handler_time += t_done - t_msg
+                st.wait_time += t_msg - t_end
+                st.handler_hist.add(t_done - t_msg)
+                st.wait_hist.add(t_msg - t_end)
+                st.bytes_from_child += (sandio.stats_bytes_from_child -
+                                        from_child)
+                st.bytes_to_child += sandio.stats_bytes_to_child - to_child
+                t_end = t_done
+        finally:
+            self.run_time += clock() - start
+            self.bytes_from_child += (sandio.stats_bytes_from_child -
+                                      bytes_from_child)
+            self.bytes_to_child += sandio.stats_bytes_to_child - bytes_to_child
+
+    def as_dict(self):
+        return {
+            'messages': self.messages,
+            'run_time': self.run_time,
+            'bytes_from_child': self.bytes_from_child,
+            'bytes_to_child': self.bytes_to_child,
+            'sample_every': self.sample_every,
+            'signatures': dict([(sig.decode('ascii'), st.as_dict())
+                                for sig, st in self.signatures.items()]),
+        }
+
+    def summary(self, limit=25):
+        """Return a printable table of the signatures that cost the most
+        handler time."""
+        lines = []
+        lines.append("%d messages in %.3f s, %d bytes read from and %d "
+                     "bytes written to the subprocess" % (
+                         self.messages, self.run_time,
+                         self.bytes_from_child, self.bytes_to_child))
+        if self.sample_every > 1:
+            lines.append("(times extrapolated from 1 message in %d)" %
+                         (self.sample_every,))
+        lines.append("%-30s %8s %11s %8s %8s %11s %10s %10s" % (
+            "signature", "calls", "handler ms", "us/call", "p99 us",
+            "wait ms", "bytes in", "bytes out"))
+        stats = sorted(self.signatures.values(),
+                       key=lambda st: st.estimate_handler_time(),
+                       reverse=True)
+        for st in stats[:limit]:
+            handler_time = st.estimate_handler_time()
+            p99 = st.handler_hist.percentile(99)
+            lines.append("%-30s %8d %11.3f %8.1f %8s %11.3f %10d %10d" % (
+                st.signature.decode('ascii')[:30], st.count,
+                handler_time * 1e3, handler_time * 1e6 / st.count,
+                '-' if p99 is None else '%d' % (p99 * 1e6,),
+                st.estimate_wait_time() * 1e3,
+                st._scale(st.bytes_from_child), st._scale(st.bytes_to_child)))
+        if len(stats) > limit:
+            lines.append("... and %d more signatures" % (len(stats) - limit,))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,352 @@
+"""Recording and replaying sessions with a sandboxed subprocess.
+
+Recording: add MixRecord to the class of the controller, and give the
+path of the trace file in the constructor:
+
+    class RecordingProc(MixRecord, MyProc):
+        pass
+
+    vp = RecordingProc(popen.stdin, popen.stdout, record_trace='run.trace')
+    vp.run()
+
+The trace contains all the bytes exchanged with the subprocess, in order:
+the messages and their arguments, the requests of the controller (memory
+reads and writes, malloc(), errno, results) and the replies of the
+subprocess.
+
+Replaying: replay() runs any VirtualizedProc subclass on the recorded
+bytes, without a subprocess:
+
+    vp = replay(MyProc, 'run.trace')
+
+Since the subprocess is fully deterministic from its point of view, the
+controller receives exactly the same messages as in the recorded
+session, as long as it sends the same requests.  With check=True
+(the default), replay() checks that the requests and results are the
+same as the recorded ones, and raises ReplayDivergence at the first
+difference.  This only works with the synchronous VirtualizedProc.run(),
+not with asyncproc.
+
+To look at a trace:
+
+    python -m sandboxlib.replay <trace file>
+
+Format of the trace files: a header (MAGIC, version, flags), followed by
+a zlib stream of records.  Each record is one tag byte (FROM_CHILD or
+TO_CHILD), the length of the data as a varint, and the data.
+Consecutive pieces of data in the same direction are merged into one
+record.
+"""
+
+import sys, errno, struct, zlib
+from io import BytesIO
+from . import sandboxio
+from .sandboxio import SandboxError, SandboxedIO, Ptr, ptr_size
+
+MAGIC = b'SBXTRACE'
+VERSION = 1
+FROM_CHILD = b'<'
+TO_CHILD = b'>'
+
+_header = struct.Struct('<8sII')
+FLAG_ZLIB = 1
+
+
+class ReplayDivergence(SandboxError):
+    """The controller did not send the same data as in the recorded
+    session."""
+
+
+def _pack_varint(n):
+    result = bytearray()
+    while n >= 0x80:
+        result.append((n & 0x7f) | 0x80)
+        n >>= 7
+    result.append(n)
+    return bytes(result)
+
+
+class TraceWriter(object):
+    """Writes a trace file.  Call write(tag, data) for each piece of data,
+    and close() at the end."""
+
+    buffer_size = 65536
+
+    def __init__(self, path, compress=True):
+        self.f = open(path, 'wb')
+        self.f.write(_header.pack(MAGIC, VERSION,
+                                  FLAG_ZLIB if compress else 0))
+        self._compressor = zlib.compressobj(6) if compress else None
+        self._tag = None
+        self._pieces = []
+        self._out = []
+        self._out_size = 0
+
+    def write(self, tag, data):
+        if tag != self._tag:
+            self._end_record()
+            self._tag = tag
+        self._pieces.append(bytes(data))
+
+    def _end_record(self):
+        if self._pieces:
+            data = b''.join(self._pieces)
+            self._pieces = []
+            self._out.append(self._tag + _pack_varint(len(data)))
+            self._out.append(data)
+            self._out_size += len(data)
+            if self._out_size >= self.buffer_size:
+                self._write_out()
+
+    def _write_out(self):
+        data = b''.join(self._out)
+        self._out = []
+        self._out_size = 0
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        self.f.write(data)
+
+    def close(self):
+        if self.f is None:
+            return
+        self._end_record()
+        self._write_out()
+        if self._compressor is not None:
+            self.f.write(self._compressor.flush())
+        self.f.close()
+        self.f = None
+
+
+def iter_trace(path):
+    """Yield the records (tag, data) of a trace file."""
+    with open(path, 'rb') as f:
+        header = f.read(_header.size)
+        try:
+            magic, version, flags = _header.unpack(header)
+        except struct.error:
+            magic = None
+        if magic != MAGIC:
+            raise ValueError("%r: not a trace file" % (path,))
+        if version != VERSION:
+            raise ValueError("%r: unsupported trace version %d" % (path,
+                                                                   version))
+        data = f.read()
+    if flags & FLAG_ZLIB:
+        data = zlib.decompress(data)
+    pos = 0
+    while pos < len(data):
+        tag = data[pos:pos + 1]
+        pos += 1
+        length = 0
+        shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            length |= (byte & 0x7f) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        yield tag, data[pos:pos + length]
+        pos += length
+
+def read_trace(path):
+    """Return (bytes from the child, bytes to the child) of a trace."""
+    from_child = []
+    to_child = []
+    for tag, data in iter_trace(path):
+        if tag == FROM_CHILD:
+            from_child.append(data)
+        else:
+            to_child.append(data)
+    return b''.join(from_child), b''.join(to_child)
+
+
+# ---------- recording ----------
+
+class RecordingSandboxedIO(SandboxedIO):
+    """A SandboxedIO that copies everything it reads and writes to the
+    TraceWriter 'self.trace'."""
+    trace = None
+
+    def _raw_readinto(self, view):
+        n = super(RecordingSandboxedIO, self)._raw_readinto(view)
+        if n:
+            self.trace.write(FROM_CHILD, view[:n])
+        return n
+
+    def _write_pieces(self, pieces):
+        for piece in pieces:
+            self.trace.write(TO_CHILD, piece)
+        super(RecordingSandboxedIO, self)._write_pieces(pieces)
+
+
+class MixRecord(object):
+    """Records the session in the trace file 'record_trace', a keyword
+    argument of the constructor."""
+    sandio_class = RecordingSandboxedIO
+
+    def __init__(self, *args, **kwds):
+        self.trace_writer = TraceWriter(kwds.pop('record_trace'))
+        super(MixRecord, self).__init__(*args, **kwds)
+        self.sandio.trace = self.trace_writer
+
+    def run(self):
+        try:
+            super(MixRecord, self).run()
+        finally:
+            self.trace_writer.close()
+
+
+# ---------- replaying ----------
+
+class ReplaySink(object):
+    """Stands for the stdin of the subprocess during a replay.  If
+    'expected' is not None, checks that the data written is the same."""
+
+    def __init__(self, expected=None):
+        self.expected = expected
+        self.pos = 0
+
+    def write(self, data):
+        n = len(data)
+        expected = self.expected
+        if expected is not None and expected[self.pos:self.pos + n] != data:
+            raise ReplayDivergence(
+                "the controller's output differs from the recorded one "
+                "at offset %d" % (self._first_difference(data),))
+        self.pos += n
+        return n
+
+    def _first_difference(self, data):
+        expected = self.expected[self.pos:self.pos + len(data)]
+        for i in range(min(len(data), len(expected))):
+            if expected[i] != data[i]:
+                return self.pos + i
+        return self.pos + min(len(data), len(expected))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def check_finished(self):
+        if self.expected is not None and self.pos != len(self.expected):
+            raise ReplayDivergence(
+                "the controller sent %d bytes instead of the %d recorded" % (
+                    self.pos, len(self.expected)))
+
+
+def replay(vproc_class, trace_path, check=True, **kwds):
+    """Run a new instance of 'vproc_class' on the recorded session, and
+    return it.  The keyword arguments are passed to the constructor."""
+    from_child, to_child = read_trace(trace_path)
+    sink = ReplaySink(to_child if check else None)
+    vproc = vproc_class(sink, BytesIO(from_child), **kwds)
+    vproc.run()
+    sink.check_finished()
+    return vproc
+
+
+# ---------- decoding ----------
+
+_ptr = struct.Struct('=' + sandboxio._ptr_code)
+_int = struct.Struct('=i')
+_longlong = struct.Struct('=q')
+_double = struct.Struct('=d')
+
+def iter_messages(trace_path):
+    """Decode a trace.  Yields a tuple (signature, arguments, requests,
+    result) for each message, where 'requests' is a list of the requests
+    of the controller with the replies of the subprocess, like
+    ('R', address, data read) or ('E', errno), and 'result' is the
+    result returned, or None if the session ends before.
+    """
+    from_child, to_child = read_trace(trace_path)
+    fc = [0]
+    tc = [0]
+    def get(stream, pos, n):
+        if pos[0] + n > len(stream):
+            raise EOFError
+        data = stream[pos[0]:pos[0] + n]
+        pos[0] += n
+        return data
+    def get_ptr(stream, pos):
+        return _ptr.unpack(get(stream, pos, ptr_size))[0]
+    while fc[0] < len(from_child):
+        n = from_child[fc[0]]
+        msg = from_child[fc[0] + 1:fc[0] + 1 + n]
+        fc[0] += 1 + n
+        size, decode = sandboxio.make_message_decoder(msg)
+        requests = []
+        try:
+            args = decode(get(from_child, fc, size), 0)
+            while True:
+                cmd = get(to_child, tc, 1)
+                if cmd == b'R':
+                    addr = get_ptr(to_child, tc)
+                    length = get_ptr(to_child, tc)
+                    requests.append(('R', addr, get(from_child, fc, length)))
+                elif cmd == b'Z':
+                    addr = get_ptr(to_child, tc)
+                    get_ptr(to_child, tc)
+                    length = get_ptr(from_child, fc)
+                    requests.append(('Z', addr, get(from_child, fc, length)))
+                elif cmd == b'W':
+                    addr = get_ptr(to_child, tc)
+                    length = get_ptr(to_child, tc)
+                    requests.append(('W', addr, get(to_child, tc, length)))
+                elif cmd == b'M':
+                    length = get_ptr(to_child, tc)
+                    data = get(to_child, tc, length)
+                    requests.append(('M', get_ptr(from_child, fc), data))
+                elif cmd == b'F':
+                    requests.append(('F', get_ptr(to_child, tc)))
+                elif cmd == b'E':
+                    requests.append(('E', _int.unpack(get(to_child, tc,
+                                                          4))[0]))
+                elif cmd == b'v':
+                    result = None
+                    break
+                elif cmd == b'p':
+                    result = Ptr(get_ptr(to_child, tc))
+                    break
+                elif cmd == b'i':
+                    result = _longlong.unpack(get(to_child, tc, 8))[0]
+                    break
+                elif cmd == b'f':
+                    result = _double.unpack(get(to_child, tc, 8))[0]
+                    break
+                else:
+                    raise ValueError("bad request %r in trace" % (cmd,))
+        except EOFError:
+            yield msg, None, requests, None
+            return
+        yield msg, args, requests, result
+
+
+def main(argv):
+    """Usage: python -m sandboxlib.replay <trace file>
+
+Prints the messages of a trace, with the requests of the controller and
+the replies of the subprocess.
+"""
+    if len(argv) != 1 or argv[0] in ('-h', '--help'):
+        sys.stderr.write(main.__doc__)
+        return 2
+    for msg, args, requests, result in iter_messages(argv[0]):
+        sys.stdout.write('%s %r\n' % (msg.decode('ascii'), args))
+        for request in requests:
+            if request[0] == 'E':
+                text = errno.errorcode.get(request[1], str(request[1]))
+            elif request[0] == 'F':
+                text = hex(request[1])
+            else:
+                text = '%s %s' % (hex(request[1]), repr(request[2])[:70])
+            sys.stdout.write('    %s %s\n' % (request[0], text))
+        sys.stdout.write('    => %r\n' % (result,))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,217 @@
+"""Starting a sandboxed subprocess, running its controller, and waiting
+for it to exit.
+
+    runner = SandboxRunner(MyProc, executable, ['/bin/pypy', '-c', 'pass'],
+                           budget=ExecutionBudget(wall_clock=10.0))
+    result = runner.run()
+    print(result.exitcode, result.output, result.termination)
+
+SandboxRunner spawns the subprocess with larger pipes (F_SETPIPE_SZ, on
+Linux), so that big replies don't need several context switches.  Once
+the subprocess closes its end, the exit is waited for without polling:
+with a pidfd if possible, or else with os.wait4() in a helper thread.
+The subprocess is reaped with os.wait4(), which gives its resource usage.
+
+To configure the VirtualizedProc before it runs, call start() first; it
+returns the VirtualizedProc.  For more control, run it yourself and then
+call wait().
+"""
+
+import os, sys, select, threading, time, subprocess
+from .sandboxio import BudgetExceeded
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)   # Linux-only
+
+
+def set_pipe_size(f, size):
+    """Try to resize the pipe 'f' to 'size' bytes.  Returns False if it
+    is not possible (e.g. not on Linux, or above
+    /proc/sys/fs/pipe-max-size)."""
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.fcntl(f.fileno(), F_SETPIPE_SZ, size)
+    except OSError:
+        return False
+    return True
+
+
+def spawn(executable, args, env=None, pipe_size=None, preexec_fn=None):
+    """Start a sandboxed subprocess, with pipes for its stdin and stdout,
+    and return the Popen object.  Like with subprocess.Popen, env=None
+    means that the subprocess inherits our environment; pass env={} to
+    give it an empty one."""
+    popen = subprocess.Popen(args, executable=executable, env=env,
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             preexec_fn=preexec_fn)
+    if pipe_size:
+        set_pipe_size(popen.stdin, pipe_size)
+        set_pipe_size(popen.stdout, pipe_size)
+    return popen
+
+
+def _wait4(pid, timeout, kill):
+    # os.wait4(pid, 0), but if the process is still running after 'timeout'
+    # seconds, call kill() first.  Returns (timed_out, status, rusage).
+    timed_out = False
+    if timeout is not None:
+        pidfd = None
+        if hasattr(os, 'pidfd_open'):
+            try:
+                pidfd = os.pidfd_open(pid)
+            except OSError:
+                pass
+        if pidfd is not None:
+            try:
+                if not select.select([pidfd], [], [], timeout)[0]:
+                    timed_out = True
+                    kill()
+            finally:
+                os.close(pidfd)
+        else:
+            results = []
+            def wait_in_thread():
+                try:
+                    results.append(os.wait4(pid, 0))
+                except BaseException as e:
+                    results.append(e)
+            thread = threading.Thread(target=wait_in_thread)
+            thread.daemon = True
+            thread.start()
+            thread.join(timeout)
+            if thread.is_alive():
+                timed_out = True
+                kill()
+                thread.join()
+            if isinstance(results[0], BaseException):
+                raise results[0]
+            return (timed_out,) + results[0][1:]
+    pid, status, rusage = os.wait4(pid, 0)
+    return timed_out, status, rusage
+
+
+class RunResult(object):
+    """The result of SandboxRunner.run().
+
+    'exitcode' is the exit code of the subprocess (negative for a signal).
+    'termination' is None if the subprocess exited by itself, or else the
+    reason why it was killed: the 'reason' of a BudgetExceeded, 'error'
+    if the controller raised another exception (stored in 'error'), or
+    'exit_timeout' if it did not exit after closing its stdout.
+    'output' is the output collected by MixGrabOutput, if any.
+    'elapsed' is the total wall-clock time, 'run_time' the part spent in
+    the controller's run(), and 'rusage' the resource usage of the
+    subprocess.
+    """
+
+    def __init__(self):
+        self.exitcode = None
+        self.termination = None
+        self.error = None
+        self.output = None
+        self.elapsed = None
+        self.run_time = None
+        self.rusage = None
+
+    def __repr__(self):
+        return '<RunResult exitcode=%r termination=%r>' % (self.exitcode,
+                                                          self.termination)
+
+
+class SandboxRunner(object):
+    """Runs the subprocess 'args' with the VirtualizedProc subclass
+    'vproc_class'.  'env' is passed to spawn(): None means inherit our
+    environment, which is usually not what you want for a sandboxed
+    subprocess."""
+    pipe_size = 1024 * 1024
+    exit_timeout = 5.0      # after the subprocess closes its stdout
+
+    def __init__(self, vproc_class, executable, args, env=None, budget=None,
+                 vproc_kwds={}):
+        self.vproc_class = vproc_class
+        self.executable = executable
+        self.args = list(args)
+        self.env = env
+        self.budget = budget
+        self.vproc_kwds = vproc_kwds
+        self.popen = None
+        self.vproc = None
+        self._start_time = None
+
+    def start(self):
+        """Start the subprocess, and return its VirtualizedProc."""
+        preexec_fn = None
+        if self.budget is not None:
+            preexec_fn = self.budget.preexec_fn()
+        self._start_time = time.monotonic()
+        self.popen = spawn(self.executable, self.args, env=self.env,
+                           pipe_size=self.pipe_size, preexec_fn=preexec_fn)
+        self.vproc = self.vproc_class(self.popen.stdin, self.popen.stdout,
+                                      **self.vproc_kwds)
+        self.vproc.child_pid = self.popen.pid
+        if self.budget is not None:
+            self.budget.apply(self.vproc, self.popen.pid)
+        return self.vproc
+
+    def kill(self):
+        if self.popen.returncode is None:
+            try:
+                self.popen.kill()
+            except OSError:
+                pass
+
+    def wait(self, timeout=None, result=None):
+        """Close the pipes and wait for the subprocess to exit, for at most
+        'timeout' seconds, after which it is killed.  Returns a RunResult
+        (or fills 'result')."""
+        if result is None:
+            result = RunResult()
+        popen = self.popen
+        for f in (popen.stdin, popen.stdout):
+            try:
+                f.close()
+            except (OSError, ValueError):
+                pass     # e.g. broken pipe when flushing
+        timed_out, status, rusage = _wait4(popen.pid, timeout, self.kill)
+        if timed_out and result.termination is None:
+            result.termination = 'exit_timeout'
+        popen.returncode = os.waitstatus_to_exitcode(status)
+        result.exitcode = popen.returncode
+        result.rusage = rusage
+        result.elapsed = time.monotonic() - self._start_time
+        return result
+
+    def run(self):
+        """Start the subprocess (unless start() was already called), run
+        the controller and wait for the exit.  Exceptions from the
+        controller are reported in the RunResult, and the subprocess is
+        killed."""
+        result = RunResult()
+        vproc = self.vproc
+        if vproc is None:
+            vproc = self.start()
+        t_run = time.monotonic()
+        try:
+            vproc.run()
+        except BudgetExceeded as e:
+            result.termination = e.reason
+            result.error = e
+            self.kill()
+        except Exception as e:
+            result.termination = 'error'
+            result.error = e
+            self.kill()
+        except BaseException:
+            # e.g. KeyboardInterrupt: don't leave the subprocess running
+            self.kill()
+            self.wait(self.exit_timeout)
+            raise
+        result.run_time = time.monotonic() - t_run
+        if hasattr(vproc, 'get_all_output'):
+            result.output = vproc.get_all_output()
+        return self.wait(self.exit_timeout, result)
@@ -1,4 +1,4 @@
-import struct
+import os, sys, struct, select, time
 
 VERSION = 20001
 
@@ -7,6 +7,18 @@ class SandboxError(Exception):
     """The sandboxed process misbehaved"""
 
 
+class BudgetExceeded(SandboxError):
+    """The sandboxed process reached one of the limits of its budget.
+    'reason' is one of 'wall_clock', 'messages', 'bytes_from_child',
+    'bytes_to_child' or 'rss'; 'limit' is the limit that was reached."""
+
+    def __init__(self, reason, limit):
+        SandboxError.__init__(self, "budget exceeded: %s (limit %s)" % (
+            reason, limit))
+        self.reason = reason
+        self.limit = limit
+
+
 class Ptr(object):
     def __init__(self, addr):
         self.addr = addr
@@ -19,133 +31,456 @@ ptr_size = struct.calcsize("P")
 NULL = Ptr(0)
 
 _ptr_code = 'q' if ptr_size == 8 else 'i'
-_pack_one_ptr = struct.Struct("=" + _ptr_code).pack
-_pack_one_longlong = struct.Struct("=q").pack
-_pack_one_double = struct.Struct("=d").pack
-_pack_one_int = struct.Struct("=i").pack
-_pack_two_ptrs = struct.Struct("=" + _ptr_code + _ptr_code).pack
-_unpack_one_ptr = struct.Struct("=" + _ptr_code).unpack
+_pack_cmd_ptr = struct.Struct("=c" + _ptr_code).pack
+_pack_cmd_longlong = struct.Struct("=cq").pack
+_pack_cmd_double = struct.Struct("=cd").pack
+_pack_cmd_int = struct.Struct("=ci").pack
+_pack_cmd_two_ptrs = struct.Struct("=c" + _ptr_code + _ptr_code).pack
+_unpack_from_one_ptr = struct.Struct("=" + _ptr_code).unpack_from
+
+# maximum number of buffers passed to a single os.writev() call
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 16
+if _IOV_MAX <= 0:
+    _IOV_MAX = 16
+
+
+def parse_signature(msg):
+    """Parse a message like b'open(pii)i' and return a pair (unpacker,
+    codes), where 'unpacker' is a struct.Struct for the packed arguments
+    and 'codes' is the string of argument type codes.
+    """
+    i1 = msg.find(b'(')
+    i2 = msg.find(b')')
+    if not (i1 > 0 and i1 < i2 and i2 == len(msg) - 2):
+        raise SandboxError(
+            "badly formatted data received from the sandboxed process")
+    pack_args = ['=']
+    codes = []
+    for c in msg[i1+1:i2]:
+        if isinstance(c, int): c = chr(c)   # Python 3
+        if c == 'p':
+            pack_args.append(_ptr_code)
+        elif c == 'i':
+            pack_args.append('q')
+        elif c == 'f':
+            pack_args.append('d')
+        elif c == 'v':
+            pass
+        else:
+            raise SandboxError(
+                "unsupported format string in parentheses: %r" % (msg,))
+        codes.append(c)
+    return struct.Struct(''.join(pack_args)), ''.join(codes)
+
+def _compile_unpacking(codes, unpack_from, func=None):
+    # Generate a small function that unpacks the raw arguments in-place
+    # with a single struct call and builds the Python-level arguments
+    # without any per-argument loop.  If 'func' is given, the result is
+    # instead a function (self, buf, pos) that calls 'func(self, *args)'
+    # directly.
+    names = []
+    exprs = []
+    for c in codes:
+        if c == 'v':
+            exprs.append('None')
+        else:
+            name = 'a%d' % len(names)
+            names.append(name)
+            exprs.append('Ptr(%s)' % name if c == 'p' else name)
+    lines = []
+    if func is None:
+        lines.append('def decode(buf, pos):')
+    else:
+        lines.append('def decode(self, buf, pos):')
+    if names:
+        lines.append('    %s= unpack_from(buf, pos)' % (
+            ''.join(n + ', ' for n in names)))
+    if func is None:
+        lines.append('    return (%s)' % (''.join(e + ', ' for e in exprs)))
+    else:
+        lines.append('    return func(%s)' % (', '.join(['self'] + exprs)))
+    namespace = {'unpack_from': unpack_from, 'Ptr': Ptr, 'func': func}
+    exec('\n'.join(lines) + '\n', namespace)
+    return namespace['decode']
+
+def make_message_decoder(msg):
+    """Return a pair (size, decode) for the given message signature:
+    'size' is the number of bytes of packed arguments that follow the
+    message, and 'decode(buf, pos)' turns them into a tuple of arguments.
+    """
+    unpacker, codes = parse_signature(msg)
+    return unpacker.size, _compile_unpacking(codes, unpacker.unpack_from)
+
+def make_message_dispatcher(msg, func):
+    """Return a pair (size, dispatch) for the given message signature:
+    'dispatch(self, buf, pos)' decodes the packed arguments and passes
+    them straight to 'func(self, *args)', returning its result.
+    """
+    unpacker, codes = parse_signature(msg)
+    return unpacker.size, _compile_unpacking(codes, unpacker.unpack_from,
+                                             func)
 
 
 class SandboxedIO(object):
-    _message_decoders = {}
+    # Maps the message signatures that we expect to a pair (size, decode),
+    # as returned by make_message_decoder().  Unknown messages are still
+    # decoded by read_message(), but the result is not stored, so that
+    # the sandboxed process cannot make this dictionary grow.
+    message_decoders = {}
+
+
+    # Initial size of the input buffer.  It grows if a single message is
+    # larger, but replies to read_buffer() that are larger are read
+    # directly into their own buffer.
+    input_buffer_size = 65536
+
+    # Limits, normally set by budget.ExecutionBudget.  'deadline' is a
+    # time.monotonic() value, and 'wall_clock' the corresponding number of
+    # seconds for the error message.  'check_callback' is called every
+    # 'check_every' messages, and every 'check_interval' seconds while
+    # waiting for the subprocess.  Call update_limits() after changing them.
+    deadline = None
+    wall_clock = None
+    max_messages = sys.maxsize
+    max_bytes_from_child = sys.maxsize
+    max_bytes_to_child = sys.maxsize
+    check_callback = None
+    check_every = sys.maxsize
+    check_interval = None
+    _next_check = sys.maxsize
 
 
     def __init__(self, child_stdin, child_stdout):
         self.child_stdin = child_stdin
         self.child_stdout = child_stdout
-
-    def _read(self, count):
-        result = self.child_stdout.read(count)
-        if len(result) != count:
-            raise SandboxError(
-                "connection interrupted with the sandboxed process")
-        return result
-
-    @staticmethod
-    def _make_message_decoder(data):
-        i1 = data.find(b'(')
-        i2 = data.find(b')')
-        if not (i1 > 0 and i1 < i2 and i2 == len(data) - 2):
-            raise SandboxError(
-                "badly formatted data received from the sandboxed process")
-        pack_args = ['=']
-        codes = []
-        for c in data[i1+1:i2]:
-            if isinstance(c, int): c = chr(c)   # Python 3
-            if c == 'p':
-                pack_args.append(_ptr_code)
-            elif c == 'i':
-                pack_args.append('q')
-            elif c == 'f':
-                pack_args.append('d')
-            elif c == 'v':
+        # Everything sent by the subprocess is read into '_inbuf', as much
+        # as is available with each system call, and then parsed out of it.
+        # The unparsed data is '_inbuf[_inpos:_inend]'.  If 'child_stdout'
+        # is a buffered file, we bypass its own buffer and read directly
+        # from the raw file.
+        self._inbuf = bytearray(self.input_buffer_size)
+        self._inview = memoryview(self._inbuf)
+        self._inpos = 0
+        self._inend = 0
+        try:
+            self._in_fd = child_stdout.fileno()
+        except (AttributeError, ValueError, OSError):
+            self._in_fd = None
+        raw = getattr(child_stdout, 'raw', None)
+        if raw is not None:
+            self._readinto = raw.readinto
+        elif hasattr(child_stdout, 'readinto1'):
+            self._readinto = child_stdout.readinto1
+        else:
+            self._readinto = child_stdout.readinto
+        # Everything sent to the subprocess is queued in '_outq', without
+        # copying, and only sent when we are about to wait for an answer
+        # from the subprocess.  If 'child_stdin' is a real file, we send
+        # all the queued pieces with a single os.writev() system call.
+        self._outq = []
+        self._out_fd = None
+        if hasattr(os, 'writev'):
+            try:
+                self._out_fd = child_stdin.fileno()
+            except (AttributeError, ValueError, OSError):
                 pass
             else:
-                raise SandboxError(
-                    "unsupported format string in parentheses: %r" % (data,))
-            codes.append(c)
-        unpacker = struct.Struct(''.join(pack_args))
-        decoder = unpacker, ''.join(codes)
+                child_stdin.flush()
+        self.stats_messages = 0
+        self.stats_write_pieces = 0
+        self.stats_write_syscalls = 0
+        # bytes of the subprocess memory read with read_buffer() and
+        # read_charp(), and written with write_buffer() and malloc()
+        self.stats_bytes_from_child = 0
+        self.stats_bytes_to_child = 0
+
+    def _raw_readinto(self, view):
+        """Read some bytes into the memoryview 'view', with a single system
+        call if possible.  Returns the number of bytes read, or 0 at EOF.
+        """
+        if self.deadline is not None or self.check_interval is not None:
+            self._wait_readable()
+        return self._readinto(view)
+
+    def _wait_readable(self):
+        # wait until the subprocess sends something, but not after the
+        # deadline, and calling 'check_callback' regularly
+        fd = self._in_fd
+        if fd is None:
+            return
+        while True:
+            timeout = self.check_interval
+            if self.deadline is not None:
+                remaining = self.deadline - time.monotonic()
+                if remaining <= 0:
+                    raise BudgetExceeded('wall_clock', self.wall_clock)
+                if timeout is None or remaining < timeout:
+                    timeout = remaining
+            if select.select([fd], [], [], timeout)[0]:
+                return
+            if self.check_callback is not None:
+                self.check_callback()
+
+    def update_limits(self):
+        """Must be called after the limits are changed."""
+        self._next_check = min(self.max_messages + 1,
+                               self.stats_messages + self.check_every)
+
+    def _check_limits(self):
+        if self.stats_messages > self.max_messages:
+            raise BudgetExceeded('messages', self.max_messages)
+        if self.check_callback is not None:
+            self.check_callback()
+        self.update_limits()
+
+    def _make_room(self, count):
+        # Make sure '_inbuf' can hold 'count' bytes starting at '_inpos',
+        # by moving the unparsed data to the start, or by reallocating it.
+        pos = self._inpos
+        end = self._inend
+        if count > len(self._inbuf):
+            size = max(count, 2 * len(self._inbuf))
+            newbuf = bytearray(size)
+            newbuf[:end - pos] = self._inview[pos:end]
+            self._inview.release()
+            self._inbuf = newbuf
+            self._inview = memoryview(newbuf)
+        else:
+            # the source and destination may overlap: copy through bytes
+            self._inbuf[:end - pos] = bytes(self._inview[pos:end])
+        self._inpos = 0
+        self._inend = end - pos
 
-        SandboxedIO._message_decoders[data] = decoder
-        return decoder
+    def _fill(self, count):
+        """Make sure that at least 'count' bytes are available in '_inbuf'
+        starting at '_inpos'.  Returns False if the subprocess finished
+        before that.
+        """
+        if self._inpos + count > len(self._inbuf):
+            self._make_room(count)
+        target = self._inpos + count
+        end = self._inend
+        while end < target:
+            n = self._raw_readinto(self._inview[end:])
+            if not n:
+                self._inend = end
+                return False
+            end += n
+        self._inend = end
+        return True
+
+    def _interrupted(self):
+        return SandboxError("connection interrupted with the sandboxed process")
+
+    def _read(self, count):
+        """Read exactly 'count' bytes and return them as a bytes object."""
+        pos = self._inpos
+        if count > self._inend - pos and count > len(self._inbuf):
+            return self._read_large(count)
+        if not self._fill(count):
+            raise self._interrupted()
+        pos = self._inpos
+        self._inpos = pos + count
+        return bytes(self._inview[pos:pos + count])
+
+    def _read_large(self, count):
+        # the reply does not fit in '_inbuf': read the rest of it directly
+        # into its own buffer, without going through '_inbuf'
+        result = bytearray(count)
+        view = memoryview(result)
+        pos = self._inpos
+        got = self._inend - pos
+        view[:got] = self._inview[pos:self._inend]
+        self._inpos = self._inend = 0
+        while got < count:
+            n = self._raw_readinto(view[got:])
+            if not n:
+                raise self._interrupted()
+            got += n
+        view.release()
+        return bytes(result)
+
+    def read_signature(self):
+        """Wait for the next message and return only its signature, like
+        b'open(pii)i'; the caller must then call read_arguments() with the
+        size of the packed arguments.  Raises EOFError if the subprocess
+        finished.
+        """
+        if not self._fill(1):
+            raise EOFError
+        self.stats_messages += 1
+        if self.stats_messages >= self._next_check:
+            self._check_limits()
+        n = self._inbuf[self._inpos]
+        if not self._fill(1 + n):
+            raise self._interrupted()
+        start = self._inpos + 1
+        self._inpos = start + n
+        return bytes(self._inview[start:start + n])
+
+    def read_arguments(self, size):
+        """Consume the packed arguments that follow a message.  Returns a
+        pair (buf, pos) giving where they are; this is only valid until
+        the next read from the subprocess.
+        """
+        if not self._fill(size):
+            raise self._interrupted()
+        pos = self._inpos
+        self._inpos = pos + size
+        return self._inbuf, pos
 
     def read_message(self):
         """Wait for the next message and returns it.  Raises EOFError if the
         subprocess finished.  Raises SandboxError if there is another kind
         of detected misbehaviour.
         """
-        ch = self.child_stdout.read(1)
-        if len(ch) == 0:
-            raise EOFError
-        n = ord(ch)
-        msg = self._read(n)
-        decoder = self._message_decoders.get(msg)
+        msg = self.read_signature()
+        decoder = self.message_decoders.get(msg)
         if decoder is None:
-            decoder = self._make_message_decoder(msg)
-
-        unpacker, codes = decoder
-        raw_args = iter(unpacker.unpack(self._read(unpacker.size)))
-        args = []
-        for c in codes:
-            if c == 'p':
-                args.append(Ptr(next(raw_args)))
-            elif c == 'v':
-                args.append(None)
-            else:
-                args.append(next(raw_args))
-        return msg, args
+            decoder = make_message_decoder(msg)
+        size, decode = decoder
+        buf, pos = self.read_arguments(size)
+        return msg, decode(buf, pos)
 
-    def read_buffer(self, ptr, length):
+    def flush(self):
+        """Send all the queued output to the subprocess."""
+        pieces = self._outq
+        if pieces:
+            self._outq = []
+            self.stats_write_pieces += len(pieces)
+            self._write_pieces(pieces)
+
+    def _write_pieces(self, pieces):
+        fd = self._out_fd
+        if fd is None:
+            g = self.child_stdin
+            for piece in pieces:
+                g.write(piece)
+            g.flush()
+            self.stats_write_syscalls += 1
+            return
+        i = 0
+        while i < len(pieces):
+            n = self._writev(fd, pieces[i:i + _IOV_MAX])
+            i = self._skip_written(pieces, i, n)
+
+    def _skip_written(self, pieces, i, n):
+        # after 'n' bytes of 'pieces[i:]' have been written, skip the
+        # pieces that have been written completely, and keep only the
+        # unwritten part of the next one.  Returns the new 'i'.
+        self.stats_write_syscalls += 1
+        while n:
+            size = len(pieces[i])
+            if n < size:
+                pieces[i] = memoryview(pieces[i])[n:]
+                break
+            n -= size
+            i += 1
+        return i
+
+    def _writev(self, fd, buffers):
+        return os.writev(fd, buffers)
+
+    def write_stats(self):
+        """Return a dict with statistics about the data sent to the
+        subprocess: how many pieces were sent and with how many system
+        calls, and how many system calls per message that saved compared
+        to sending every piece separately.
+        """
+        messages = self.stats_messages
+        pieces = self.stats_write_pieces
+        syscalls = self.stats_write_syscalls
+        return {
+            'messages': messages,
+            'pieces': pieces,
+            'syscalls': syscalls,
+            'saved': pieces - syscalls,
+            'saved_per_message': (float(pieces - syscalls) / messages
+                                  if messages else 0.0),
+        }
+
+    def _request_buffer(self, ptr, length):
         if length < 0:
             raise Exception("read_buffer: negative length")
-        g = self.child_stdin
-        g.write(b"R" + _pack_two_ptrs(ptr.addr, length))
-        g.flush()
+        if self.stats_bytes_from_child + length > self.max_bytes_from_child:
+            raise BudgetExceeded('bytes_from_child', self.max_bytes_from_child)
+        self._outq.append(_pack_cmd_two_ptrs(b"R", ptr.addr, length))
+        self.stats_bytes_from_child += length
+
+    def read_buffer(self, ptr, length):
+        self._request_buffer(ptr, length)
+        self.flush()
         return self._read(length)
 
+    def _charp_length(self, buf, pos):
+        length = _unpack_from_one_ptr(buf, pos)[0]
+        self.stats_bytes_from_child += length
+        if self.stats_bytes_from_child > self.max_bytes_from_child:
+            raise BudgetExceeded('bytes_from_child', self.max_bytes_from_child)
+        return length
+
+    def _request_charp(self, ptr, maxlen):
+        self._outq.append(_pack_cmd_two_ptrs(b"Z", ptr.addr, maxlen))
+
     def read_charp(self, ptr, maxlen):
-        g = self.child_stdin
-        g.write(b"Z" + _pack_two_ptrs(ptr.addr, maxlen))
-        g.flush()
-        length = _unpack_one_ptr(self._read(ptr_size))[0]
+        self._request_charp(ptr, maxlen)
+        self.flush()
+        length = self._charp_length(*self.read_arguments(ptr_size))
         return self._read(length)
 
     def write_buffer(self, ptr, bytes_data):
-        assert isinstance(bytes_data, bytes)
-        g = self.child_stdin
-        g.write(b"W" + _pack_two_ptrs(ptr.addr, len(bytes_data)))
-        g.write(bytes_data)
-        # g.flush() not necessary here
+        """Write the data into the memory of the subprocess.  'bytes_data'
+        can be any object supporting the buffer protocol.  It is not
+        copied, so it must not be modified before the next flush."""
+        if not isinstance(bytes_data, bytes):
+            bytes_data = memoryview(bytes_data).cast('B')
+        if (self.stats_bytes_to_child + len(bytes_data) >
+                self.max_bytes_to_child):
+            raise BudgetExceeded('bytes_to_child', self.max_bytes_to_child)
+        outq = self._outq
+        outq.append(_pack_cmd_two_ptrs(b"W", ptr.addr, len(bytes_data)))
+        outq.append(bytes_data)
+        self.stats_bytes_to_child += len(bytes_data)
+        # self.flush() not necessary here
 
-    def write_result(self, result):
-        g = self.child_stdin
+    def _queue_result(self, result):
         if result is None:
-            g.write(b'v')
+            self._outq.append(b'v')
         elif isinstance(result, Ptr):
-            g.write(b'p' + _pack_one_ptr(result.addr))
+            self._outq.append(_pack_cmd_ptr(b'p', result.addr))
         elif isinstance(result, float):
-            g.write(b'f' + _pack_one_double(result))
+            self._outq.append(_pack_cmd_double(b'f', result))
         else:
-            g.write(b'i' + _pack_one_longlong(result))
-        g.flush()
+            self._outq.append(_pack_cmd_longlong(b'i', result))
+
+    def write_result(self, result):
+        self._queue_result(result)
+        self.flush()
 
     def set_errno(self, err):
-        g = self.child_stdin
-        g.write(b"E" + _pack_one_int(err))
-        # g.flush() not necessary here
+        self._outq.append(_pack_cmd_int(b"E", err))
+        # self.flush() not necessary here
+
+    def _request_malloc(self, bytes_data):
+        if not isinstance(bytes_data, bytes):
+            bytes_data = memoryview(bytes_data).cast('B')
+        if (self.stats_bytes_to_child + len(bytes_data) >
+                self.max_bytes_to_child):
+            raise BudgetExceeded('bytes_to_child', self.max_bytes_to_child)
+        outq = self._outq
+        outq.append(_pack_cmd_ptr(b"M", len(bytes_data)))
+        outq.append(bytes_data)
+        self.stats_bytes_to_child += len(bytes_data)
 
     def malloc(self, bytes_data):
-        assert isinstance(bytes_data, bytes)
-        g = self.child_stdin
-        g.write(b"M" + _pack_one_ptr(len(bytes_data)))
-        g.write(bytes_data)
-        g.flush()
-        addr = _unpack_one_ptr(self._read(ptr_size))[0]
-        return Ptr(addr)
+        self._request_malloc(bytes_data)
+        self.flush()
+        buf, pos = self.read_arguments(ptr_size)
+        return Ptr(_unpack_from_one_ptr(buf, pos)[0])
 
     def free(self, ptr):
-        g = self.child_stdin
-        g.write(b"F" + _pack_one_ptr(ptr.addr))
-        # g.flush() not necessary here
+        self._outq.append(_pack_cmd_ptr(b"F", ptr.addr))
+        # self.flush() not necessary here
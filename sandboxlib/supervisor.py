@@ -0,0 +1,230 @@
+"""Runs many sandboxed jobs in parallel with a multiprocessing pool.
+
+A job is a dict with the following keys:
+
+    'executable'   the real path to the sandboxed executable
+    'args'         the argument list, starting with args[0]
+    'vfs'          optional dict {virtual name: real directory}, mounted
+                   read-only as top-level directories of the virtual root;
+                   the names 'tmp' and 'lib' are reserved
+    'lib_path'     optional real directory that contains lib-python and
+                   lib_pypy; mounted as '/lib' (see vfs_pypy_lib_directory),
+                   and args[0] is replaced with '/lib/pypy'
+    'stdin'        optional bytes (or str, encoded as utf-8) to give as stdin
+    'tmp_quota'    optional [max_bytes, max_inodes]: if given, '/tmp' is a
+                   fresh writable tmpfs.TmpDir with these limits; otherwise
+                   it is an empty read-only directory
+    'budget'       optional dict of keyword arguments for
+                   budget.ExecutionBudget, e.g. {'wall_clock': 10.0}; if
+                   a limit is reached, the job is killed and the 'reason'
+                   is returned as the 'termination' of the result
+    'id'           optional identifier, returned with the result
+
+The result of a job is a dict with the keys 'id', 'exitcode', 'output',
+'error', 'rusage', 'termination', 'start' and 'duration'.  If the job
+could not be run at all, 'termination' is 'error' and 'error' describes
+the exception.
+
+Each worker process reuses the same VirtualizedProc subclass, and the same
+VFS tree for jobs with the same 'vfs' and 'lib_path', across all the jobs
+it runs; it keeps the VFS trees of the last 'MAX_VFS_ROOTS' combinations.
+"""
+
+import time, threading
+import multiprocessing
+from collections import OrderedDict
+from .virtualizedproc import VirtualizedProc
+from .mix_pypy import MixPyPy
+from .mix_vfs import MixVFS, Dir, RealDir
+from .tmpfs import TmpDir
+from .mix_grab_output import MixGrabOutput
+from .mix_accept_input import MixAcceptInput
+from .budget import ExecutionBudget
+from .runner import SandboxRunner
+
+
+class SupervisedProc(MixPyPy, MixVFS, MixGrabOutput, MixAcceptInput,
+                     VirtualizedProc):
+    virtual_cwd = "/tmp"
+    vfs_root = Dir({'tmp': Dir({})})
+
+
+# ---------- in the worker processes ----------
+
+MAX_VFS_ROOTS = 32
+RESERVED_VFS_NAMES = ('tmp', 'lib')
+
+_worker_class = None
+_worker_vfs_roots = OrderedDict()     # LRU of the VFS trees
+
+def _init_worker(vproc_class):
+    global _worker_class
+    _worker_class = vproc_class
+    vproc_class.dispatch_table()      # compile it once per worker
+
+def _get_vfs_root(job):
+    vfs = job.get('vfs') or {}
+    lib_path = job.get('lib_path')
+    key = (tuple(sorted(vfs.items())), lib_path)
+    try:
+        root = _worker_vfs_roots[key]
+    except KeyError:
+        pass
+    else:
+        _worker_vfs_roots.move_to_end(key)
+        return root
+    for name in RESERVED_VFS_NAMES:
+        if name in vfs:
+            raise ValueError("%r is a reserved name in 'vfs'" % (name,))
+    entries = {'tmp': Dir({})}
+    for name, path in vfs.items():
+        entries[name] = RealDir(path)
+    if lib_path is not None:
+        entries['lib'] = MixVFS.vfs_pypy_lib_directory(lib_path)
+    root = _worker_vfs_roots[key] = Dir(entries)
+    while len(_worker_vfs_roots) > MAX_VFS_ROOTS:
+        _worker_vfs_roots.popitem(last=False)
+    return root
+
+def _get_job_vfs_root(job):
+    root = _get_vfs_root(job)
+    if job.get('tmp_quota') is not None:
+        # a new root, with the same nodes except a private '/tmp'
+        max_bytes, max_inodes = job['tmp_quota']
+        entries = dict(root.entries)
+        entries['tmp'] = TmpDir(max_bytes, max_inodes)
+        root = Dir(entries)
+    return root
+
+def _rusage_dict(rusage):
+    return {'utime': rusage.ru_utime,
+            'stime': rusage.ru_stime,
+            'maxrss': rusage.ru_maxrss}
+
+def _new_result(job, start):
+    return {'id': job.get('id'), 'exitcode': None, 'output': None,
+            'error': None, 'rusage': None, 'termination': None,
+            'start': start, 'duration': 0.0}
+
+def _run_job(job):
+    start = time.time()
+    result = _new_result(job, start)
+    args = list(job['args'])
+    if job.get('lib_path') is not None:
+        args[0] = '/lib/pypy'
+    stdin_data = job.get('stdin') or b''
+    if not isinstance(stdin_data, bytes):
+        stdin_data = stdin_data.encode('utf-8')
+    budget = None
+    if job.get('budget') is not None:
+        budget = ExecutionBudget(**job['budget'])
+    runner = SandboxRunner(_worker_class, job['executable'], args,
+                           env={}, budget=budget,
+                           vproc_kwds={'vfs_root': _get_job_vfs_root(job)})
+    vproc = runner.start()
+    vproc.input_stdin = stdin_data
+    run_result = runner.run()
+    if run_result.error is not None:
+        e = run_result.error
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    result['termination'] = run_result.termination
+    result['output'] = run_result.output
+    result['exitcode'] = run_result.exitcode
+    result['rusage'] = _rusage_dict(run_result.rusage)
+    result['duration'] = time.time() - start
+    return result
+
+
+# ---------- in the supervisor process ----------
+
+def _percentiles(values, percents=(50, 90, 99)):
+    result = {}
+    values = sorted(values)
+    for p in percents:
+        if values:
+            index = min(len(values) - 1, int(len(values) * p / 100.0))
+            result['p%d' % p] = values[index]
+        else:
+            result['p%d' % p] = None
+    return result
+
+
+class Supervisor(object):
+    """Accepts jobs with submit() and runs them on a pool of worker
+    processes, by default one per core.  The results are collected in
+    'self.results', in the order in which they finish, and passed to the
+    optional 'on_result' callback (called from a background thread).
+    """
+
+    def __init__(self, processes=None, vproc_class=SupervisedProc,
+                 on_result=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.on_result = on_result
+        self.results = []
+        self._pool = multiprocessing.Pool(processes,
+                                          initializer=_init_worker,
+                                          initargs=(vproc_class,))
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._latencies = []      # from submit() to the result
+        self._run_times = []      # inside the worker
+
+    def submit(self, job):
+        """Queue a job, given as a dict (see the module docstring)."""
+        submit_time = time.time()
+        def callback(result):
+            result['latency'] = time.time() - submit_time
+            with self._lock:
+                self._completed += 1
+                if result['error'] is not None or result['exitcode'] != 0:
+                    self._failed += 1
+                self._latencies.append(result['latency'])
+                self._run_times.append(result['duration'])
+                self.results.append(result)
+            if self.on_result is not None:
+                self.on_result(result)
+        def error_callback(exc):
+            # the job could not even be started (or the worker crashed)
+            result = _new_result(job, submit_time)
+            result['error'] = '%s: %s' % (type(exc).__name__, exc)
+            result['termination'] = 'error'
+            callback(result)
+        with self._lock:
+            self._submitted += 1
+        self._pool.apply_async(_run_job, (job,), callback=callback,
+                               error_callback=error_callback)
+
+    def metrics(self):
+        """Return a snapshot of the metrics, as a dict.  'running' and
+        'queue_depth' are estimates: the workers don't report when they
+        start a job, so they assume that every worker process is busy as
+        long as there are more pending jobs than worker processes."""
+        with self._lock:
+            elapsed = time.time() - self._start_time
+            pending = self._submitted - self._completed
+            return {
+                'elapsed': elapsed,
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'failed': self._failed,
+                'running': min(pending, self.processes),
+                'queue_depth': max(0, pending - self.processes),
+                'throughput': self._completed / elapsed if elapsed else 0.0,
+                'latency': _percentiles(self._latencies),
+                'run_time': _percentiles(self._run_times),
+            }
+
+    def join(self):
+        """Wait until all submitted jobs are finished, and stop the
+        workers."""
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
@@ -0,0 +1,339 @@
+"""A writable directory kept in memory, for the scratch files of a
+sandboxed process.
+
+    class MyProc(MixVFS, VirtualizedProc):
+        ...
+
+    tmp = TmpDir(max_bytes=16*1024*1024, max_inodes=1000)
+    vp = MyProc(popen.stdin, popen.stdout,
+                vfs_root=Dir({'lib': ..., 'tmp': tmp}))
+    vp.run()
+    for path, f in tmp.walk():
+        print(path, f.getsize())
+
+A TmpDir and all the files and directories created inside it share the
+same quota, so a fresh TmpDir should normally be given to each sandboxed
+process.  The content of files is stored as a list of chunks, so that
+appending to a file never copies what is already there; getchunks()
+returns the content without copying it either.
+"""
+
+import os, errno, stat, time, itertools
+from .mix_vfs import Dir, FSObject
+from ._commonstruct_cffi import ffi
+
+CHUNK_SIZE = 65536
+
+_tmp_ino_counter = itertools.count(1)
+
+
+class TmpQuota(object):
+    """The number of bytes and inodes used by a tree of tmp nodes, and the
+    limits on them."""
+
+    def __init__(self, max_bytes, max_inodes):
+        self.max_bytes = max_bytes
+        self.max_inodes = max_inodes
+        self.bytes_used = 0
+        self.inodes_used = 0
+
+    def charge(self, nbytes=0, ninodes=0):
+        if (self.bytes_used + nbytes > self.max_bytes or
+                self.inodes_used + ninodes > self.max_inodes):
+            raise OSError(errno.ENOSPC, "tmpfs quota exceeded")
+        self.bytes_used += nbytes
+        self.inodes_used += ninodes
+
+    def release(self, nbytes=0, ninodes=0):
+        self.bytes_used -= nbytes
+        self.inodes_used -= ninodes
+
+
+class TmpNode(object):
+    # Mixin for the nodes of a tmpfs.  They are owned by the virtual user,
+    # and never cached by PathCache because they change.
+    read_only = False
+    cacheable = False
+
+    def _init_tmp(self, quota, mode):
+        self.quota = quota
+        self.kind = self.kind | (mode & 0o111)
+        self.mtime = int(time.time())
+        self._st_ino = (hash(('tmpfs', next(_tmp_ino_counter)))
+                        & 0x7fffffffffffffff) or 1
+
+    def getmtime(self):
+        return self.mtime
+
+    def stat_bytes(self):
+        return ffi.buffer(self.stat())[:]
+
+
+class TmpDir(TmpNode, Dir):
+    """A writable directory in memory.  Only the top-level TmpDir should be
+    created directly; it makes a TmpQuota with the given limits, unless
+    'quota' is specified."""
+
+    def __init__(self, max_bytes=16*1024*1024, max_inodes=1024, quota=None,
+                 mode=0o755, parent=None):
+        if quota is None:
+            quota = TmpQuota(max_bytes, max_inodes)
+        Dir.__init__(self, {})
+        self._init_tmp(quota, mode)
+        self.parent = parent
+
+    def __repr__(self):
+        return '<TmpDir %d entries>' % (len(self.entries),)
+
+    def _check_new(self, name):
+        if name in self.entries:
+            raise OSError(errno.EEXIST, name)
+
+    def _touch(self):
+        self.mtime = int(time.time())
+
+    def create(self, name, mode):
+        self._check_new(name)
+        self.quota.charge(ninodes=1)
+        node = self.entries[name] = TmpFile(self.quota, mode)
+        self._touch()
+        return node
+
+    def mkdir(self, name, mode):
+        self._check_new(name)
+        self.quota.charge(ninodes=1)
+        node = self.entries[name] = TmpDir(quota=self.quota, mode=mode,
+                                           parent=self)
+        self._touch()
+        return node
+
+    def unlink(self, name):
+        node = self.join(name)
+        if node.is_dir():
+            raise OSError(errno.EISDIR, name)
+        del self.entries[name]
+        node._unlinked()
+        self._touch()
+
+    def rmdir(self, name):
+        node = self.join(name)
+        if not node.is_dir():
+            raise OSError(errno.ENOTDIR, name)
+        if node.entries:
+            raise OSError(errno.ENOTEMPTY, name)
+        del self.entries[name]
+        node.parent = None
+        self.quota.release(ninodes=1)
+        self._touch()
+
+    def rename(self, name, new_dir, new_name):
+        node = self.join(name)
+        if not isinstance(new_dir, TmpDir) or new_dir.quota is not self.quota:
+            raise OSError(errno.EXDEV, new_name)
+        old = new_dir.entries.get(new_name)
+        if old is node:
+            return
+        if node.is_dir():
+            d = new_dir
+            while d is not None:
+                if d is node:
+                    raise OSError(errno.EINVAL, "moving a directory inside "
+                                                "itself")
+                d = d.parent
+            if old is not None:
+                new_dir.rmdir(new_name)
+            node.parent = new_dir
+        elif old is not None:
+            new_dir.unlink(new_name)
+        del self.entries[name]
+        new_dir.entries[new_name] = node
+        self._touch()
+        new_dir._touch()
+
+    def walk(self, prefix=''):
+        """Yield (relative path, TmpFile) for all the files in this tree."""
+        for name in self.keys():
+            node = self.entries[name]
+            path = prefix + name
+            if node.is_dir():
+                for item in node.walk(path + '/'):
+                    yield item
+            else:
+                yield path, node
+
+
+class TmpFile(TmpNode, FSObject):
+    kind = stat.S_IFREG
+
+    def __init__(self, quota, mode=0o644):
+        self._init_tmp(quota, mode)
+        self.chunks = []
+        self.size = 0
+        self.nlink = 1
+        self.nopen = 0
+
+    def __repr__(self):
+        return '<TmpFile %d bytes>' % (self.size,)
+
+    def getsize(self):
+        return self.size
+
+    def getchunks(self):
+        """Return the content as a list of memoryviews, without copying.
+        They are only valid until the next change of the file."""
+        return [memoryview(chunk) for chunk in self.chunks]
+
+    def getvalue(self):
+        return b''.join(self.chunks)
+
+    def open(self, flags=0):
+        self.nopen += 1
+        return OpenTmpFile(self, flags)
+
+    def _closed(self):
+        self.nopen -= 1
+        self._maybe_free()
+
+    def _unlinked(self):
+        self.nlink = 0
+        self._maybe_free()
+
+    def _maybe_free(self):
+        if self.nlink == 0 and self.nopen == 0:
+            self.quota.release(self.size, 1)
+            self.chunks = []
+            self.size = 0
+
+    def _resize_chunk(self, index, offset, tail=b''):
+        # replace chunks[index][offset:] with 'tail'.  A chunk can't be
+        # resized while memoryviews of it are alive (e.g. returned by read()
+        # or getchunks()); it is copied in that case.
+        if index == len(self.chunks):
+            self.chunks.append(bytearray())
+        chunk = self.chunks[index]
+        try:
+            chunk[offset:] = tail
+        except BufferError:
+            chunk = self.chunks[index] = bytearray(chunk[:offset])
+            chunk += tail
+
+    def read(self, pos, count):
+        """Read up to 'count' bytes at 'pos'.  Returns a memoryview slice
+        of a chunk if possible."""
+        end = min(pos + count, self.size)
+        if pos >= end:
+            return b''
+        index, offset = divmod(pos, CHUNK_SIZE)
+        if offset + (end - pos) <= CHUNK_SIZE:
+            return memoryview(self.chunks[index])[offset:offset + end - pos]
+        pieces = []
+        while pos < end:
+            index, offset = divmod(pos, CHUNK_SIZE)
+            n = min(CHUNK_SIZE - offset, end - pos)
+            pieces.append(self.chunks[index][offset:offset + n])
+            pos += n
+        return b''.join(pieces)
+
+    def _fill_zeroes(self, new_size):
+        # extend the file with zeroes up to 'new_size'; the quota must
+        # already be charged
+        size = self.size
+        while size < new_size:
+            index, offset = divmod(size, CHUNK_SIZE)
+            n = min(CHUNK_SIZE - offset, new_size - size)
+            self._resize_chunk(index, offset, bytes(n))
+            size += n
+        self.size = new_size
+
+    def write(self, pos, data):
+        data = memoryview(data).cast('B')
+        end = pos + len(data)
+        if end > self.size:
+            self.quota.charge(end - self.size)
+            if pos > self.size:
+                self._fill_zeroes(pos)
+        i = 0
+        while pos < end:
+            index, offset = divmod(pos, CHUNK_SIZE)
+            n = min(CHUNK_SIZE - offset, end - pos)
+            if (index < len(self.chunks) and
+                    offset + n <= len(self.chunks[index])):
+                self.chunks[index][offset:offset + n] = data[i:i + n]
+            else:
+                # this is the last chunk, and it grows
+                self._resize_chunk(index, offset, data[i:i + n])
+            pos += n
+            i += n
+        self.size = max(self.size, end)
+        self.mtime = int(time.time())
+        return len(data)
+
+    def truncate(self, length):
+        if length < 0:
+            raise OSError(errno.EINVAL, "negative length")
+        if length > self.size:
+            self.quota.charge(length - self.size)
+            self._fill_zeroes(length)
+        elif length < self.size:
+            index, offset = divmod(length, CHUNK_SIZE)
+            del self.chunks[index + (offset > 0):]
+            if offset:
+                self._resize_chunk(index, offset)
+            self.quota.release(self.size - length)
+            self.size = length
+        self.mtime = int(time.time())
+
+
+class OpenTmpFile(object):
+    """An open file descriptor for a TmpFile.  The open flags are the ones
+    of os.open(); O_APPEND makes every write go to the end of the file."""
+
+    def __init__(self, node, flags):
+        accmode = flags & (os.O_RDONLY | os.O_WRONLY | os.O_RDWR)
+        self.node = node
+        self.pos = 0
+        self.readable = accmode != os.O_WRONLY
+        self.vfs_writable = accmode != os.O_RDONLY
+        self.append = bool(flags & os.O_APPEND)
+        self.closed = False
+
+    def read(self, count=-1):
+        if not self.readable:
+            raise OSError(errno.EBADF, "file not open for reading")
+        if count < 0:
+            count = self.node.size
+        data = self.node.read(self.pos, count)
+        self.pos += len(data)
+        return data
+
+    def write(self, data):
+        if not self.vfs_writable:
+            raise OSError(errno.EBADF, "file not open for writing")
+        if self.append:
+            self.pos = self.node.size
+        n = self.node.write(self.pos, data)
+        self.pos += n
+        return n
+
+    def truncate(self, length):
+        if not self.vfs_writable:
+            raise OSError(errno.EINVAL, "file not open for writing")
+        self.node.truncate(length)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.node.size
+        if offset < 0:
+            raise OSError(errno.EINVAL, "negative seek position")
+        self.pos = offset
+        return offset
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.node._closed()
@@ -0,0 +1,181 @@
+"""Virtual clocks, which give the time seen by the sandboxed process.
+
+Assign one to the 'virtual_clock' attribute of a VirtualizedProc (of the
+instance, because clocks have state):
+
+    vp = MyProc(popen.stdin, popen.stdout)
+    vp.virtual_clock = MonotonicClock()
+
+The policies are:
+
+    FrozenClock(t)            the time is always 't' and never advances;
+                              the default, with t = virtual_time
+    RealClock()               the real time and the real monotonic clock
+    MonotonicClock(start)     a clock that starts at 'start' (by default
+                              virtual_time) and advances like the real
+                              monotonic clock, so that the sandboxed process
+                              can measure durations but not see the date
+    OffsetClock(offset)       the real time plus 'offset' seconds
+    StepClock(start, step)    deterministic: advances by 'step' seconds at
+                              every reading of any clock
+
+Each clock gives the real time (CLOCK_REALTIME, time(), gettimeofday()),
+the monotonic time (CLOCK_MONOTONIC), and the CPU time of the process
+(CLOCK_PROCESS_CPUTIME_ID, clock(), times(), getrusage()).  The clocks
+that follow the real time report the CPU time of the subprocess, read
+from /proc/<pid>/stat if the VirtualizedProc has a 'child_pid' (set by
+SandboxRunner), and else the time elapsed since the clock was created.
+"""
+
+import os, time, struct
+from ._commonstruct_cffi import ffi
+
+# Aug 1st, 2019: the default time of VirtualizedProc
+DEFAULT_TIME = time.mktime((2019, 8, 1, 0, 0, 0, 0, 0, 0))
+
+try:
+    clock_ticks = os.sysconf('SC_CLK_TCK')
+except (AttributeError, ValueError, OSError):
+    clock_ticks = 100
+
+
+def read_child_cputimes(pid):
+    """Return (user time, system time) in seconds of the process 'pid',
+    from /proc/<pid>/stat, or None if not available."""
+    try:
+        with open('/proc/%d/stat' % (pid,), 'rb') as f:
+            data = f.read()
+        # the fields after the command name, which is in parentheses;
+        # utime and stime are the fields number 14 and 15
+        fields = data[data.rindex(b')') + 2:].split()
+        return (int(fields[11]) / float(clock_ticks),
+                int(fields[12]) / float(clock_ticks))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def make_packer(ctype, fields):
+    """Return a struct.Struct to write the integer 'fields' of the C type
+    'ctype', zero-filling the rest.  A field is a name, or a tuple of names
+    for a field of a nested struct."""
+    codes = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}
+    fmt = ['=']
+    pos = 0
+    for field in fields:
+        path = field if isinstance(field, tuple) else (field,)
+        offset = ffi.offsetof(ctype, *path)
+        ftype = ffi.typeof(ctype)
+        for name in path:
+            ftype = dict(ftype.fields)[name].type
+        size = ffi.sizeof(ftype)
+        code = codes[size]
+        if int(ffi.cast(ftype, -1)) > 0:
+            code = code.upper()
+        assert offset >= pos
+        fmt.append('%dx%s' % (offset - pos, code))
+        pos = offset + size
+    fmt.append('%dx' % (ffi.sizeof(ctype) - pos))
+    return struct.Struct(''.join(fmt))
+
+
+class VirtualClock(object):
+    """Abstract base class of the clocks, which must define realtime()
+    and monotonic().  By default the CPU times are zero."""
+    resolution = 1e-9
+
+    def __new__(cls, *args, **kwds):
+        if (cls.realtime is VirtualClock.realtime or
+                cls.monotonic is VirtualClock.monotonic):
+            raise TypeError("%s is abstract: it must define realtime() "
+                            "and monotonic()" % (cls.__name__,))
+        return object.__new__(cls)
+
+    def realtime(self):
+        """Return the real time, in seconds since the Epoch."""
+        raise TypeError("%s does not define realtime()" % (
+            type(self).__name__,))
+
+    def monotonic(self):
+        """Return the monotonic time, in seconds."""
+        raise TypeError("%s does not define monotonic()" % (
+            type(self).__name__,))
+
+    def cputimes(self, vproc):
+        """Return (user time, system time) of the sandboxed process."""
+        return (0.0, 0.0)
+
+
+class FrozenClock(VirtualClock):
+    """The time never advances: the real time is 't', and the monotonic
+    and CPU times are zero."""
+
+    def __init__(self, t=DEFAULT_TIME):
+        self.t = t
+
+    def realtime(self):
+        return self.t
+
+    def monotonic(self):
+        return 0.0
+
+
+class RealClock(VirtualClock):
+
+    def __init__(self):
+        self._start = time.monotonic()
+
+    def realtime(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def cputimes(self, vproc):
+        pid = vproc.child_pid
+        if pid is not None:
+            result = read_child_cputimes(pid)
+            if result is not None:
+                return result
+        return (time.monotonic() - self._start, 0.0)
+
+
+class MonotonicClock(RealClock):
+
+    def __init__(self, start=DEFAULT_TIME):
+        RealClock.__init__(self)
+        self.start = start
+
+    def realtime(self):
+        return self.start + self.monotonic()
+
+    def monotonic(self):
+        return time.monotonic() - self._start
+
+
+class OffsetClock(RealClock):
+
+    def __init__(self, offset):
+        RealClock.__init__(self)
+        self.offset = offset
+
+    def realtime(self):
+        return time.time() + self.offset
+
+
+class StepClock(VirtualClock):
+
+    def __init__(self, start=DEFAULT_TIME, step=1e-6):
+        self.start = start
+        self.step = step
+        self.resolution = step
+        self.steps = 0
+
+    def realtime(self):
+        return self.start + self.monotonic()
+
+    def monotonic(self):
+        self.steps += 1
+        return self.steps * self.step
+
+    def cputimes(self, vproc):
+        return (self.steps * self.step, 0.0)
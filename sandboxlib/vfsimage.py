@@ -0,0 +1,312 @@
+"""Packed images of directory trees, for use in the virtual file system.
+
+Serving a big tree like lib-python with RealDir costs host listdir(),
+stat() and open() calls for every sandboxed process.  Instead, the tree
+can be packed once into a single image file:
+
+    python -m sandboxlib.vfsimage --exclude=.pyc /path/pypy/lib-python lp.img
+
+and then used in the vfs_root of a MixVFS:
+
+    vfs_root = Dir({'lib-python': open_image('lp.img').root(), ...})
+
+The image is mmap()ed once per controller process, and shared between all
+the sandboxed processes that it controls.  Looking up a name is a binary
+search in the image, and reading a file returns a memoryview of the mapped
+pages, which is sent to the subprocess without copying.
+
+Layout of an image file (all integers are little-endian):
+
+    header     magic, version, number of entries, offsets of the sections
+    entries    one fixed-size record per file or directory, the root first;
+               the entries for the children of a directory are contiguous
+               and sorted by name
+    names      the utf-8 names of all the entries, concatenated
+    data       the content of all the files, concatenated
+"""
+
+import os, sys, errno, stat, struct, mmap, threading
+from .mix_vfs import Dir, File, MemoryFile
+from ._commonstruct_cffi import lib
+
+MAGIC = b'SBXVFSI\x00'
+VERSION = 1
+
+# magic, version, num_entries, names_offset, names_size, data_offset
+_header = struct.Struct('<8sIIQQQ')
+# name_offset, name_size, st_mode, st_size, st_mtime, first, count:
+# for a directory, 'first' is the index of the first child entry and
+# 'count' the number of children; for a file, 'first' is the offset of
+# the data from 'data_offset' and 'count' is unused
+_entry = struct.Struct('<QIIQqQQ')
+
+
+class ImageError(Exception):
+    pass
+
+
+# ---------- building images ----------
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _walk_tree(root_path, show_dotfiles, follow_links, exclude):
+    # Returns a list [(path, name, st, children indexes)] in the order of
+    # the entries in the image, i.e. breadth-first with sorted children.
+    exclude = tuple([excl.lower() for excl in exclude])
+    st = os.stat(root_path)
+    entries = [(root_path, '', st, None)]
+    i = 0
+    while i < len(entries):
+        path, name, st, _ = entries[i]
+        if stat.S_ISDIR(st.st_mode):
+            children = []
+            for child in sorted(os.listdir(path),
+                                key=lambda n: n.encode('utf-8')):
+                if child.startswith('.') and not show_dotfiles:
+                    continue
+                if exclude and child.lower().endswith(exclude):
+                    continue
+                child_path = os.path.join(path, child)
+                if follow_links:
+                    child_st = os.stat(child_path)
+                else:
+                    child_st = os.lstat(child_path)
+                if not (stat.S_ISDIR(child_st.st_mode) or
+                        stat.S_ISREG(child_st.st_mode)):
+                    continue     # ignore symlinks and special files
+                children.append((child_path, child, child_st))
+            first = len(entries)
+            entries[i] = (path, name, st, (first, len(children)))
+            for child_path, child, child_st in children:
+                entries.append((child_path, child, child_st, None))
+        i += 1
+    return entries
+
+def build_image(root_path, image_path, show_dotfiles=False,
+                follow_links=False, exclude=[], processes=None):
+    """Pack the real directory 'root_path' into the file 'image_path'.  The
+    options 'show_dotfiles', 'follow_links' and 'exclude' have the same
+    meaning as for RealDir.  If 'processes' is given, the files are read
+    by a pool of that many processes.
+    """
+    entries = _walk_tree(root_path, show_dotfiles, follow_links, exclude)
+
+    names = []
+    names_size = 0
+    records = []
+    data_size = 0
+    file_paths = []
+    for path, name, st, children in entries:
+        name = name.encode('utf-8')
+        if children is not None:
+            first, count = children
+            size = 0
+        else:
+            first, count = data_size, 0
+            size = st.st_size
+            data_size += size
+            file_paths.append((path, size))
+        records.append(_entry.pack(names_size, len(name), st.st_mode, size,
+                                   int(st.st_mtime), first, count))
+        names.append(name)
+        names_size += len(name)
+
+    names_offset = _header.size + _entry.size * len(records)
+    data_offset = names_offset + names_size
+    data_offset = (data_offset + mmap.PAGESIZE - 1) & ~(mmap.PAGESIZE - 1)
+
+    if processes is not None:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(processes)
+        contents = executor.map(_read_file, [p for p, _ in file_paths],
+                                chunksize=64)
+    else:
+        executor = None
+        contents = (_read_file(p) for p, _ in file_paths)
+
+    tmp_path = image_path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(_header.pack(MAGIC, VERSION, len(records), names_offset,
+                                 names_size, data_offset))
+            f.write(b''.join(records))
+            f.write(b''.join(names))
+            f.write(b'\x00' * (data_offset - f.tell()))
+            for (path, size), data in zip(file_paths, contents):
+                if len(data) != size:
+                    raise ImageError("file changed while building the "
+                                     "image: %r" % (path,))
+                f.write(data)
+        os.rename(tmp_path, image_path)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+# ---------- using images ----------
+
+class VFSImage(object):
+    """An image file, mapped in memory."""
+
+    def __init__(self, image_path):
+        self.path = image_path
+        with open(image_path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, self.num_entries, self.names_offset,
+                names_size, self.data_offset) = _header.unpack_from(self.mm)
+        except struct.error:
+            raise ImageError("%r: not a VFS image" % (image_path,))
+        if magic != MAGIC:
+            raise ImageError("%r: not a VFS image" % (image_path,))
+        if version != VERSION:
+            raise ImageError("%r: unsupported version %d" % (image_path,
+                                                             version))
+        self._ino_base = hash((st.st_dev, st.st_ino))
+        self._nodes = [None] * self.num_entries
+
+    def entry(self, index):
+        return _entry.unpack_from(self.mm, _header.size + _entry.size * index)
+
+    def name(self, index):
+        name_offset, name_size = _entry.unpack_from(
+            self.mm, _header.size + _entry.size * index)[:2]
+        start = self.names_offset + name_offset
+        return self.mm[start:start + name_size]
+
+    def node(self, index):
+        """Return the ImageDir or ImageFile for the given entry.  There is
+        only one node object per entry."""
+        node = self._nodes[index]
+        if node is None:
+            st_mode = self.entry(index)[2]
+            if stat.S_ISDIR(st_mode):
+                node = ImageDir(self, index)
+            else:
+                node = ImageFile(self, index)
+            self._nodes[index] = node
+        return node
+
+    def root(self):
+        return self.node(0)
+
+
+_images = {}
+_images_lock = threading.Lock()
+
+def open_image(image_path):
+    """Return the VFSImage for the given file, mapping it only once per
+    process."""
+    key = os.path.realpath(image_path)
+    with _images_lock:
+        try:
+            return _images[key]
+        except KeyError:
+            image = _images[key] = VFSImage(key)
+            return image
+
+
+class ImageNode(object):
+    # Mixin for the nodes of an image
+    def __init__(self, image, index):
+        (_, _, st_mode, self.size, self.mtime,
+            self.first, self.count) = image.entry(index)
+        self.image = image
+        self.index = index
+        self.kind = stat.S_IFMT(st_mode) | (st_mode & 0o111)
+        self._st_ino = (hash((image._ino_base, index))
+                        & 0x7fffffffffffffff) or 1
+
+    def getmtime(self):
+        return self.mtime
+
+
+class ImageDir(ImageNode, Dir):
+    def __repr__(self):
+        return '<ImageDir %s:%d>' % (self.image.path, self.index)
+
+    def keys(self):
+        image = self.image
+        return [image.name(i).decode('utf-8')
+                for i in range(self.first, self.first + self.count)]
+
+    def scandir(self):
+        image = self.image
+        result = []
+        for i in range(self.first, self.first + self.count):
+            node = image.node(i)
+            d_type = lib.DT_DIR if node.is_dir() else lib.DT_REG
+            result.append((image.name(i).decode('utf-8'), d_type,
+                           node.getino()))
+        return result
+
+    def join(self, name):
+        image = self.image
+        key = name.encode('utf-8')
+        lo = self.first
+        hi = self.first + self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if image.name(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.first + self.count and image.name(lo) == key:
+            return image.node(lo)
+        raise OSError(errno.ENOENT, name)
+
+
+class ImageFile(ImageNode, File):
+    def __repr__(self):
+        return '<ImageFile %s:%d>' % (self.image.path, self.index)
+
+    def getsize(self):
+        return self.size
+
+    def open(self):
+        start = self.image.data_offset + self.first
+        return MemoryFile(memoryview(self.image.mm)[start:start + self.size])
+
+
+def main(argv):
+    """Usage: python -m sandboxlib.vfsimage [options] <directory> <image>
+
+Options:
+    --exclude=END     ignore the files whose name ends with END (several
+                      --exclude options can be given)
+    --show-dotfiles   include the files whose name starts with '.'
+    --follow-links    follow symlinks instead of ignoring them
+    --processes=N     read the files with N processes
+"""
+    from getopt import getopt
+    options, arguments = getopt(argv, 'h',
+        ['exclude=', 'show-dotfiles', 'follow-links', 'processes=', 'help'])
+    if len(arguments) != 2:
+        sys.stderr.write(main.__doc__)
+        return 2
+    kwds = {'exclude': []}
+    for option, value in options:
+        if option == '--exclude':
+            kwds['exclude'].append(value)
+        elif option == '--show-dotfiles':
+            kwds['show_dotfiles'] = True
+        elif option == '--follow-links':
+            kwds['follow_links'] = True
+        elif option == '--processes':
+            kwds['processes'] = int(value)
+        elif option in ['-h', '--help']:
+            sys.stderr.write(main.__doc__)
+            return 2
+        else:
+            raise ValueError(option)
+    build_image(arguments[0], arguments[1], **kwds)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
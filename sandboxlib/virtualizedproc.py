@@ -1,8 +1,9 @@
-import sys, types
-import os, errno, time
+import sys, types, inspect
+import os, errno, time, struct, resource
 from . import sandboxio
 from .sandboxio import Ptr, NULL, ptr_size
-from ._commonstruct_cffi import ffi
+from ._commonstruct_cffi import ffi, lib
+from . import vclock
 
 
 def signature(sig):
@@ -12,6 +13,7 @@ def signature(sig):
     return decorator
 
 FATAL = object()
+_NO_RESULT = object()    # returned when no result must be sent back
 
 def sigerror(sig, error=FATAL, returns=FATAL):
     if error is FATAL:
@@ -51,6 +53,39 @@ def sigerror(sig, error=FATAL, returns=FATAL):
     return s_error
 
 
+# precomputed packing of the structures written by the time functions
+_pack_time_t = struct.Struct(
+    '=' + {4: 'i', 8: 'q'}[ffi.sizeof("time_t")]).pack
+_pack_timeval = vclock.make_packer(
+    "struct timeval", ["tv_sec", "tv_usec"]).pack
+_pack_timespec = vclock.make_packer(
+    "struct timespec", ["tv_sec", "tv_nsec"]).pack
+_pack_tms = vclock.make_packer(
+    "struct tms", ["tms_utime", "tms_stime"]).pack
+_pack_rusage = vclock.make_packer(
+    "struct rusage", [("ru_utime", "tv_sec"), ("ru_utime", "tv_usec"),
+                      ("ru_stime", "tv_sec"), ("ru_stime", "tv_usec")]).pack
+
+def _clock_ids(*names):
+    return frozenset([getattr(time, name) for name in names
+                      if hasattr(time, name)])
+_realtime_clocks = _clock_ids('CLOCK_REALTIME', 'CLOCK_TAI')
+_monotonic_clocks = _clock_ids('CLOCK_MONOTONIC', 'CLOCK_MONOTONIC_RAW',
+                               'CLOCK_BOOTTIME', 'CLOCK_UPTIME',
+                               'CLOCK_UPTIME_RAW')
+_cputime_clocks = _clock_ids('CLOCK_PROCESS_CPUTIME_ID',
+                             'CLOCK_THREAD_CPUTIME_ID')
+
+RUSAGE_SELF = getattr(resource, 'RUSAGE_SELF', 0)
+RUSAGE_CHILDREN = getattr(resource, 'RUSAGE_CHILDREN', -1)
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)
+
+
+async def _await_no_result(awaitable):
+    await awaitable
+    return _NO_RESULT
+
+
 class VirtualizedProc(object):
     """Controls a virtualized sandboxed process, which is given a custom
     view on the filesystem and a custom environment.
@@ -60,13 +95,21 @@ class VirtualizedProc(object):
     virtual_gid = 1000
     virtual_pid = 4200
     virtual_cwd = "/"
-    virtual_time = time.mktime((2019, 8, 1, 0, 0, 0, 0, 0, 0))
+    virtual_time = vclock.DEFAULT_TIME
     # ^^^ Aug 1st, 2019.  Subclasses can overwrite with a property
     # to get the current time dynamically, too
+    # a vclock.VirtualClock; None means a clock frozen at 'virtual_time'
+    virtual_clock = None
+    # the pid of the subprocess, if known (set by SandboxRunner)
+    child_pid = None
+    sandio_class = sandboxio.SandboxedIO
+    # assign a profiler.SyscallProfile() here to profile run()
+    profile = None
 
 
     def __init__(self, child_stdin, child_stdout):
-        self.sandio = sandboxio.SandboxedIO(child_stdin, child_stdout)
+        self.sandio = self.sandio_class(child_stdin, child_stdout)
+        self.sandio.message_decoders = self.message_decoders()
 
     @classmethod
     def collect_signatures(cls):
@@ -79,10 +122,40 @@ class VirtualizedProc(object):
                     funcs.setdefault(sig, value)
         return funcs
 
+    @classmethod
+    def _compile_signatures(cls):
+        # Compiled once per class, the first time it is needed.  Note that
+        # this means that signatures added to the class after it started
+        # running a subprocess are not seen.
+        try:
+            return cls.__dict__['_compiled_signatures_']
+        except KeyError:
+            pass
+        decoders = {}
+        dispatchers = {}
+        for sig, func in cls.collect_signatures().items():
+            decoders[sig] = sandboxio.make_message_decoder(sig)
+            dispatchers[sig] = sandboxio.make_message_dispatcher(sig, func)
+        cls._compiled_signatures_ = decoders, dispatchers
+        return decoders, dispatchers
+
+    @classmethod
+    def message_decoders(cls):
+        """Return a dict {signature: (size, decode)} for all the signatures
+        implemented by this class."""
+        return cls._compile_signatures()[0]
+
+    @classmethod
+    def dispatch_table(cls):
+        """Return a dict {signature: (size, dispatch)}, where 'size' is the
+        size of the packed arguments and 'dispatch(self, buf, pos)' decodes
+        them and calls the implementation of the signature."""
+        return cls._compile_signatures()[1]
+
     @classmethod
     def check_dump(cls, dump, missing_ok=set()):
         errors = []
-        cls_signatures = cls.collect_signatures()
+        cls_signatures = cls.dispatch_table()     # compiled once per class
         dump = dump.decode('ascii')
         for line in dump.splitlines(False):
             key, value = line.split(': ', 1)
@@ -108,21 +181,51 @@ class VirtualizedProc(object):
                                       "implemented: %s" % (fnname,))
         return errors
 
+    def lookup_message(self, msg, dispatch_table):
+        """The first step of handling the message 'msg', shared by all the
+        main loops.  Returns (size, dispatch): the loop reads 'size' bytes
+        of arguments and calls dispatch(self, buf, pos), which returns the
+        result to send back, or _NO_RESULT for an unknown signature after
+        calling handle_missing_signature()."""
+        try:
+            return dispatch_table[msg]
+        except KeyError:
+            pass
+        # not cached: we don't want the sandboxed process to make the
+        # controller allocate memory for random signatures
+        size, decode = sandboxio.make_message_decoder(msg)
+        def dispatch(self, buf, pos):
+            result = self.handle_missing_signature(msg, decode(buf, pos))
+            if inspect.isawaitable(result):
+                return _await_no_result(result)    # AsyncVirtualizedProc
+            return _NO_RESULT
+        return size, dispatch
+
     def run(self):
-        cls_signatures = self.collect_signatures()
-        sandio = self.sandio
-        while True:
-            try:
-                msg, args = sandio.read_message()
-            except EOFError:
-                break
-            try:
-                sigfunc = cls_signatures[msg]
-            except KeyError:
-                self.handle_missing_signature(msg, args)
-            else:
-                result = sigfunc(self, *args)
-                sandio.write_result(result)
+        try:
+            if self.profile is not None:
+                self.profile.run(self)
+                return
+            dispatch_table = self.dispatch_table()
+            lookup_message = self.lookup_message
+            sandio = self.sandio
+            while True:
+                try:
+                    msg = sandio.read_signature()
+                except EOFError:
+                    break
+                size, dispatch = lookup_message(msg, dispatch_table)
+                buf, pos = sandio.read_arguments(size)
+                result = dispatch(self, buf, pos)
+                if result is not _NO_RESULT:
+                    sandio.write_result(result)
+        finally:
+            self.close()
+
+    def close(self):
+        """Called by run() when the subprocess has exited, or when run()
+        stops because of an exception.  Mixins that keep per-subprocess
+        resources release them here."""
 
     def handle_missing_signature(self, msg, args):
         raise Exception("subprocess tries to call %r, terminating it" % (
@@ -133,8 +236,6 @@ class VirtualizedProc(object):
     s_chmod          = sigerror("chmod(pi)i")
     s_chown          = sigerror("chown(pii)i")
     s_chroot         = sigerror("chroot(p)i")
-    s_clock_getres   = sigerror("clock_getres(ip)i")
-    s_clock_gettime  = sigerror("clock_gettime(ip)i", errno.ENOSYS, -1)
     s_close          = sigerror("close(i)i")
     s_closedir       = sigerror("closedir(p)i")
     s_confstr        = sigerror("confstr(ipi)i", errno.EINVAL, 0)
@@ -158,7 +259,6 @@ class VirtualizedProc(object):
     s_getlogin       = sigerror("getlogin()p")
     s_getpgid        = sigerror("getpgid(i)i")
     s_getpgrp        = sigerror("getpgrp()i")
-    s_getrusage      = sigerror("getrusage(ip)i")
     s_getsid         = sigerror("getsid(i)i")
     s_initgroups     = sigerror("initgroups(pi)i")
     s_kill           = sigerror("kill(ii)i")
@@ -203,7 +303,6 @@ class VirtualizedProc(object):
     s_system         = sigerror("system(p)i")
     s_tcgetpgrp      = sigerror("tcgetpgrp(i)i", errno.ENOTTY, -1)
     s_tcsetpgrp      = sigerror("tcsetpgrp(ii)i", errno.ENOTTY, -1)
-    s_times          = sigerror("times(p)i")
     s_ttyname        = sigerror("ttyname(i)p", errno.ENOTTY, NULL)
     s_umask          = sigerror("umask(i)i")
     s_uname          = sigerror("uname(p)i", errno.ENOSYS, -1)
@@ -215,7 +314,6 @@ class VirtualizedProc(object):
     s_write          = sigerror("write(ipi)i")
 
     # extra functions needed for pypy3
-    s_clock          = sigerror("clock()i")
     s_clock_settime  = sigerror("clock_settime(ip)i")
     s_dirfd          = sigerror("dirfd(p)i")
     s_faccessat      = sigerror("faccessat(ipii)i")
@@ -265,28 +363,105 @@ class VirtualizedProc(object):
     s_utimensat      = sigerror("utimensat(ippi)i")
 
 
+    def get_virtual_clock(self):
+        clock = self.virtual_clock
+        if clock is None:
+            clock = vclock.FrozenClock(self.virtual_time)
+            self.virtual_clock = clock
+        return clock
+
     @signature("time(p)i")
     def s_time(self, p_tloc):
-        t = int(self.virtual_time)
+        t = int(self.get_virtual_clock().realtime())
         if p_tloc.addr != 0:
-            bytes_data = ffi.buffer(ffi.new("time_t *", t))[:]
-            self.sandio.write_buffer(p_tloc, bytes_data)
+            self.sandio.write_buffer(p_tloc, _pack_time_t(t))
         return t
 
     @signature("gettimeofday(pp)i")
     def s_gettimeofday(self, p_tv, p_tz):
         if p_tv.addr != 0:
-            t = self.virtual_time
+            t = self.get_virtual_clock().realtime()
             assert t >= 0.0
             sec = int(t)
             usec = int((t - sec) * 1000000.0)
-            bytes_data = ffi.buffer(ffi.new("struct timeval *", [sec, usec]))[:]
-            self.sandio.write_buffer(p_tv, bytes_data)
+            self.sandio.write_buffer(p_tv, _pack_timeval(sec, usec))
         if p_tz.addr != 0:
             raise Exception("subprocess called gettimeofday() with a non-null "
                             "second argument (tz)")
         return 0
 
+    def _clock_value(self, clk_id):
+        # the time of the given clock, or None if not supported
+        if clk_id in _realtime_clocks:
+            return self.get_virtual_clock().realtime()
+        if clk_id in _monotonic_clocks:
+            return self.get_virtual_clock().monotonic()
+        if clk_id in _cputime_clocks:
+            return sum(self.get_virtual_clock().cputimes(self))
+        return None
+
+    @signature("clock_gettime(ip)i")
+    def s_clock_gettime(self, clk_id, p_ts):
+        t = self._clock_value(clk_id)
+        if t is None:
+            self.sandio.set_errno(errno.EINVAL)
+            return -1
+        if p_ts.addr == 0:
+            self.sandio.set_errno(errno.EFAULT)
+            return -1
+        sec = int(t // 1)
+        nsec = int((t - sec) * 1e9)
+        self.sandio.write_buffer(p_ts, _pack_timespec(sec, nsec))
+        return 0
+
+    @signature("clock_getres(ip)i")
+    def s_clock_getres(self, clk_id, p_ts):
+        if (clk_id not in _realtime_clocks and
+                clk_id not in _monotonic_clocks and
+                clk_id not in _cputime_clocks):
+            self.sandio.set_errno(errno.EINVAL)
+            return -1
+        if p_ts.addr != 0:
+            res = self.get_virtual_clock().resolution
+            sec = int(res)
+            nsec = int(round((res - sec) * 1e9))
+            if sec == 0 and nsec == 0:
+                nsec = 1
+            self.sandio.write_buffer(p_ts, _pack_timespec(sec, nsec))
+        return 0
+
+    @signature("clock()i")
+    def s_clock(self):
+        return int(sum(self.get_virtual_clock().cputimes(self)) *
+                   lib.CLOCKS_PER_SEC)
+
+    @signature("times(p)i")
+    def s_times(self, p_tms):
+        clock = self.get_virtual_clock()
+        utime, stime = clock.cputimes(self)
+        if p_tms.addr != 0:
+            self.sandio.write_buffer(p_tms, _pack_tms(
+                int(utime * vclock.clock_ticks),
+                int(stime * vclock.clock_ticks)))
+        return int(clock.monotonic() * vclock.clock_ticks)
+
+    @signature("getrusage(ip)i")
+    def s_getrusage(self, who, p_usage):
+        if who == RUSAGE_SELF or who == RUSAGE_THREAD:
+            utime, stime = self.get_virtual_clock().cputimes(self)
+        elif who == RUSAGE_CHILDREN:
+            utime = stime = 0.0
+        else:
+            self.sandio.set_errno(errno.EINVAL)
+            return -1
+        if p_usage.addr == 0:
+            self.sandio.set_errno(errno.EFAULT)
+            return -1
+        self.sandio.write_buffer(p_usage, _pack_rusage(
+            int(utime), int(utime % 1 * 1e6),
+            int(stime), int(stime % 1 * 1e6)))
+        return 0
+
     @signature("get_environ()p")
     def s_get_environ(self):
         """Default implementation: the 'environ' variable points to a NULL
@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+
+"""Runs a queue of sandboxed jobs on a pool of worker processes.
+
+Usage:
+    supervise.py [options] <jobs-file>
+
+The jobs file contains one job per line, in JSON format, like:
+
+    {"id": 1, "executable": "/path/pypy-c-sandbox",
+     "args": ["pypy", "-S", "-c", "print(6*7)"],
+     "lib_path": "/path/pypy", "vfs": {"data": "/real/data"},
+     "stdin": "..."}
+
+See sandboxlib/supervisor.py for the meaning of each key.  Use '-' to read
+the jobs from stdin.  The results are written as JSON lines to stdout, and
+the final metrics to stderr.
+
+Options:
+    --processes=N   the number of worker processes (default: one per core)
+
+    --metrics=SEC   also dump the metrics to stderr every SEC seconds
+"""
+
+import sys, json, time
+from sandboxlib.supervisor import Supervisor
+
+
+def main(argv):
+    from getopt import getopt      # and not gnu_getopt!
+    options, arguments = getopt(argv, 'h',
+        ['processes=', 'metrics=', 'help'])
+
+    def help():
+        sys.stderr.write(__doc__)
+        return 2
+
+    if len(arguments) != 1:
+        return help()
+
+    processes = None
+    metrics_interval = None
+    for option, value in options:
+        if option == '--processes':
+            processes = int(value)
+        elif option == '--metrics':
+            metrics_interval = float(value)
+        elif option in ['-h', '--help']:
+            return help()
+        else:
+            raise ValueError(option)
+
+    def on_result(result):
+        result = dict(result)
+        if result['output'] is not None:
+            result['output'] = result['output'].decode('latin1')
+        sys.stdout.write(json.dumps(result) + '\n')
+        sys.stdout.flush()
+
+    def dump_metrics():
+        sys.stderr.write(json.dumps(supervisor.metrics()) + '\n')
+
+    supervisor = Supervisor(processes, on_result=on_result)
+    if arguments[0] == '-':
+        jobs_file = sys.stdin
+    else:
+        jobs_file = open(arguments[0])
+    num_jobs = 0
+    for line in jobs_file:
+        if line.strip():
+            supervisor.submit(json.loads(line))
+            num_jobs += 1
+
+    if metrics_interval is not None:
+        while supervisor.metrics()['completed'] < num_jobs:
+            time.sleep(metrics_interval)
+            dump_metrics()
+    supervisor.join()
+    dump_metrics()
+    return 0 if supervisor.metrics()['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
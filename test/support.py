@@ -1,9 +1,8 @@
 from __future__ import print_function
 import py
 import os
-import subprocess
-import time
 from sandboxlib.mix_grab_output import MixGrabOutput
+from sandboxlib.runner import SandboxRunner
 
 
 
@@ -11,23 +10,16 @@ class BaseTest(object):
 
     def execute(self, args, env=None):
         assert isinstance(args, (list, tuple))
-        myclass = self.vproccls
-        popen = subprocess.Popen(args, executable=self.pypy_c_sandbox, env=env,
-                                 stdin=subprocess.PIPE,
-                                 stdout=subprocess.PIPE)
-        self.popen = popen
-        self.virtualizedproc = myclass(popen.stdin, popen.stdout)
+        self.runner = SandboxRunner(self.vproccls, self.pypy_c_sandbox, args,
+                                    env=env)
+        self.virtualizedproc = self.runner.start()
+        self.popen = self.runner.popen
         return self.virtualizedproc
 
     def close(self, expected_exitcode=0):
-        timeout = 3.0
-        while self.popen.poll() is None:
-            timeout -= 0.05
-            if timeout < 0.0:
-                self.popen.terminate()
-                raise AssertionError(
-                    "timed out waiting for subprocess to finish")
-            time.sleep(0.05)
+        result = self.runner.wait(timeout=3.0)
+        if result.termination == 'exit_timeout':
+            raise AssertionError("timed out waiting for subprocess to finish")
 
         out = None
         if isinstance(self.virtualizedproc, MixGrabOutput):
@@ -37,6 +29,6 @@ class BaseTest(object):
             print(out)
             print('*****')
 
-        assert self.popen.returncode == expected_exitcode, (
-            "subprocess finished with exit code %r" % (self.popen.returncode,))
+        assert result.exitcode == expected_exitcode, (
+            "subprocess finished with exit code %r" % (result.exitcode,))
         return out
@@ -0,0 +1,102 @@
+import asyncio, io
+import pytest
+from sandboxlib import VirtualizedProc
+from sandboxlib.asyncproc import AsyncVirtualizedProc
+from sandboxlib.mix_accept_input import MixAcceptInput, MmapInput
+from sandboxlib.mix_accept_input import InputSource, AsyncStreamInput
+from sandboxlib.fakechild import run_in_thread
+
+
+class InputProc(MixAcceptInput, VirtualizedProc):
+    pass
+
+class AsyncInputProc(MixAcceptInput, AsyncVirtualizedProc):
+    pass
+
+
+def reading_script(reads, size):
+    def script(child):
+        p_buf = child.alloc(size)
+        while True:
+            n = child.call('read(ipi)i', 0, p_buf, size)
+            reads.append(child.read_memory(p_buf, n))
+            if n == 0:
+                break
+    return script
+
+def run_reads(input_stdin, size):
+    reads = []
+    child_stdin, child_stdout, thread = run_in_thread(
+        reading_script(reads, size))
+    vp = InputProc(child_stdin, child_stdout)
+    vp.input_stdin = input_stdin
+    vp.run()
+    thread.join()
+    assert thread.error is None
+    return reads
+
+
+def test_bytes_input():
+    assert run_reads(b'hello world', 4) == [b'hell', b'o wo', b'rld', b'']
+    assert run_reads(memoryview(b'abc'), 10) == [b'abc', b'']
+    assert run_reads(b'', 10) == [b'']
+
+def test_iterator_input():
+    def gen():
+        yield b'abcdef'
+        yield b''
+        yield bytearray(b'gh')
+    assert run_reads(gen(), 4) == [b'abcd', b'ef', b'gh', b'']
+
+def test_mmap_input(tmpdir):
+    path = tmpdir.join('input')
+    path.write_binary(b'x' * 10000)
+    assert b''.join(run_reads(MmapInput(str(path)), 4096)) == b'x' * 10000
+    path.write_binary(b'')
+    assert run_reads(MmapInput(str(path)), 4096) == [b'']
+
+def test_file_input(tmpdir):
+    path = tmpdir.join('input')
+    path.write_binary(b'data')
+    with path.open('rb') as f:
+        assert run_reads(f, 100) == [b'data', b'']
+
+def test_bytesio_input():
+    f = io.BytesIO(b'skip:data')
+    f.read(5)
+    assert run_reads(f, 100) == [b'data', b'']
+
+def test_stream_input():
+    class Stream(io.RawIOBase):
+        def __init__(self, data):
+            self.data = data
+        def read(self, count):
+            result, self.data = self.data[:count], self.data[count:]
+            return result
+    assert run_reads(Stream(b'abcde'), 3) == [b'abc', b'de', b'']
+
+def test_source_without_read():
+    class NoRead(InputSource):
+        pass
+    with pytest.raises(TypeError):
+        run_reads(NoRead(), 10)
+
+def test_async_source_with_sync_proc():
+    with pytest.raises(TypeError):
+        run_reads(AsyncStreamInput(reader=None), 10)
+
+def test_async_stream_input():
+    reads = []
+    child_stdin, child_stdout, thread = run_in_thread(
+        reading_script(reads, 6))
+    async def main():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b'async data')
+        reader.feed_eof()
+        vp = AsyncInputProc(child_stdin, child_stdout)
+        vp.input_stdin = reader
+        await vp.run()
+    asyncio.run(main())
+    thread.join()
+    assert thread.error is None
+    assert reads == [b'async ', b'data', b'']
@@ -0,0 +1,143 @@
+import pytest
+import asyncio, time
+from sandboxlib.asyncproc import AsyncVirtualizedProc
+from sandboxlib.virtualizedproc import signature
+from sandboxlib.budget import ExecutionBudget, BudgetExceeded
+from sandboxlib.profiler import SyscallProfile
+from sandboxlib.fakechild import run_in_thread
+from sandboxlib.sandboxio import SandboxError
+
+
+class SlowUidProc(AsyncVirtualizedProc):
+    active = 0
+    max_active = 0
+
+    @signature("getuid()i")
+    async def s_getuid(self):
+        cls = SlowUidProc
+        cls.active += 1
+        cls.max_active = max(cls.max_active, cls.active)
+        await asyncio.sleep(0.01)
+        cls.active -= 1
+        return 1000 + self.number
+
+def getuid_script(results, count):
+    def script(child):
+        for i in range(count):
+            results.append(child.call('getuid()i'))
+    return script
+
+
+def test_concurrent_children():
+    children = []
+    async def main():
+        procs = []
+        for i in range(5):
+            results = []
+            child_stdin, child_stdout, thread = run_in_thread(
+                getuid_script(results, 10))
+            vp = SlowUidProc(child_stdin, child_stdout)
+            vp.number = i
+            procs.append(vp)
+            children.append((thread, results))
+        await asyncio.gather(*[vp.run() for vp in procs])
+    start = time.time()
+    asyncio.run(main())
+    assert time.time() - start < 0.4     # not 5 * 10 * 0.01 sequentially
+    assert SlowUidProc.max_active == 5
+    for i, (thread, results) in enumerate(children):
+        thread.join()
+        assert thread.error is None
+        assert results == [1000 + i] * 10
+
+def test_wall_clock():
+    def script(child):
+        child.call('getuid()i')
+        time.sleep(2.0)
+    child_stdin, child_stdout, thread = run_in_thread(script)
+    async def main():
+        vp = SlowUidProc(child_stdin, child_stdout)
+        vp.number = 0
+        ExecutionBudget(wall_clock=0.1).apply(vp)
+        await vp.run()
+    start = time.time()
+    with pytest.raises(BudgetExceeded) as e:
+        asyncio.run(main())
+    assert e.value.reason == 'wall_clock'
+    assert time.time() - start < 1.5
+
+def test_profile_not_supported():
+    child_stdin, child_stdout, thread = run_in_thread(lambda child: None)
+    vp = SlowUidProc(child_stdin, child_stdout)
+    vp.profile = SyscallProfile()
+    with pytest.raises(AssertionError):
+        asyncio.run(vp.run())
+
+class SlowStdin(object):
+    # delays every command read by the fake child from the controller
+    def __init__(self, f, delay):
+        self.f = f
+        self.delay = delay
+
+    def read(self, count):
+        time.sleep(self.delay)
+        return self.f.read(count)
+
+    def close(self):
+        self.f.close()
+
+class StrlenProc(AsyncVirtualizedProc):
+    @signature("test_strlen(p)i")
+    async def s_test_strlen(self, p_str):
+        data = await self.sandio.read_charp_async(p_str, 100)
+        p_copy = await self.sandio.malloc_async(data)
+        assert await self.sandio.read_buffer_async(p_copy, 3) == data[:3]
+        return len(data)
+
+def test_awaitable_requests_do_not_block_the_loop():
+    results = []
+    def script(child):
+        p_str = child.alloc(b'hello\0')
+        child.stdin = SlowStdin(child.stdin, 0.05)
+        results.append(child.call('test_strlen(p)i', p_str))
+    child_stdin, child_stdout, thread = run_in_thread(script)
+    ticks = []
+    async def ticker(task):
+        while not task.done():
+            ticks.append(None)
+            await asyncio.sleep(0.01)
+    async def main():
+        task = asyncio.ensure_future(
+            StrlenProc(child_stdin, child_stdout).run())
+        await asyncio.gather(task, ticker(task))
+    asyncio.run(main())
+    thread.join()
+    assert thread.error is None
+    assert results == [5]
+    assert len(ticks) >= 10     # the loop kept running during the requests
+
+def test_reply_timeout():
+    def script(child):
+        p_str = child.alloc(b'hello\0')
+        child.stdin = SlowStdin(child.stdin, 1.0)
+        child.call('test_strlen(p)i', p_str)
+    child_stdin, child_stdout, thread = run_in_thread(script)
+    vp = StrlenProc(child_stdin, child_stdout)
+    vp.sandio.reply_timeout = 0.1
+    with pytest.raises(SandboxError):
+        asyncio.run(vp.run())
+
+def test_async_missing_signature():
+    class AsyncStrictProc(AsyncVirtualizedProc):
+        async def handle_missing_signature(self, msg, args):
+            await asyncio.sleep(0)
+            raise SandboxError("missing %s" % (msg.decode('ascii'),))
+    child_stdin, child_stdout, thread = run_in_thread(
+        lambda child: child.call('frobnicate(ii)i', 5, 6))
+    vp = AsyncStrictProc(child_stdin, child_stdout)
+    with pytest.raises(SandboxError) as e:
+        asyncio.run(vp.run())
+    assert str(e.value) == "missing frobnicate(ii)i"
+    child_stdin.close()
+    child_stdout.close()
+    thread.join()
@@ -0,0 +1,70 @@
+import pytest
+import os, sys, time, subprocess
+from sandboxlib import VirtualizedProc
+from sandboxlib.mix_grab_output import MixGrabOutput
+from sandboxlib.budget import ExecutionBudget, BudgetExceeded, read_rss
+from sandboxlib.fakechild import run_in_thread
+
+
+class BudgetProc(MixGrabOutput, VirtualizedProc):
+    pass
+
+
+def run_budget(budget, script, pid=None):
+    child_stdin, child_stdout, thread = run_in_thread(script)
+    vp = BudgetProc(child_stdin, child_stdout)
+    budget.apply(vp, pid)
+    try:
+        with pytest.raises(BudgetExceeded) as e:
+            vp.run()
+    finally:
+        child_stdin.close()
+        child_stdout.close()
+    return e.value
+
+def getuid_forever(child):
+    while True:
+        child.call('getuid()i')
+
+
+def test_max_messages():
+    e = run_budget(ExecutionBudget(max_messages=100), getuid_forever)
+    assert e.reason == 'messages'
+    assert e.limit == 100
+
+def test_max_bytes():
+    def script(child):
+        p_buf = child.alloc(b'x' * 1000)
+        while True:
+            child.call('write(ipi)i', 1, p_buf, 1000)
+    e = run_budget(ExecutionBudget(max_bytes_from_child=5500), script)
+    assert e.reason == 'bytes_from_child'
+
+def test_wall_clock():
+    def script(child):
+        child.call('getuid()i')
+        time.sleep(2.0)
+    start = time.time()
+    e = run_budget(ExecutionBudget(wall_clock=0.1), script)
+    assert e.reason == 'wall_clock'
+    assert time.time() - start < 1.5
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason="needs /proc")
+def test_max_rss():
+    assert read_rss(os.getpid()) > 0
+    budget = ExecutionBudget(max_rss=1, rss_check_every=10)
+    e = run_budget(budget, getuid_forever, pid=os.getpid())
+    assert e.reason == 'rss'
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason="needs RLIMIT_AS")
+def test_max_address_space():
+    assert ExecutionBudget(max_rss=1).preexec_fn() is None
+    limit = 4 * 1024 ** 3
+    budget = ExecutionBudget(max_address_space=limit)
+    output = subprocess.check_output(
+        [sys.executable, '-c', 'import resource; '
+         'print(resource.getrlimit(resource.RLIMIT_AS)[0])'],
+        preexec_fn=budget.preexec_fn())
+    assert int(output) == limit
@@ -0,0 +1,61 @@
+from io import StringIO
+from sandboxlib import VirtualizedProc
+from sandboxlib.mix_dump_output import MixDumpOutput
+from sandboxlib.fakechild import run_in_thread
+
+
+class FlushCountingIO(StringIO):
+    flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+        StringIO.flush(self)
+
+
+class DumpProc(MixDumpOutput, VirtualizedProc):
+    pass
+
+
+def run_writes(writes, **attrs):
+    def script(child):
+        for fd, data in writes:
+            child.call('write(ipi)i', fd, child.alloc(data), len(data))
+    child_stdin, child_stdout, thread = run_in_thread(script)
+    vp = DumpProc(child_stdin, child_stdout)
+    vp.dump_stdout = FlushCountingIO()
+    vp.dump_stderr = vp.dump_stdout
+    vp.__dict__.update(attrs)
+    vp.run()
+    thread.join()
+    return vp.dump_stdout
+
+
+def test_dump_sanitize():
+    assert DumpProc.dump_sanitize(DumpProc, b'ab\x00\n\xe9\x7f~') == b'ab?\n??~'
+
+def test_dump_sanitize_override():
+    out = run_writes([(1, b'abc\n')],
+                     dump_sanitize=lambda data: data.upper())
+    assert out.getvalue() == 'ABC\n'
+
+def test_dump_newline():
+    out = run_writes([(1, b'a'), (1, b'b\n'), (1, b'c'), (1, b'd')])
+    assert out.getvalue() == 'ab\ncd'
+    assert out.flushes == 2
+
+def test_dump_colors_and_order():
+    out = run_writes([(1, b'a'), (1, b'b'), (2, b'\x01c'), (1, b'd')],
+                     dump_stdout_fmt='<{0}>', dump_stderr_fmt='[{0}]',
+                     dump_flush='size')
+    assert out.getvalue() == '<ab>[?c]<d>'
+
+def test_dump_always():
+    out = run_writes([(1, b'a'), (1, b'b')], dump_flush='always')
+    assert out.getvalue() == 'ab'
+    assert out.flushes == 2
+
+def test_dump_idle():
+    out = run_writes([(1, b'x')] * 20, dump_flush='idle',
+                     dump_flush_idle=10.0)
+    assert out.getvalue() == 'x' * 20
+    assert out.flushes == 1
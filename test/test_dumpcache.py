@@ -0,0 +1,57 @@
+import os, sys
+from sandboxlib import VirtualizedProc
+from sandboxlib.sandboxio import VERSION
+from sandboxlib import dumpcache
+from sandboxlib.dumpcache import check_executable
+
+
+class DumpProc(VirtualizedProc):
+    pass
+
+
+def make_executable(tmpdir, funcs):
+    counter = tmpdir.join('counter')
+    exe = tmpdir.join('fake-sandbox')
+    exe.write('#!/bin/sh\n'
+              'echo x >> %s\n'
+              'echo "Version: %d"\n'
+              'echo "Platform: %s"\n'
+              'echo "Funcs: %s"\n' % (counter, VERSION, sys.platform, funcs))
+    exe.chmod(0o755)
+    return str(exe), counter
+
+def test_check_executable_cached(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    exe, counter = make_executable(tmpdir, 'getuid()i foobar(i)i')
+    errors = check_executable(DumpProc, exe, cache_dir=cache_dir)
+    assert errors == ["Sandboxed function signature not implemented: "
+                      "foobar(i)i"]
+    assert check_executable(DumpProc, exe, cache_dir=cache_dir) == errors
+    assert len(counter.readlines()) == 1
+    # other signatures allowed to be missing: the dump is reused, but
+    # check_dump() runs again
+    assert check_executable(DumpProc, exe, missing_ok={'foobar(i)i'},
+                            cache_dir=cache_dir) == []
+    assert len(counter.readlines()) == 1
+
+def test_check_executable_changed(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    exe, counter = make_executable(tmpdir, 'foobar(i)i')
+    assert check_executable(DumpProc, exe, cache_dir=cache_dir,
+                            use_hash=True) != []
+    exe, counter = make_executable(tmpdir, 'getuid()i')
+    assert check_executable(DumpProc, exe, cache_dir=cache_dir,
+                            use_hash=True) == []
+    assert len(counter.readlines()) == 2
+
+def test_check_executable_argv0(tmpdir, monkeypatch):
+    spawned = []
+    def spawn(executable, args, **kwds):
+        spawned.append((executable, args))
+        return real_spawn(executable, args, **kwds)
+    real_spawn = dumpcache.spawn
+    monkeypatch.setattr(dumpcache, 'spawn', spawn)
+    exe, counter = make_executable(tmpdir, 'getuid()i')
+    assert check_executable(DumpProc, exe, cache_dir=str(tmpdir),
+                            argv0='/lib/pypy') == []
+    assert spawned == [(os.path.realpath(exe), ['/lib/pypy'])]
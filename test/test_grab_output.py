@@ -0,0 +1,106 @@
+import pytest
+import threading
+from io import BytesIO
+from sandboxlib import VirtualizedProc
+from sandboxlib.mix_grab_output import MixGrabOutput, OutputLimitExceeded
+from sandboxlib.mix_grab_output import RingBufferSink, SpoolSink
+from sandboxlib.mix_grab_output import CallbackSink, QueueSink, OutputSink
+from sandboxlib.fakechild import run_in_thread
+
+
+class GrabProc(MixGrabOutput, VirtualizedProc):
+    output_chunk_size = 1000
+
+
+def run_writes(writes, **kwds):
+    def script(child):
+        for fd, data in writes:
+            child.call('write(ipi)i', fd, child.alloc(data), len(data))
+    child_stdin, child_stdout, thread = run_in_thread(script)
+    vp = GrabProc(child_stdin, child_stdout, **kwds)
+    try:
+        vp.run()
+    finally:
+        child_stdin.close()
+        thread.join()
+    return vp
+
+
+def test_ring_buffer_sink():
+    sink = RingBufferSink(10)
+    sink.write(b'abcdef')
+    assert sink.getvalue() == b'abcdef'
+    sink.write(b'ghijkl')
+    assert sink.getvalue() == b'cdefghijkl'
+    assert sink.dropped == 2
+    sink.write(b'0123456789ABC')
+    assert sink.getvalue() == b'3456789ABC'
+    assert sink.size == 25
+    sink.reset()
+    assert sink.getvalue() == b''
+
+def test_spool_sink():
+    sink = SpoolSink(max_memory=100)
+    sink.write(b'x' * 60)
+    assert not sink.spilled()
+    sink.write(b'y' * 60)
+    assert sink.spilled()
+    sink.write(b'z')
+    assert sink.getvalue() == b'x' * 60 + b'y' * 60 + b'z'
+    f = BytesIO()
+    sink.copy_to(f)
+    assert f.getvalue() == sink.getvalue()
+    sink.close()
+
+def test_grab_default():
+    vp = run_writes([(1, b'out1 '), (2, b'err '), (1, b'out2')])
+    assert vp.get_all_output() == b'out1 err out2'
+    vp.reset_output()
+    assert vp.get_all_output() == b''
+
+def test_grab_separate_and_chunked():
+    big = bytes(range(256)) * 40
+    vp = run_writes([(1, b'out1 '), (2, big), (1, b'out2')],
+                    separate_output=True)
+    assert vp.get_stdout() == b'out1 out2'
+    assert vp.get_stderr() == big
+    # the big write is read in 11 chunks, but is still a single message
+    assert vp.sandio.stats_messages == 3
+
+def test_grab_limit():
+    with pytest.raises(OutputLimitExceeded):
+        run_writes([(1, b'x' * 600), (1, b'y' * 600)],
+                   write_buffer_limit=1000)
+
+def test_grab_streaming():
+    chunks = []
+    queue_sink = QueueSink()
+    received = []
+    reader = threading.Thread(target=lambda: received.extend(queue_sink))
+    reader.start()
+    run_writes([(1, b'a' * 2500), (2, b'b')],
+               stdout_sink=queue_sink, stderr_sink=CallbackSink(chunks.append))
+    reader.join()
+    assert received == [b'a' * 1000, b'a' * 1000, b'a' * 500]
+    assert chunks == [b'b']
+
+def test_sinks_finished_on_error():
+    sink = QueueSink()
+    def script(child):
+        child.call('write(ipi)i', 1, child.alloc(b'abc'), 3)
+        child.call('foobar()i')
+    child_stdin, child_stdout, thread = run_in_thread(script)
+    vp = GrabProc(child_stdin, child_stdout, stdout_sink=sink)
+    with pytest.raises(Exception) as e:
+        vp.run()
+    assert 'foobar()i' in str(e.value)
+    child_stdin.close()
+    thread.join()
+    assert list(sink) == [b'abc']     # does not block
+
+def test_sink_without_write():
+    class BadSink(OutputSink):
+        pass
+    with pytest.raises(TypeError) as e:
+        run_writes([(1, b'data')], stdout_sink=BadSink())
+    assert 'BadSink does not define write()' in str(e.value)
@@ -0,0 +1,87 @@
+import os, sys, subprocess
+import pytest
+from sandboxlib import VirtualizedProc
+from sandboxlib.sandboxio import SandboxError
+from sandboxlib.mix_grab_output import MixGrabOutput
+from sandboxlib.pool import SandboxPool, MixWarmPool, PoolTimeout
+from sandboxlib.pool import WarmSandbox
+from sandboxlib.fakechild import run_in_thread, workload_echo
+
+
+class EchoProc(MixGrabOutput, VirtualizedProc):
+    pass
+
+ENV = {'PYTHONPATH': os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__)))}
+ECHO_ARGS = [sys.executable, '-m', 'sandboxlib.fakechild', 'echo', '100']
+
+
+def test_park_and_resume():
+    class WarmEchoProc(MixWarmPool, EchoProc):
+        pass
+    child_stdin, child_stdout, thread = run_in_thread(
+        lambda child: workload_echo(child, 100))
+    vp = WarmEchoProc(child_stdin, child_stdout)
+    assert vp.pool_run() is True
+    assert vp.pool_resume(b'hello') is True
+    assert vp.get_all_output() == b'hello'
+    assert vp.pool_resume(b' world') is True
+    assert vp.get_all_output() == b'hello world'
+    assert vp.pool_resume(b'', eof=True) is False
+    thread.join()
+    assert thread.error is None
+
+def test_reuse():
+    pool = SandboxPool(EchoProc, ECHO_ARGS, sys.executable, env=ENV,
+                       size=1, max_reuse=3)
+    pool.start()
+    try:
+        pids = []
+        for i in range(5):
+            sandbox = pool.acquire(timeout=10)
+            pids.append(sandbox.popen.pid)
+            pool.release(sandbox)
+        assert pids[0] == pids[1] == pids[2] != pids[3] == pids[4]
+        result = pool.run_job(b'job')
+        assert (result.output, result.exitcode) == (b'job', None)
+    finally:
+        pool.close()
+
+def test_no_reuse():
+    pool = SandboxPool(EchoProc, ECHO_ARGS, sys.executable, env=ENV, size=2)
+    pool.start()
+    try:
+        pids = set()
+        for i in range(3):
+            sandbox = pool.acquire(timeout=10)
+            pids.add(sandbox.popen.pid)
+            pool.release(sandbox)
+        assert len(pids) == 3
+    finally:
+        pool.close()
+
+def test_acquire_timeout():
+    pool = SandboxPool(EchoProc, ECHO_ARGS, sys.executable, env=ENV, size=1)
+    try:
+        with pytest.raises(PoolTimeout):
+            pool.acquire(timeout=0.01)     # not started
+    finally:
+        pool.close()
+
+def test_start_error():
+    pool = SandboxPool(EchoProc, [sys.executable, '-c', 'pass'],
+                       sys.executable, env=ENV, size=1)
+    pool.start()
+    try:
+        with pytest.raises(SandboxError):
+            pool.acquire(timeout=10)
+    finally:
+        pool.close()
+
+def test_kill_closes_pipes():
+    popen = subprocess.Popen([sys.executable, '-c', 'input()'],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    sandbox = WarmSandbox(popen, None)
+    sandbox.kill()
+    assert popen.stdin.closed and popen.stdout.closed
+    assert popen.returncode < 0
@@ -0,0 +1,100 @@
+import itertools
+import pytest
+from sandboxlib import VirtualizedProc
+from sandboxlib.mix_grab_output import MixGrabOutput
+from sandboxlib.profiler import Histogram, SignatureStats, SyscallProfile
+from sandboxlib.fakechild import run_in_thread
+
+
+class ProfiledProc(MixGrabOutput, VirtualizedProc):
+    pass
+
+class MissingSignature(Exception):
+    pass
+
+class StrictProc(VirtualizedProc):
+    def handle_missing_signature(self, msg, args):
+        raise MissingSignature(msg, tuple(args))
+
+
+def test_histogram():
+    h = Histogram()
+    for us in [0.5, 3, 3, 5, 100, 1e9 * 1e6]:
+        h.add(us / 1e6)
+    assert h.as_dict() == {1: 1, 4: 2, 8: 1, 128: 1,
+                           1 << (Histogram.NUM_BUCKETS - 1): 1}
+    assert h.percentile(50) == 4e-6
+    assert h.percentile(80) == 128e-6
+    assert Histogram().percentile(50) is None
+
+def test_signature_stats_extrapolated():
+    st = SignatureStats(b'read(ipi)i')
+    st.count = 100
+    st.sampled = 10
+    st.handler_time = 0.5
+    st.bytes_to_child = 1000
+    d = st.as_dict()
+    assert d['handler_time'] == 5.0
+    assert d['bytes_to_child'] == 10000
+
+def test_summary():
+    profile = SyscallProfile(sample_every=10)
+    st = profile.signatures[b'getuid()i'] = SignatureStats(b'getuid()i')
+    st.count = st.sampled = 1
+    st.handler_time = 0.001
+    st.handler_hist.add(0.001)
+    text = profile.summary()
+    assert 'getuid()i' in text and '1 message in 10' in text
+    assert profile.as_dict()['signatures']['getuid()i']['count'] == 1
+
+def test_run_sampled():
+    def script(child):
+        p_buf = child.alloc(b'x' * 10)
+        for i in range(200):
+            child.call('getuid()i')
+            child.call('write(ipi)i', 1, p_buf, 10)
+    child_stdin, child_stdout, thread = run_in_thread(script)
+    vp = ProfiledProc(child_stdin, child_stdout)
+    # every call to the clock advances it by one "second"
+    vp.profile = profile = SyscallProfile(
+        sample_every=5, clock=itertools.count().__next__)
+    profile._random.seed(42)
+    vp.run()
+    thread.join()
+    assert thread.error is None
+    assert vp.get_all_output() == b'x' * 2000
+    assert profile.messages == 400
+    assert profile.bytes_from_child == 2000
+    sampled = 0
+    for sig in (b'getuid()i', b'write(ipi)i'):
+        st = profile.signatures[sig]
+        assert st.count == 200
+        assert 0 < st.sampled < 200
+        # each timed message is handled between two consecutive clock
+        # readings, and waited for since the previous reading
+        assert st.handler_time == st.wait_time == st.sampled
+        assert st.handler_hist.count == st.wait_hist.count == st.sampled
+        d = profile.as_dict()['signatures'][sig.decode('ascii')]
+        assert abs(d['handler_time'] - 200) < 1e-9
+        sampled += st.sampled
+    assert 400 / 10 < sampled < 400 / 2.5
+    assert profile.signatures[b'write(ipi)i'].bytes_from_child == (
+        10 * profile.signatures[b'write(ipi)i'].sampled)
+
+def test_missing_signature():
+    def script(child):
+        child.call('getuid()i')
+        child.call('frobnicate(ii)i', 5, 6)
+    for profile in [None, SyscallProfile()]:
+        child_stdin, child_stdout, thread = run_in_thread(script)
+        vp = StrictProc(child_stdin, child_stdout)
+        vp.profile = profile
+        with pytest.raises(MissingSignature) as e:
+            vp.run()
+        assert e.value.args == (b'frobnicate(ii)i', (5, 6))
+        child_stdin.close()
+        child_stdout.close()
+        thread.join()
+        if profile is not None:
+            assert profile.messages == 2
+            assert list(profile.signatures) == [b'getuid()i']
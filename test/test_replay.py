@@ -0,0 +1,36 @@
+import pytest
+import struct
+from sandboxlib import VirtualizedProc
+from sandboxlib.replay import TraceWriter, FROM_CHILD, TO_CHILD
+from sandboxlib.replay import replay, iter_messages, ReplayDivergence
+
+
+def write_trace(path, uid):
+    trace = TraceWriter(str(path))
+    trace.write(FROM_CHILD, b'\x09getuid()i')
+    trace.write(TO_CHILD, b'i' + struct.pack('=q', uid))
+    msg = b'getcwd(pi)p'
+    trace.write(FROM_CHILD, bytes([len(msg)]) + msg)
+    trace.write(FROM_CHILD, struct.pack('=qq', 0x1000, 100))
+    trace.write(TO_CHILD, b'W' + struct.pack('=qq', 0x1000, 2) + b'/\x00')
+    trace.write(TO_CHILD, b'p' + struct.pack('=q', 0x1000))
+    trace.close()
+
+def test_replay(tmpdir):
+    path = tmpdir.join('trace')
+    write_trace(path, VirtualizedProc.virtual_uid)
+    replay(VirtualizedProc, str(path))
+    messages = list(iter_messages(str(path)))
+    assert [msg for msg, _, _, _ in messages] == [b'getuid()i',
+                                                  b'getcwd(pi)p']
+    msg, args, requests, result = messages[1]
+    assert args[0].addr == 0x1000 and args[1] == 100
+    assert requests == [('W', 0x1000, b'/\x00')]
+    assert result.addr == 0x1000
+
+def test_replay_divergence(tmpdir):
+    path = tmpdir.join('trace')
+    write_trace(path, 1234)
+    with pytest.raises(ReplayDivergence):
+        replay(VirtualizedProc, str(path))
+    replay(VirtualizedProc, str(path), check=False)
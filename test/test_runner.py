@@ -0,0 +1,60 @@
+import os, sys
+import pytest
+from sandboxlib import VirtualizedProc
+from sandboxlib.mix_vfs import MixVFS, Dir
+from sandboxlib.mix_grab_output import MixGrabOutput
+from sandboxlib.budget import ExecutionBudget
+from sandboxlib.runner import SandboxRunner, spawn, _wait4
+
+
+class RunnerProc(MixVFS, MixGrabOutput, VirtualizedProc):
+    vfs_root = Dir({})
+
+ENV = {'PYTHONPATH': os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__)))}
+
+def fakechild_runner(workload, count, **kwds):
+    return SandboxRunner(RunnerProc, sys.executable,
+                         [sys.executable, '-m', 'sandboxlib.fakechild',
+                          workload, str(count)], env=ENV, **kwds)
+
+
+def test_run():
+    runner = fakechild_runner('stat_storm', 100)
+    result = runner.run()
+    assert result.exitcode == 0
+    assert result.termination is None
+    assert result.output == b''
+    assert runner.vproc.sandio.stats_messages == 100
+    assert result.elapsed >= result.run_time > 0
+    assert result.rusage.ru_utime > 0
+
+def test_run_budget():
+    runner = fakechild_runner('stat_storm', 100000,
+                              budget=ExecutionBudget(max_messages=10))
+    result = runner.run()
+    assert result.termination == 'messages'
+    assert result.exitcode < 0
+
+def test_exit_timeout():
+    runner = SandboxRunner(RunnerProc, '/bin/sh',
+                           ['sh', '-c', 'exec 1>&-; sleep 10'])
+    runner.exit_timeout = 0.2
+    result = runner.run()
+    assert result.termination == 'exit_timeout'
+    assert result.exitcode < 0
+    assert result.elapsed < 5
+
+def test_spawn_env(monkeypatch):
+    script = 'import os, sys; sys.stdout.write(os.environ.get("SBX_TEST", ""))'
+    monkeypatch.setenv('SBX_TEST', 'inherited')
+    for env, expected in [(None, b'inherited'), ({}, b''),
+                          ({'SBX_TEST': 'given'}, b'given')]:
+        popen = spawn(sys.executable, [sys.executable, '-c', script], env=env)
+        out, _ = popen.communicate()
+        assert out == expected
+
+def test_wait4_thread_error(monkeypatch):
+    monkeypatch.delattr(os, 'pidfd_open', raising=False)
+    with pytest.raises(ChildProcessError):
+        _wait4(os.getpid(), 1.0, kill=lambda: None)
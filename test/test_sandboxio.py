@@ -0,0 +1,184 @@
+import os, errno, io
+import pytest
+from sandboxlib import VirtualizedProc
+from sandboxlib.virtualizedproc import signature
+from sandboxlib.sandboxio import SandboxedIO, SandboxError, Ptr
+from sandboxlib.sandboxio import parse_signature
+from sandboxlib.mix_vfs import MixVFS, Dir, File
+from sandboxlib.tmpfs import TmpDir
+from sandboxlib.fakechild import run_in_thread
+
+
+class FakeProc(MixVFS, VirtualizedProc):
+    pass
+
+
+def run_script(script, **kwds):
+    child_stdin, child_stdout, thread = run_in_thread(script)
+    vp = FakeProc(child_stdin, child_stdout, **kwds)
+    vp.run()
+    thread.join()
+    if thread.error is not None:
+        raise thread.error
+    return vp, thread.child
+
+
+class ChunkedReader(object):
+    """A child_stdout that returns the data in chunks of the given sizes,
+    cycling over them."""
+    def __init__(self, data, sizes):
+        self.data = data
+        self.sizes = sizes
+        self.reads = 0
+    def readinto(self, view):
+        size = min(self.sizes[self.reads % len(self.sizes)], len(view))
+        self.reads += 1
+        chunk, self.data = self.data[:size], self.data[size:]
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+def encode_message(sig, *args):
+    return bytes([len(sig)]) + sig + parse_signature(sig)[0].pack(*args)
+
+class SmallBufferIO(SandboxedIO):
+    input_buffer_size = 32
+
+MESSAGES = [(b'getuid()i', ()),
+            (b'dup2(ii)i', (3, 4)),
+            (b'many(iiiiiiii)i', tuple(range(8))),   # larger than 32 bytes
+            (b'lseek(iii)i', (5, -1, 2))] * 5
+
+
+def test_protocol_roundtrip():
+    results = {}
+    p_cwd = []
+    def script(child):
+        p_cwd.append(child.alloc(256))
+        results['uid'] = child.call('getuid()i')
+        results['cwd'] = child.call('getcwd(pi)p', p_cwd[0], 256)
+        results['cwd_value'] = child.read_charp(p_cwd[0])
+    vp, child = run_script(script, vfs_root=Dir({}))
+    assert results['uid'] == VirtualizedProc.virtual_uid
+    assert results['cwd'] == p_cwd[0]
+    assert results['cwd_value'] == b'/'
+    assert vp.sandio.stats_messages == child.messages == 2
+
+def test_vfs_read_and_errno():
+    big = os.urandom(300000)
+    results = {}
+    def script(child):
+        p_buf = child.alloc(len(big) + 100)
+        p_path = child.alloc(b'/big\x00')
+        fd = child.call('open(pii)i', p_path, os.O_RDONLY, 0)
+        # read() returns at most 256KB at once
+        pieces = []
+        while True:
+            n = child.call('read(ipi)i', fd, p_buf, len(big) + 100)
+            if n == 0:
+                break
+            pieces.append(child.read_memory(p_buf, n))
+        results['data'] = b''.join(pieces)
+        child.call('close(i)i', fd)
+        p_missing = child.alloc(b'/missing\x00')
+        results['fd'] = child.call('open(pii)i', p_missing, os.O_RDONLY, 0)
+        results['errno'] = child.errno
+    run_script(script, vfs_root=Dir({'big': File(big)}))
+    assert results['data'] == big
+    assert results['fd'] == -1
+    assert results['errno'] == errno.ENOENT
+
+def test_vfs_write_tmp():
+    tmp = TmpDir()
+    def script(child):
+        p_path = child.alloc(b'/tmp/out\x00')
+        p_buf = child.alloc(b'hello world')
+        fd = child.call('open(pii)i', p_path,
+                        os.O_WRONLY | os.O_CREAT, 0o644)
+        child.call('write(ipi)i', fd, p_buf, 11)
+        child.call('close(i)i', fd)
+    run_script(script, vfs_root=Dir({'tmp': tmp}))
+    assert tmp.join('out').getvalue() == b'hello world'
+
+
+def test_framing_split_messages():
+    data = b''.join([encode_message(sig, *args) for sig, args in MESSAGES])
+    for sizes in [[1], [7], [3, 50], [len(data)]]:
+        sandio = SmallBufferIO(io.BytesIO(), ChunkedReader(data, sizes))
+        got = [sandio.read_message() for i in range(len(MESSAGES))]
+        assert got == MESSAGES
+        # grown for the arguments of 'many(iiiiiiii)i'
+        assert len(sandio._inbuf) > SmallBufferIO.input_buffer_size
+        with pytest.raises(EOFError):
+            sandio.read_message()
+
+def test_framing_truncated_message():
+    data = encode_message(b'dup2(ii)i', 3, 4)[:-1]
+    sandio = SmallBufferIO(io.BytesIO(), ChunkedReader(data, [5]))
+    with pytest.raises(SandboxError):
+        sandio.read_message()
+
+def test_make_room_overlapping():
+    # the unparsed data is longer than the consumed data before it, so
+    # moving it to the start of the buffer is an overlapping copy
+    sandio = SmallBufferIO(io.BytesIO(), ChunkedReader(b'', [1]))
+    sandio._inbuf[:32] = bytes(range(32))
+    sandio._inpos = 4
+    sandio._inend = 32
+    sandio._make_room(30)
+    assert (sandio._inpos, sandio._inend) == (0, 28)
+    assert bytes(sandio._inbuf[:28]) == bytes(range(4, 32))
+
+def test_large_reply():
+    reply = os.urandom(100)
+    child_stdin = io.BytesIO()
+    sandio = SmallBufferIO(child_stdin, ChunkedReader(reply, [9]))
+    assert sandio.read_buffer(Ptr(0x1000), 100) == reply
+    assert child_stdin.getvalue().startswith(b'R')
+    assert sandio.stats_bytes_from_child == 100
+
+def test_dispatch_table():
+    class Base(VirtualizedProc):
+        @signature("dup2(ii)i")
+        def s_dup2(self, fd1, fd2):
+            return fd1 * 10 + fd2
+    class Sub(Base):
+        @signature("frob()i")
+        def s_frob(self):
+            return 42
+    table = Sub.dispatch_table()
+    assert Sub.dispatch_table() is table        # compiled once per class
+    assert Base.dispatch_table() is not table
+    assert b'frob()i' not in Base.dispatch_table()
+    size, dispatch = table[b'dup2(ii)i']
+    args = parse_signature(b'dup2(ii)i')[0].pack(3, 4)
+    assert size == len(args)
+    assert dispatch(None, b'xx' + args, 2) == 34
+    size, dispatch = table[b'frob()i']
+    assert size == 0 and dispatch(None, b'', 0) == 42
+
+def queue_replies(sandio):
+    sandio.write_buffer(Ptr(0x1000), b'hello')
+    sandio.set_errno(errno.ENOENT)
+    sandio.write_buffer(Ptr(0x2000), bytearray(b'world'))
+    sandio.write_result(-1)
+
+def test_coalesced_writev():
+    expected = io.BytesIO()
+    queue_replies(SandboxedIO(expected, io.BytesIO()))
+    expected = expected.getvalue()
+    for max_write in [None, 3]:
+        r, w = os.pipe()
+        with os.fdopen(r, 'rb') as fr, os.fdopen(w, 'wb') as fw:
+            sandio = SandboxedIO(fw, io.BytesIO())
+            if max_write is not None:
+                # partial writes
+                sandio._writev = lambda fd, buffers: os.write(
+                    fd, b''.join(buffers)[:max_write])
+            queue_replies(sandio)
+            assert sandio.stats_write_pieces == 6
+            if max_write is None:
+                assert sandio.stats_write_syscalls == 1
+            else:
+                assert sandio.stats_write_syscalls == (
+                    len(expected) + max_write - 1) // max_write
+            assert fr.read(len(expected)) == expected
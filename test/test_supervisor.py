@@ -0,0 +1,75 @@
+import os, sys, json, subprocess
+import pytest
+from sandboxlib import supervisor as supervisor_module
+from sandboxlib.supervisor import Supervisor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the jobs get an empty environment, so set sys.path explicitly
+ECHO_ARGS = [sys.executable, '-c',
+             'import sys; sys.path.insert(0, %r); '
+             'from sandboxlib.fakechild import main; '
+             'sys.exit(main(sys.argv[1:]))' % (ROOT,),
+             'echo', '100']
+
+JOBS = [
+    {'id': 'ok', 'executable': sys.executable, 'args': ECHO_ARGS,
+     'stdin': 'hello'},
+    {'id': 'bad', 'executable': '/nonexistent/pypy-sandbox',
+     'args': ['pypy']},
+]
+
+
+def test_supervisor():
+    supervisor = Supervisor(2)
+    for job in JOBS:
+        supervisor.submit(job)
+    supervisor.join()
+    results = dict((r['id'], r) for r in supervisor.results)
+    ok, bad = results['ok'], results['bad']
+    assert sorted(ok) == sorted(bad)
+    assert (ok['exitcode'], ok['termination'], ok['error']) == (0, None, None)
+    assert ok['output'] == b'hello'
+    assert ok['rusage'] is not None
+    assert bad['termination'] == 'error'
+    assert bad['error'].startswith('FileNotFoundError')
+    metrics = supervisor.metrics()
+    assert (metrics['submitted'], metrics['completed'],
+            metrics['failed']) == (2, 2, 1)
+    assert metrics['latency']['p50'] is not None
+
+def test_supervise_script(tmpdir):
+    jobs_file = tmpdir.join('jobs')
+    jobs_file.write(''.join(json.dumps(job) + '\n' for job in JOBS))
+    popen = subprocess.Popen([sys.executable,
+                              os.path.join(ROOT, 'supervise.py'),
+                              '--processes=2', str(jobs_file)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = popen.communicate()
+    assert popen.returncode == 1      # one job failed
+    results = [json.loads(line) for line in stdout.splitlines()]
+    assert sorted((r['id'], r['output']) for r in results) == [
+        ('bad', None), ('ok', 'hello')]
+    metrics = json.loads(stderr.splitlines()[-1])
+    assert metrics['failed'] == 1
+
+def test_vfs_roots_lru(tmpdir, monkeypatch):
+    monkeypatch.setattr(supervisor_module, 'MAX_VFS_ROOTS', 2)
+    monkeypatch.setattr(supervisor_module, '_worker_vfs_roots',
+                        supervisor_module.OrderedDict())
+    get_vfs_root = supervisor_module._get_vfs_root
+    jobs = [{'vfs': {'data': str(tmpdir)}}, {'vfs': {'other': str(tmpdir)}},
+            {}]
+    root0 = get_vfs_root(jobs[0])
+    assert get_vfs_root(jobs[0]) is root0
+    root1 = get_vfs_root(jobs[1])
+    get_vfs_root(jobs[0])           # most recently used
+    get_vfs_root(jobs[2])           # evicts jobs[1]
+    assert len(supervisor_module._worker_vfs_roots) == 2
+    assert get_vfs_root(jobs[0]) is root0
+    assert get_vfs_root(jobs[1]) is not root1
+
+def test_reserved_vfs_names(tmpdir):
+    for name in ['tmp', 'lib']:
+        with pytest.raises(ValueError):
+            supervisor_module._get_vfs_root({'vfs': {name: str(tmpdir)}})
@@ -0,0 +1,113 @@
+import pytest
+import os, errno
+from sandboxlib import VirtualizedProc
+from sandboxlib.mix_vfs import MixVFS, Dir, File, PathCache
+from sandboxlib.tmpfs import TmpDir, CHUNK_SIZE
+from sandboxlib.fakechild import run_in_thread
+
+
+def test_write_read_chunks():
+    tmp = TmpDir()
+    node = tmp.create('f', 0o644)
+    f = node.open(os.O_WRONLY | os.O_APPEND)
+    for i in range(3):
+        f.write(b'x' * (CHUNK_SIZE - 1))
+    chunks = node.getchunks()
+    assert len(chunks) == 3
+    f.write(b'y' * 10)       # resizes a chunk that is still exported
+    assert node.getsize() == 3 * CHUNK_SIZE + 7
+    assert sum(len(c) for c in chunks) == 3 * (CHUNK_SIZE - 1)
+    f.close()
+    g = node.open(os.O_RDWR)
+    g.seek(CHUNK_SIZE - 2)
+    assert bytes(g.read(4)) == b'xxxx'
+    g.seek(10, 2)
+    g.write(b'!')
+    assert node.getvalue().endswith(b'y' * 10 + b'\x00' * 10 + b'!')
+    g.truncate(5)
+    assert node.getvalue() == b'xxxxx'
+    g.close()
+    with pytest.raises(OSError) as e:
+        node.open(os.O_RDONLY).write(b'a')
+    assert e.value.errno == errno.EBADF
+
+def test_quota():
+    tmp = TmpDir(max_bytes=100, max_inodes=2)
+    f = tmp.create('a', 0o644).open(os.O_WRONLY)
+    f.write(b'a' * 60)
+    with pytest.raises(OSError) as e:
+        f.write(b'a' * 41)
+    assert e.value.errno == errno.ENOSPC
+    tmp.mkdir('d', 0o755)
+    with pytest.raises(OSError) as e:
+        tmp.create('b', 0o644)
+    assert e.value.errno == errno.ENOSPC
+    tmp.unlink('a')
+    assert (tmp.quota.bytes_used, tmp.quota.inodes_used) == (60, 2)
+    f.close()     # the unlinked file is only freed now
+    assert (tmp.quota.bytes_used, tmp.quota.inodes_used) == (0, 1)
+
+def test_dirs_and_rename():
+    tmp = TmpDir()
+    d = tmp.mkdir('d', 0o755)
+    d.create('x', 0o644).open(os.O_WRONLY).write(b'data')
+    tmp.create('y', 0o644)
+    with pytest.raises(OSError) as e:
+        tmp.rmdir('d')
+    assert e.value.errno == errno.ENOTEMPTY
+    with pytest.raises(OSError) as e:
+        tmp.rename('d', d, 'sub')
+    assert e.value.errno == errno.EINVAL
+    d.rename('x', tmp, 'y')
+    assert [(path, f.getvalue()) for path, f in tmp.walk()] == [
+        ('y', b'data')]
+    tmp.rmdir('d')
+    assert tmp.keys() == ['y']
+    with pytest.raises(OSError) as e:
+        Dir({}).mkdir('foo', 0o755)
+    assert e.value.errno == errno.EPERM
+
+def test_path_cache_skips_tmpfs():
+    tmp = TmpDir()
+    cache = PathCache(Dir({'tmp': tmp, 'ro': File(b'')}))
+    for i in range(2):
+        with pytest.raises(OSError):
+            cache.getnode('/tmp/new')
+    node = tmp.create('new', 0o644)
+    assert cache.getnode('/tmp/new') is node
+    cache.getnode('/ro')
+    assert cache.stats()['size'] == 1
+
+def test_open_dir_through_s_open():
+    class TmpProc(MixVFS, VirtualizedProc):
+        vfs_root = Dir({'tmp': TmpDir(), 'ro': Dir({})})
+    results = []
+    def script(child):
+        for path in (b'/tmp', b'/ro'):
+            p_path = child.alloc(path + b'\0')
+            for flags in (os.O_RDONLY, os.O_WRONLY | os.O_CREAT):
+                child.errno = 0
+                results.append((child.call('open(pii)i', p_path, flags, 0),
+                                child.errno))
+    child_stdin, child_stdout, thread = run_in_thread(script)
+    TmpProc(child_stdin, child_stdout).run()
+    thread.join()
+    assert thread.error is None
+    assert results == [(-1, errno.EISDIR)] * 4
+
+def test_huge_write_is_short():
+    class TmpProc(MixVFS, VirtualizedProc):
+        vfs_root = Dir({'tmp': TmpDir(max_bytes=1000000)})
+    results = []
+    def script(child):
+        fd = child.call('open(pii)i', child.alloc(b'/tmp/f\0'),
+                        os.O_WRONLY | os.O_CREAT, 0o644)
+        p_buf = child.alloc(300000)
+        results.append(child.call('write(ipi)i', fd, p_buf, 2**31))
+    child_stdin, child_stdout, thread = run_in_thread(script)
+    vp = TmpProc(child_stdin, child_stdout)
+    vp.run()
+    thread.join()
+    assert thread.error is None
+    assert results == [256 * 1024]
+    assert vp.sandio.stats_bytes_from_child < 300000
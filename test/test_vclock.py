@@ -0,0 +1,91 @@
+import errno, io, os, time
+import pytest
+from sandboxlib import VirtualizedProc
+from sandboxlib.vclock import StepClock, MonotonicClock
+from sandboxlib.vclock import VirtualClock, FrozenClock
+from sandboxlib.vclock import read_child_cputimes
+from sandboxlib.fakechild import run_in_thread
+from sandboxlib._commonstruct_cffi import ffi
+
+
+def run_calls(calls, clock=None, child_pid=None):
+    results = []
+    def script(child):
+        for sig, size, args in calls:
+            p_buf = child.alloc(size)
+            child.errno = 0
+            res = child.call(sig, *(args + ((p_buf,) if size else ())))
+            results.append((res, child.errno, child.read_memory(p_buf, size)))
+    child_stdin, child_stdout, thread = run_in_thread(script)
+    vp = VirtualizedProc(child_stdin, child_stdout)
+    vp.virtual_clock = clock
+    vp.child_pid = child_pid
+    vp.run()
+    thread.join()
+    assert thread.error is None
+    return results
+
+def timespec(data):
+    ts = ffi.new("struct timespec *")
+    ffi.memmove(ts, data, len(data))
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+SIZEOF_TIMESPEC = ffi.sizeof("struct timespec")
+
+
+def test_frozen_by_default():
+    results = run_calls([
+        ('clock_gettime(ip)i', SIZEOF_TIMESPEC, (time.CLOCK_REALTIME,)),
+        ('clock_gettime(ip)i', SIZEOF_TIMESPEC, (time.CLOCK_MONOTONIC,)),
+        ('clock_gettime(ip)i', SIZEOF_TIMESPEC, (12345,)),
+        ('time(p)i', 0, (0,))])
+    assert results[0][0] == 0
+    assert timespec(results[0][2]) == VirtualizedProc.virtual_time
+    assert timespec(results[1][2]) == 0.0
+    assert results[2][:2] == (-1, errno.EINVAL)
+    assert results[3][0] == int(VirtualizedProc.virtual_time)
+
+def test_step_clock():
+    clock = StepClock(start=1000.0, step=0.5)
+    results = run_calls([
+        ('clock_gettime(ip)i', SIZEOF_TIMESPEC, (time.CLOCK_MONOTONIC,)),
+        ('clock_gettime(ip)i', SIZEOF_TIMESPEC, (time.CLOCK_MONOTONIC,)),
+        ('clock_gettime(ip)i', SIZEOF_TIMESPEC, (time.CLOCK_REALTIME,)),
+        ('clock_getres(ip)i', SIZEOF_TIMESPEC, (time.CLOCK_MONOTONIC,)),
+        ('clock_gettime(ip)i', SIZEOF_TIMESPEC,
+            (time.CLOCK_PROCESS_CPUTIME_ID,)),
+        ('clock()i', 0, ())], clock)
+    assert [timespec(r[2]) for r in results[:5]] == [0.5, 1.0, 1001.5,
+                                                     0.5, 1.5]
+    assert results[5][0] > 0
+
+def test_monotonic_clock_and_cputime():
+    t0 = time.monotonic()
+    results = run_calls([
+        ('clock_gettime(ip)i', SIZEOF_TIMESPEC, (time.CLOCK_REALTIME,)),
+        ('getrusage(ip)i', ffi.sizeof("struct rusage"), (0,)),
+        ('times(p)i', ffi.sizeof("struct tms"), ())],
+        MonotonicClock(start=5000.0), child_pid=os.getpid())
+    t = timespec(results[0][2])
+    assert 5000.0 <= t <= 5000.0 + time.monotonic() - t0
+    usage = ffi.new("struct rusage *")
+    ffi.memmove(usage, results[1][2], ffi.sizeof("struct rusage"))
+    utime = usage.ru_utime.tv_sec + usage.ru_utime.tv_usec * 1e-6
+    assert 0 < utime <= read_child_cputimes(os.getpid())[0] + 0.01
+    assert results[2][0] >= 0
+
+def test_virtual_clock_is_abstract():
+    with pytest.raises(TypeError):
+        VirtualClock()
+    class NoMonotonic(VirtualClock):
+        def realtime(self):
+            return 0.0
+    with pytest.raises(TypeError):
+        NoMonotonic()
+    assert FrozenClock().monotonic() == 0.0
+
+def test_default_clock_created_once():
+    vp = VirtualizedProc(io.BytesIO(), io.BytesIO())
+    clock = vp.get_virtual_clock()
+    assert isinstance(clock, FrozenClock)
+    assert vp.get_virtual_clock() is clock
@@ -0,0 +1,226 @@
+import pytest
+import os, errno, zipfile, gc, weakref
+from sandboxlib.mix_vfs import Dir, File, RealDir, ZipDir, PathCache, OpenDir
+from sandboxlib.mix_vfs import RealFile, MemoryFile
+from sandboxlib.mix_vfs import get_path_cache
+from sandboxlib.mix_vfs import FileContentCache, FDTable, OpenFileDescription
+from sandboxlib.vfsimage import build_image, open_image
+from sandboxlib._commonstruct_cffi import ffi, lib
+
+
+def test_path_cache_hits():
+    f = File(b'data')
+    cache = PathCache(Dir({'a': Dir({'b': f})}))
+    assert cache.getnode('/a/b') is f
+    assert cache.getnode('/a/b') is f
+    assert cache.getnode('/a/./b') is f
+    assert (cache.hits, cache.misses) == (1, 2)
+
+def test_path_cache_negative():
+    cache = PathCache(Dir({'a': Dir({})}))
+    for i in range(3):
+        with pytest.raises(OSError) as e:
+            cache.getnode('/a/missing')
+        assert e.value.errno == errno.ENOENT
+    assert (cache.negative_hits, cache.misses) == (2, 1)
+
+def test_path_cache_lru():
+    cache = PathCache(Dir({'a': File(b''), 'b': File(b''), 'c': File(b'')}),
+                      maxsize=2)
+    cache.getnode('/a')
+    cache.getnode('/b')
+    cache.getnode('/a')
+    cache.getnode('/c')     # evicts '/b'
+    assert cache.stats()['size'] == 2
+    cache.getnode('/a')
+    cache.getnode('/b')
+    assert (cache.hits, cache.misses, cache.evictions) == (2, 4, 2)
+
+def test_path_cache_freed_with_root():
+    root = Dir({'a': File(b'')})
+    cache = get_path_cache(root)
+    assert get_path_cache(root) is cache
+    cache.getnode('/a')
+    cache_ref = weakref.ref(cache)
+    del root, cache
+    gc.collect()
+    assert cache_ref() is None
+
+def test_path_cache_revalidate(tmpdir):
+    cache = PathCache(Dir({'real': RealDir(str(tmpdir))}), revalidate=0)
+    with pytest.raises(OSError):
+        cache.getnode('/real/foo')
+    tmpdir.join('foo').write('hello')
+    os.utime(str(tmpdir), (0, 0))     # make sure the mtime changed
+    assert cache.getnode('/real/foo').getsize() == 5
+
+def test_stable_inodes(tmpdir):
+    tmpdir.join('foo').write('hello')
+    real = RealDir(str(tmpdir))
+    root = Dir({'real': real, 'virt': Dir({'x': File(b'')})})
+    assert real.join('foo').getino() == real.join('foo').getino()
+    assert real.join('foo').getino() != real.getino()
+    x = root.join('virt').join('x')
+    assert x.getino() not in (root.getino(), root.join('virt').getino())
+
+def test_stat_bytes(tmpdir):
+    tmpdir.join('foo').write('hello')
+    os.utime(str(tmpdir.join('foo')), (1000000, 1234567))
+    node = RealDir(str(tmpdir)).join('foo')
+    data = node.stat_bytes()
+    assert node.stat_bytes() is data
+    st = ffi.cast("struct stat *", ffi.from_buffer(data))
+    assert st.st_size == 5
+    assert st.st_mtime == 1234567
+    assert st.st_ino == node.getino()
+
+def test_vfs_image(tmpdir):
+    src = tmpdir.mkdir('src')
+    src.join('a.py').write('print(42)\n')
+    src.join('a.pyc').write('junk')
+    src.join('.hidden').write('')
+    sub = src.mkdir('sub')
+    for i in range(50):
+        sub.join('f%d' % i).write('x' * i)
+    image_path = str(tmpdir.join('test.img'))
+    build_image(str(src), image_path, exclude=['.pyc'], processes=2)
+    root = open_image(image_path).root()
+    assert root.keys() == ['a.py', 'sub']
+    assert root.join('a.py').open().read() == b'print(42)\n'
+    assert root.join('sub').keys() == sorted(['f%d' % i for i in range(50)])
+    for i in range(50):
+        node = root.join('sub').join('f%d' % i)
+        assert node.getsize() == i
+        assert node.open().read() == b'x' * i
+        assert node is root.join('sub').join('f%d' % i)
+    for name in ['a.pyc', '.hidden', 'f1', 'zzz']:
+        with pytest.raises(OSError):
+            root.join(name)
+    assert root.join('sub').is_dir()
+    assert not root.join('a.py').is_dir()
+
+def test_zip_dir(tmpdir):
+    zip_path = str(tmpdir.join('test.zip'))
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        zf.writestr('pkg/__init__.py', b'', zipfile.ZIP_STORED)
+        zf.writestr('pkg/mod.py', b'0123456789' * 100, zipfile.ZIP_STORED)
+        zf.writestr('pkg/sub/data.txt', b'abcdef' * 100,
+                    zipfile.ZIP_DEFLATED)
+        zf.writestr('empty/', b'')
+    root = ZipDir(zip_path)
+    assert root.keys() == ['empty', 'pkg']
+    assert root.join('pkg').keys() == ['__init__.py', 'mod.py', 'sub']
+    assert root.join('empty').keys() == []
+    assert root.join('pkg') is root.join('pkg')
+    for name, expected in [('mod.py', b'0123456789' * 100),
+                           ('sub', None)]:
+        node = root.join('pkg').join(name)
+        if expected is None:
+            assert node.is_dir()
+            continue
+        assert node.getsize() == len(expected)
+        f = node.open()
+        assert f.read(5) == expected[:5]
+        f.seek(-3, 2)
+        assert f.read() == expected[-3:]
+        f.seek(10)
+        assert f.tell() == 10
+        assert f.read(10) == expected[10:20]
+    f = root.join('pkg').join('sub').join('data.txt').open()
+    f.seek(594)
+    assert f.read() == b'abcdef'
+    with pytest.raises(OSError):
+        root.join('pkg').join('missing.py')
+
+def test_file_content_cache(tmpdir):
+    cache = FileContentCache(max_bytes=100, max_file_size=60)
+    for name, size in [('a', 40), ('b', 40), ('c', 40), ('big', 61)]:
+        tmpdir.join(name).write('x' * size)
+    path_a = str(tmpdir.join('a'))
+    assert cache.get(path_a) == b'x' * 40
+    assert cache.get(path_a) is cache.get(path_a)
+    assert cache.get(str(tmpdir.join('big'))) is None
+    cache.get(str(tmpdir.join('b')))
+    cache.get(str(tmpdir.join('c')))      # evicts 'a'
+    assert cache.stats()['resident_bytes'] == 80
+    assert (cache.hits, cache.misses) == (2, 3)
+    tmpdir.join('b').write('y' * 10)
+    os.utime(str(tmpdir.join('b')), (0, 0))
+    assert cache.get(str(tmpdir.join('b'))) == b'y' * 10
+    assert cache.stats()['resident_bytes'] == 50
+
+class _FakeFile(object):
+    closed = False
+    def close(self):
+        self.closed = True
+
+def test_real_file_mmap_is_opt_in(tmpdir):
+    path = tmpdir.join('big')
+    path.write_binary(b'x' * 10000)
+    node = RealFile(str(path))
+    node.content_cache = None
+    f = node.open()
+    try:
+        assert not isinstance(f, MemoryFile)
+        assert f.read() == b'x' * 10000
+    finally:
+        f.close()
+    node.use_mmap = True
+    f = node.open()
+    try:
+        assert isinstance(f, MemoryFile)
+        assert bytes(f.read(5)) == b'xxxxx'
+    finally:
+        f.close()
+
+def test_fd_table():
+    fds = FDTable(range(3, 2000))
+    files = [_FakeFile() for i in range(1997)]
+    for i, f in enumerate(files):
+        assert fds.allocate(OpenFileDescription(f, None)) == 3 + i
+    with pytest.raises(OSError) as e:
+        fds.allocate(OpenFileDescription(_FakeFile(), None))
+    assert e.value.errno == errno.EMFILE
+    fds.close(1000)
+    fds.close(10)
+    assert files[7].closed
+    assert fds.dup(4) == 10
+    assert fds.dup(4) == 1000
+    fds.close(4)
+    assert not files[1].closed      # still open as fds 10 and 1000
+    fds.dup2(5, 10)
+    assert fds[10].f is files[2]
+    fds.close(10)
+    fds.close(1000)
+    assert files[1].closed
+    fds.close_all()
+    assert len(fds) == 0 and all(f.closed for f in files)
+    assert fds.allocate(OpenFileDescription(_FakeFile(), None)) == 3
+
+def test_opendir_snapshot(tmpdir):
+    tmpdir.mkdir('sub')
+    for name in ['b.txt', 'a.pyc', '.hidden', 'c']:
+        tmpdir.join(name).write('x')
+    os.symlink('c', str(tmpdir.join('link')))
+    node = RealDir(str(tmpdir), exclude=['.pyc'])
+    entries = node.scandir()
+    assert [name for name, _, _ in entries] == ['b.txt', 'c', 'sub']
+    for name, d_type, st_ino in entries:
+        sub = node.join(name)
+        assert st_ino == sub.getino()
+        assert (d_type == lib.DT_DIR) == sub.is_dir()
+    fdir = OpenDir(node)
+    records = []
+    while True:
+        record = fdir.readdir()
+        if record is None:
+            break
+        records.append(record)
+    dirent = ffi.new("struct dirent *")
+    ffi.memmove(dirent, records[2], len(records[2]))
+    assert ffi.string(dirent.d_name) == b'sub'
+    assert dirent.d_type == lib.DT_DIR
+    assert dirent.d_ino == node.join('sub').getino()
+    entries = Dir({'x': File(b''), 'y': Dir({})}).scandir()
+    assert [(name, d_type) for name, d_type, _ in entries] == [
+        ('x', lib.DT_REG), ('y', lib.DT_DIR)]